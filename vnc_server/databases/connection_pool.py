@@ -0,0 +1,194 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection of a ConnectionPool frees up within its checkoutTimeout.
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of database connections.
+
+    Callers borrow a connection with connection(), and give it back when done,
+    instead of opening one of their own. The pool opens minSize connections up
+    front, and more as needed, up to maxSize. When all of those are borrowed, a
+    caller waits up to checkoutTimeout seconds for one to come back, then gets
+    a PoolTimeout.
+
+    A connection that sat idle longer than healthCheckInterval seconds is pinged
+    before it is lent out, and replaced if the server dropped it (e.g. MySQL's
+    wait_timeout). So is one whose transaction couldn't be rolled back.
+    """
+
+    def __init__(self, connect, minSize=2, maxSize=32, checkoutTimeout=5.0, healthCheckInterval=30.0):
+        """
+        connect is called (without arguments) to open a new connection.
+        """
+        self.connect = connect
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.checkoutTimeout = checkoutTimeout
+        self.healthCheckInterval = healthCheckInterval
+
+        # Idle connections, each with when it was given back; the last one is lent out first
+        self.idle = []
+
+        # Connections open, idle or not (or being opened)
+        self.size = 0
+
+        self.cond = threading.Condition()
+
+        # Metrics
+        self.checkouts = 0
+        self.connects = 0
+        self.timeouts = 0
+        self.healthFailures = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+
+        for i in range(minSize):
+            self.idle.append((self.open(), time.time()))
+            self.size += 1
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a with block.
+        If the block raises, its transaction is rolled back first.
+        """
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            broken = not ConnectionPool.rollback(conn)
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def acquire(self):
+        start = time.time()
+        deadline = start + self.checkoutTimeout
+
+        with self.cond:
+            while (len(self.idle) == 0 and self.size >= self.maxSize):
+                remaining = deadline - time.time()
+                if (remaining <= 0):
+                    self.timeouts += 1
+                    raise PoolTimeout('No database connection freed up in %ss (all %d in use)' % (self.checkoutTimeout, self.maxSize))
+                self.cond.wait(remaining)
+
+            if (len(self.idle) > 0):
+                conn, lastUsed = self.idle.pop()
+            else:
+                # Open it outside of the lock, but count it now
+                conn, lastUsed = None, None
+                self.size += 1
+
+            wait = time.time() - start
+            self.checkouts += 1
+            self.waitTotal += wait
+            self.waitMax = max(self.waitMax, wait)
+
+        if (conn is None):
+            return self.replace(None)
+
+        if (time.time() - lastUsed > self.healthCheckInterval and not ConnectionPool.ping(conn)):
+            with self.cond:
+                self.healthFailures += 1
+            return self.replace(conn)
+
+        return conn
+
+    def release(self, conn, broken=False):
+        if (broken):
+            ConnectionPool.close(conn)
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            return
+
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    #
+    # Open a connection in place of conn (None if there was none), whose slot the caller holds
+    #
+
+    def replace(self, conn):
+        if (conn is not None):
+            ConnectionPool.close(conn)
+
+        try:
+            return self.open()
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    def open(self):
+        conn = self.connect()
+        with self.cond:
+            self.connects += 1
+        return conn
+
+    #
+    # Forget every connection without closing it. For a forked process, whose pool
+    # holds its parent's connections: the parent still uses them, and closing one
+    # would end its session with the server.
+    #
+
+    def abandon(self):
+        with self.cond:
+            self.idle = []
+            self.size = 0
+            self.cond.notify_all()
+
+    @staticmethod
+    def ping(conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def rollback(conn):
+        try:
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def stats(self):
+        """
+        Returns the metrics of the pool (wait times are in seconds):
+        'size' and 'idle' (connections now), 'maxSize', and 'checkouts', 'connects',
+        'timeouts' and 'healthFailures' so far, and 'checkoutWaitAvg' and 'checkoutWaitMax'.
+        """
+        with self.cond:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'maxSize': self.maxSize,
+                'checkouts': self.checkouts,
+                'connects': self.connects,
+                'timeouts': self.timeouts,
+                'healthFailures': self.healthFailures,
+                'checkoutWaitAvg': self.waitTotal / self.checkouts if self.checkouts else 0.0,
+                'checkoutWaitMax': self.waitMax
+            }
@@ -0,0 +1,67 @@
+import threading
+
+
+class SchemaCache(object):
+    """
+    The columns of each table, reflected the first time a table is needed,
+    then kept for the life of the process.
+
+    After a migration changes a table, invalidate() it (or every table),
+    so it is reflected again on its next use.
+    """
+
+    def __init__(self):
+        # Map from table name to list of objects,
+        # each of which has a 'name' and 'type' field.
+        # List to maintain order and correlation between name and type.
+        self.tableInfo = {}
+
+        # Bumped by invalidate(), so a reflection that started before it isn't kept
+        self.generation = 0
+
+        self.lock = threading.Lock()
+
+        # Tables reflected so far
+        self.reflections = 0
+
+    def getColumns(self, table, db):
+        """
+        The columns of table, reflected with db (a SQLDB) if they aren't known yet.
+        """
+        with self.lock:
+            columns = self.tableInfo.get(table)
+            generation = self.generation
+
+        if (columns is not None):
+            return columns
+
+        # Outside of the lock: two threads may both reflect a table, but neither waits on the other's query
+        columns = db.reflectColumns(table)
+
+        with self.lock:
+            self.reflections += 1
+            if (self.generation == generation):
+                self.tableInfo[table] = columns
+
+        return columns
+
+    def invalidate(self, table=None):
+        """
+        Forget the columns of table, or of every table if it is None.
+        """
+        with self.lock:
+            if (table is None):
+                self.tableInfo = {}
+            else:
+                self.tableInfo.pop(table, None)
+            self.generation += 1
+
+    def stats(self):
+        """
+        Returns the metrics of the cache: 'tables' (known now), and 'reflections' so far.
+        """
+        with self.lock:
+            return {
+                'tables': len(self.tableInfo),
+                'reflections': self.reflections
+            }
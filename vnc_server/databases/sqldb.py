@@ -1,39 +1,138 @@
+import os
+import threading
+from contextlib import contextmanager
+
 import pymysql
 from pprint import pprint
 
 from response import Response
+from connection_pool import ConnectionPool
+from schema_cache import SchemaCache
 
 class SQLDB(object):
+    #
+    # Every SQLDB of a process borrows its connections from the same pool,
+    # one per statement (or batch), so creating one doesn't connect.
+    #
+    poolMinSize = 2
+    poolMaxSize = 32
+    checkoutTimeout = 5.0
+    healthCheckInterval = 30.0
+
+    pool = None
+    poolPid = None
+    poolLock = threading.Lock()
+
+    #
+    # They share the columns of the tables too, each reflected the first time
+    # it is needed (see schema_cache.py), so creating one doesn't query either.
+    #
+    schema = SchemaCache()
+
     def __init__(self):
-        #
-        # Create the connection
-        #
+        # The connection of the transaction in progress (see transaction()), if any,
+        # and the first exception one of its statements raised
+        self.txConn = None
+        self.txError = None
+
+    @staticmethod
+    def connect():
         args = {
             'host':     'localhost',
             'user':     'root',
             'password': 'root',
             'db':       'EcoPRT'
         }
-        # self.conn = pymysql.connect(args)
-        self.conn = pymysql.connect(host='localhost', user='root', password='root', db='EcoPRT')
+        return pymysql.connect(**args)
 
-        #
-        # Reflect the list of tables and associated columns into memory.
-        #
-        self.tables = [r[0] for r in self.executeOne('SHOW TABLES', tuple())]
+    @staticmethod
+    def getPool():
+        """
+        The process's ConnectionPool, created on first use.
+        A forked process (e.g. a worker, see broker.py) gets its own, rather than share its parent's connections.
+        It abandons the ones it inherited, so they are never lent out in it (nor closed, see ConnectionPool.abandon()).
+        """
+        with SQLDB.poolLock:
+            if (SQLDB.pool is None or SQLDB.poolPid != os.getpid()):
+                if (SQLDB.pool is not None):
+                    SQLDB.pool.abandon()
+                SQLDB.pool = ConnectionPool(SQLDB.connect, SQLDB.poolMinSize, SQLDB.poolMaxSize,
+                                            SQLDB.checkoutTimeout, SQLDB.healthCheckInterval)
+                SQLDB.poolPid = os.getpid()
+            return SQLDB.pool
+
+    @staticmethod
+    def invalidateSchema(table=None):
+        """
+        Reflect table (or every table, if None) again on its next use, e.g. after a migration altered it.
+        """
+        SQLDB.schema.invalidate(table)
 
-        # Map from table name to list of objects,
-        # each of which has a 'name' and 'type' field.
-        # List to maintain order and correlation between name and type.
-        self.tableInfo = {}
-        for t in self.tables:
-            columnInfos = [r[0:2] for r in self.executeOne('SHOW COLUMNS FROM %s' % t, tuple())]
-            self.tableInfo[t] = [{'name': ci[0], 'type': ci[1]} for ci in columnInfos]
-    
-    def __del__(self):
-        """The is a destructor method that closes the MySQL connection when the object is deleted
+    @contextmanager
+    def transaction(self):
         """
-        self.conn.close()
+        Run the create/read/update/delete calls of a with block on one connection, in one transaction:
+
+            with db.transaction():
+                db.update(...)
+                db.delete(...)
+
+        They are committed together when the block ends. If the block raises, any of the
+        calls failed (even if its failed Response was ignored), or the commit fails, they
+        are all rolled back, and the exception is raised from the with statement.
+
+        Until the block ends, only the thread that started it may use this SQLDB.
+        Transactions don't nest.
+        """
+        if (self.txConn is not None):
+            raise Exception('This SQLDB is already in a transaction')
+
+        pool = SQLDB.getPool()
+        conn = pool.acquire()
+        self.txConn = conn
+        self.txError = None
+        broken = False
+        try:
+            yield self
+
+            if (self.txError is not None):
+                raise self.txError
+            conn.commit()
+        except Exception:
+            # A connection that can't even roll back is replaced
+            broken = not ConnectionPool.rollback(conn)
+            raise
+        finally:
+            self.txConn = None
+            self.txError = None
+            pool.release(conn, broken)
+
+    @contextmanager
+    def connection(self):
+        """
+        The connection to run statements on: the transaction's, if one is in progress, or one borrowed from the pool.
+        """
+        if (self.txConn is None):
+            with SQLDB.getPool().connection() as conn:
+                yield conn
+            return
+
+        try:
+            yield self.txConn
+        except Exception as e:
+            # Fails the whole transaction, even if the caller carries on
+            if (self.txError is None):
+                self.txError = e
+            raise
+
+    def commit(self, conn):
+        # A transaction only commits at its end
+        if (self.txConn is None):
+            conn.commit()
+
+    def reflectColumns(self, table):
+        columnInfos = [r[0:2] for r in self.executeOne('SHOW COLUMNS FROM %s' % table, tuple())]
+        return [{'name': ci[0], 'type': ci[1]} for ci in columnInfos]
 
     def executeOne(self, sql, args):
         """
@@ -44,11 +143,12 @@ class SQLDB(object):
         # print('\tSQL: %s' % sql)
         # print('\targs: tuple(%s)\n' % list(args))
 
-        with self.conn.cursor() as cursor:
-            cursor.execute(sql, args)
-            results = list(cursor.fetchall())
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, args)
+                results = list(cursor.fetchall())
 
-        self.conn.commit()
+            self.commit(conn)
 
         #
         # Convert from bytes (VARBINARY) to string
@@ -66,6 +166,20 @@ class SQLDB(object):
         return newResults
 
 
+    def executeAll(self, statements):
+        """
+        Run several (sql, args) statements on one connection, in one transaction (and one commit),
+        or as part of the transaction in progress.
+        If any of them fails, none of them is applied, and its exception is raised.
+        """
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                for sql, args in statements:
+                    cursor.execute(sql, args)
+
+            self.commit(conn)
+
+
     def create(self, table, cols, obj):
         colsSQL = ', '.join(cols)
 
@@ -81,6 +195,73 @@ class SQLDB(object):
             return Response(False, str(e))
 
 
+    def createMany(self, table, cols, rows, ignoreDuplicates=False):
+        """
+        Insert many rows with one multi-row INSERT statement (and one commit).
+        Each row is a tuple of values, in the same order as cols.
+        With ignoreDuplicates, rows whose key already exists are skipped instead of failing the whole insert.
+        """
+        if (len(rows) == 0):
+            return Response(True, 'Nothing to create.')
+
+        colsSQL = ', '.join(cols)
+
+        rowSQL = '(%s)' % ', '.join(['%s' for c in cols])
+        valsSQL = ', '.join([rowSQL] * len(rows))
+
+        verb = 'INSERT IGNORE' if ignoreDuplicates else 'INSERT'
+        sql = '%s INTO %s (%s) VALUES %s' % (verb, table, colsSQL, valsSQL)
+        args = tuple([v for row in rows for v in row])
+
+        try:
+            self.executeOne(sql, args)
+            return Response(True, 'Successfully created %d rows.' % len(rows))
+        except Exception as e:
+            return Response(False, str(e))
+
+
+    def upsert(self, table, cols, obj, updateCols):
+        """
+        Insert a row, or, if its key already exists, set updateCols of that row instead
+        (INSERT ... ON DUPLICATE KEY UPDATE), in one statement.
+        """
+        return self.upsertMany(table, cols, [tuple([obj[c] for c in cols])], updateCols)
+
+
+    def upsertMany(self, table, cols, rows, updateCols):
+        """
+        Upsert many rows with one multi-row statement (and one commit), like createMany().
+        Each row is a tuple of values, in the same order as cols.
+        """
+        if (len(rows) == 0):
+            return Response(True, 'Nothing to upsert.')
+
+        try:
+            self.executeOne(*SQLDB.upsertSQL(table, cols, rows, updateCols))
+            return Response(True, 'Successfully upserted %d rows.' % len(rows))
+        except Exception as e:
+            return Response(False, str(e))
+
+
+    @staticmethod
+    def upsertSQL(table, cols, rows, updateCols):
+        """
+        The (sql, args) of upsertMany(), e.g. for executeAll().
+        The new values are named by a row alias, so this needs MySQL 8.0.19 or later (see README.md).
+        """
+        colsSQL = ', '.join(cols)
+
+        rowSQL = '(%s)' % ', '.join(['%s' for c in cols])
+        valsSQL = ', '.join([rowSQL] * len(rows))
+
+        updateSQL = ', '.join(['%s=new.%s' % (uc, uc) for uc in updateCols])
+
+        sql = 'INSERT INTO %s (%s) VALUES %s AS new ON DUPLICATE KEY UPDATE %s' % (table, colsSQL, valsSQL, updateSQL)
+        args = tuple([v for row in rows for v in row])
+
+        return sql, args
+
+
     def read(self, table, selectCols, whereCols, obj):
         if (whereCols is None):
             whereCols = []
@@ -100,6 +281,8 @@ class SQLDB(object):
         args = tuple(obj[wc] for wc in whereCols)
 
         try:
+            if (selectCols == '*'):
+                tableInfo = SQLDB.schema.getColumns(table, self)
             results = self.executeOne(sql, args)
         except Exception as e:
             return Response(False, str(e))
@@ -111,7 +294,7 @@ class SQLDB(object):
                 # Use the reflected list of columns to determine order
                 out.append({
                     colInfo['name']: res[i]
-                    for i, colInfo in enumerate(self.tableInfo[table])
+                    for i, colInfo in enumerate(tableInfo)
                 })
             else:
                 out.append({
@@ -123,6 +306,18 @@ class SQLDB(object):
 
 
     def update(self, table, setAttrs, whereAttrs):
+        try:
+            self.executeOne(*SQLDB.updateSQL(table, setAttrs, whereAttrs))
+            return Response(True, 'Successfully updated.')
+        except Exception as e:
+            return Response(False, str(e))
+
+
+    @staticmethod
+    def updateSQL(table, setAttrs, whereAttrs):
+        """
+        The (sql, args) of update(), e.g. for executeAll().
+        """
         if (whereAttrs == None):
             whereAttrs = {}
 
@@ -144,9 +339,29 @@ class SQLDB(object):
         values.extend([whereAttrs[wc] for wc in whereCols])
         args = tuple(values)
 
+        return sql, args
+
+
+    def updateMany(self, table, setCols, whereCols, rows):
+        """
+        Run the same UPDATE for many rows, all in one transaction (and one commit).
+        Each row is a tuple of the values of setCols, then of whereCols.
+        If any of them fails, none of them is applied.
+        """
+        if (len(rows) == 0):
+            return Response(True, 'Nothing to update.')
+
+        setSQL   = ', '.join(['%s=%%s' % sc for sc in setCols])
+        whereSQL = ' AND '.join(['%s=%%s' % wc for wc in whereCols])
+
+        sql = 'UPDATE %s SET %s WHERE %s' % (table, setSQL, whereSQL)
+
         try:
-            self.executeOne(sql, args)
-            return Response(True, 'Successfully updated.')
+            with self.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.executemany(sql, rows)
+                self.commit(conn)
+            return Response(True, 'Successfully updated %d rows.' % len(rows))
         except Exception as e:
             return Response(False, str(e))
 
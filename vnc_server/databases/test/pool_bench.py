@@ -0,0 +1,100 @@
+#
+# Benchmark of the API's HTTP requests against MySQL: the latency of each,
+# and the queries and new connections it costs.
+#
+# Run it from vnc_server/network (flaskAPI's imports are relative to it), with
+# MySQL up and a user to sign in as:
+#
+#     python3 ../databases/test/pool_bench.py EMAIL PASSWORD [--unpooled] [-n N]
+#
+# With --unpooled, every query opens a connection of its own and closes it
+# after, close to what every SQLDB() cost before it had a ConnectionPool.
+#
+import argparse
+import json
+import sys
+import os
+import time
+import base64
+
+sys.path.insert(1, os.path.abspath('../databases'))
+import pymysql
+from sqldb import SQLDB
+from connection_pool import ConnectionPool
+
+
+class CountingCursor(pymysql.cursors.Cursor):
+    queries = 0
+
+    def execute(self, query, args=None):
+        CountingCursor.queries += 1
+        return super().execute(query, args)
+
+
+class Unpooled(ConnectionPool):
+    """
+    Opens a connection per checkout, and closes it when it comes back.
+    """
+    def release(self, conn, broken=False):
+        super().release(conn, True)
+
+
+def connect():
+    return pymysql.connect(host='localhost', user='root', password='root', db='EcoPRT', cursorclass=CountingCursor)
+
+
+def bench(client, path, headers, n):
+    pool = SQLDB.getPool()
+    queries = CountingCursor.queries
+    connects = pool.stats()['connects']
+    latencies = []
+
+    for i in range(n):
+        start = time.time()
+        response = client.get(path, headers=headers)
+        latencies.append(time.time() - start)
+        if (response.status_code != 200):
+            print('%s returned %d' % (path, response.status_code))
+            return
+
+    latencies.sort()
+    print('%-24s avg %7.2fms  p50 %7.2fms  p95 %7.2fms  %5.1f queries/req  %5.2f connects/req' % (
+        path,
+        1000 * sum(latencies) / n,
+        1000 * latencies[n // 2],
+        1000 * latencies[int(n * 0.95)],
+        (CountingCursor.queries - queries) / n,
+        (pool.stats()['connects'] - connects) / n
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('email')
+    parser.add_argument('password')
+    parser.add_argument('--unpooled', action='store_true')
+    parser.add_argument('-n', type=int, default=200)
+    args = parser.parse_args()
+
+    SQLDB.connect = staticmethod(connect)
+    if (args.unpooled):
+        SQLDB.pool = Unpooled(connect, 0, SQLDB.poolMaxSize, SQLDB.checkoutTimeout, SQLDB.healthCheckInterval)
+        SQLDB.poolPid = os.getpid()
+
+    # Creates the VehicleServer, as the API does
+    import flaskAPI
+    client = flaskAPI.app.test_client()
+
+    basic = base64.b64encode(('%s:%s' % (args.email, args.password)).encode()).decode()
+    token = json.loads(client.get('/tokens', headers={'Authorization': 'Basic ' + basic}).get_data(as_text=True))['token']
+    headers = {'Authorization': 'Bearer ' + token}
+
+    print('%s, %d requests each' % ('Unpooled' if args.unpooled else 'Pooled', args.n))
+    for path in ['/vehicles', '/locationNodes', '/rides', '/users/%s/ride' % args.email]:
+        bench(client, path, headers, args.n)
+
+    print(SQLDB.getPool().stats())
+
+
+if __name__ == '__main__':
+    main()
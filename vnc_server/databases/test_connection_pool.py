@@ -0,0 +1,161 @@
+#
+# Unit tests of ConnectionPool (see connection_pool.py), with stand-in connections.
+# No MySQL needed.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_connection_pool.py
+#
+import threading
+import time
+
+import pytest
+
+from connection_pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection(object):
+    def __init__(self, number):
+        self.number = number
+        self.alive = True
+        self.canRollBack = True
+        self.rollbacks = 0
+        self.closed = False
+
+    def ping(self, reconnect=True):
+        if (not self.alive):
+            raise Exception('MySQL server has gone away')
+
+    def rollback(self):
+        if (not self.canRollBack):
+            raise Exception('Lost connection to MySQL server')
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class Connector(object):
+    """
+    Opens FakeConnections, numbered from 1, and keeps them
+    """
+
+    def __init__(self):
+        self.opened = []
+        self.failing = False
+
+    def __call__(self):
+        if (self.failing):
+            raise Exception("Can't connect to MySQL server")
+        conn = FakeConnection(len(self.opened) + 1)
+        self.opened.append(conn)
+        return conn
+
+
+def makePool(minSize=1, maxSize=2, checkoutTimeout=0.1, healthCheckInterval=30.0):
+    connector = Connector()
+    return ConnectionPool(connector, minSize, maxSize, checkoutTimeout, healthCheckInterval), connector
+
+
+def test_opens_min_size_up_front_and_reuses_connections():
+    pool, connector = makePool(minSize=2, maxSize=4)
+    assert len(connector.opened) == 2
+
+    for i in range(5):
+        with pool.connection() as conn:
+            pass
+
+    assert len(connector.opened) == 2
+    assert pool.stats()['checkouts'] == 5
+
+
+def test_checkout_times_out_when_every_connection_is_borrowed():
+    pool, connector = makePool(maxSize=2, checkoutTimeout=0.1)
+    borrowed = [pool.acquire(), pool.acquire()]
+
+    start = time.time()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+
+    assert time.time() - start >= 0.1
+    stats = pool.stats()
+    assert (stats['size'], stats['idle'], stats['timeouts']) == (2, 0, 1)
+
+
+def test_waiting_checkout_gets_a_returned_connection():
+    pool, connector = makePool(maxSize=1, checkoutTimeout=5.0)
+    conn = pool.acquire()
+
+    threading.Timer(0.05, pool.release, args=(conn,)).start()
+
+    assert pool.acquire() is conn
+    assert pool.stats()['checkoutWaitMax'] >= 0.05
+
+
+def test_dropped_idle_connection_is_replaced():
+    pool, connector = makePool(healthCheckInterval=0.0)
+    stale = connector.opened[0]
+    stale.alive = False
+
+    time.sleep(0.01)
+    conn = pool.acquire()
+
+    assert conn is not stale
+    assert stale.closed
+    stats = pool.stats()
+    assert (stats['healthFailures'], stats['connects'], stats['size']) == (1, 2, 1)
+
+
+def test_recently_used_connection_is_not_pinged():
+    pool, connector = makePool(healthCheckInterval=30.0)
+    connector.opened[0].alive = False
+
+    assert pool.acquire() is connector.opened[0]
+    assert pool.stats()['healthFailures'] == 0
+
+
+def test_failed_block_rolls_back_and_keeps_the_connection():
+    pool, connector = makePool()
+
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            raise ValueError('bad row')
+
+    assert conn.rollbacks == 1
+    assert not conn.closed
+    assert pool.stats()['idle'] == 1
+
+
+def test_connection_that_cant_roll_back_is_replaced():
+    pool, connector = makePool()
+
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            conn.canRollBack = False
+            raise ValueError('bad row')
+
+    assert conn.closed
+    assert pool.stats()['size'] == 0
+    assert pool.acquire() is not conn
+
+
+def test_failed_connect_frees_its_slot():
+    pool, connector = makePool(minSize=0, maxSize=1)
+    connector.failing = True
+
+    with pytest.raises(Exception):
+        pool.acquire()
+    assert pool.stats()['size'] == 0
+
+    connector.failing = False
+    assert pool.acquire() is connector.opened[0]
+
+
+def test_abandoned_connections_are_not_closed_or_lent():
+    pool, connector = makePool(minSize=2, maxSize=2)
+
+    pool.abandon()
+
+    assert not any(conn.closed for conn in connector.opened)
+    assert pool.stats()['size'] == 0
+    assert pool.acquire() not in connector.opened[:2]
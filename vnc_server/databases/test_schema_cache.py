@@ -0,0 +1,95 @@
+#
+# Unit tests of SchemaCache (see schema_cache.py), with a stand-in database.
+# No MySQL needed.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_schema_cache.py
+#
+import threading
+
+from schema_cache import SchemaCache
+
+
+class FakeDB(object):
+    """
+    Reflects every table as the columns in the columns dict, and counts the reflections.
+    If pause is set, each reflection waits on it, after telling reflecting.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.reflected = []
+        self.pause = None
+        self.reflecting = threading.Event()
+
+    def reflectColumns(self, table):
+        self.reflected.append(table)
+        columns = [{'name': name, 'type': 'int'} for name in self.columns[table]]
+        if (self.pause is not None):
+            self.reflecting.set()
+            assert self.pause.wait(5)
+        return columns
+
+
+def names(columns):
+    return [c['name'] for c in columns]
+
+
+def test_table_is_reflected_once():
+    cache = SchemaCache()
+    db = FakeDB({'Rides': ['id', 'userEmail']})
+
+    assert names(cache.getColumns('Rides', db)) == ['id', 'userEmail']
+    assert names(cache.getColumns('Rides', db)) == ['id', 'userEmail']
+
+    assert db.reflected == ['Rides']
+    assert cache.stats() == {'tables': 1, 'reflections': 1}
+
+
+def test_invalidated_table_is_reflected_again():
+    cache = SchemaCache()
+    db = FakeDB({'Rides': ['id'], 'Users': ['email']})
+    cache.getColumns('Rides', db)
+    cache.getColumns('Users', db)
+
+    db.columns['Rides'] = ['id', 'status']
+    cache.invalidate('Rides')
+
+    assert names(cache.getColumns('Rides', db)) == ['id', 'status']
+    assert names(cache.getColumns('Users', db)) == ['email']
+    assert db.reflected == ['Rides', 'Users', 'Rides']
+
+
+def test_invalidating_every_table():
+    cache = SchemaCache()
+    db = FakeDB({'Rides': ['id'], 'Users': ['email']})
+    cache.getColumns('Rides', db)
+    cache.getColumns('Users', db)
+
+    cache.invalidate()
+
+    assert cache.stats()['tables'] == 0
+    cache.getColumns('Users', db)
+    assert db.reflected == ['Rides', 'Users', 'Users']
+
+
+def test_reflection_that_started_before_an_invalidation_is_not_kept():
+    cache = SchemaCache()
+    db = FakeDB({'Rides': ['id']})
+    db.pause = threading.Event()
+
+    result = []
+    reflector = threading.Thread(target=lambda: result.append(cache.getColumns('Rides', db)))
+    reflector.start()
+    assert db.reflecting.wait(5)
+
+    # The migration lands while the old columns are being read
+    db.columns['Rides'] = ['id', 'status']
+    cache.invalidate('Rides')
+    db.pause.set()
+    reflector.join(5)
+
+    assert names(result[0]) == ['id']
+    assert names(cache.getColumns('Rides', db)) == ['id', 'status']
+    assert len(db.reflected) == 2
@@ -0,0 +1,153 @@
+#
+# Unit tests of SQLDB.transaction() (see sqldb.py), on stand-in connections.
+# No MySQL needed, only the pymysql package that sqldb.py imports.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_sqldb.py
+#
+import pytest
+
+from sqldb import SQLDB
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, args=None):
+        if ('Broken' in sql):
+            raise Exception("Table 'EcoPRT.Broken' doesn't exist")
+        self.conn.log.append(sql.split(' (')[0])
+
+    def fetchall(self):
+        return ()
+
+
+class FakeConnection(object):
+    """
+    Logs the statements run on it, and its commits, rollbacks and close
+    """
+
+    def __init__(self):
+        self.log = []
+        self.failCommit = False
+        self.canRollBack = True
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        if (self.failCommit):
+            raise Exception('Lost connection to MySQL server during query')
+        self.log.append('COMMIT')
+
+    def rollback(self):
+        if (not self.canRollBack):
+            raise Exception('Lost connection to MySQL server')
+        self.log.append('ROLLBACK')
+
+    def ping(self, reconnect=True):
+        pass
+
+    def close(self):
+        self.log.append('CLOSE')
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    """
+    The only connection of a fresh pool, which every SQLDB borrows
+    """
+    conn = FakeConnection()
+    monkeypatch.setattr(SQLDB, 'connect', staticmethod(lambda: conn))
+    monkeypatch.setattr(SQLDB, 'poolMinSize', 0)
+    monkeypatch.setattr(SQLDB, 'poolMaxSize', 1)
+    monkeypatch.setattr(SQLDB, 'checkoutTimeout', 0.1)
+    monkeypatch.setattr(SQLDB, 'pool', None)
+    return conn
+
+
+def test_statements_commit_together(conn):
+    db = SQLDB()
+
+    with db.transaction():
+        assert db.create('Rides', ['id'], {'id': 1}).success
+        assert db.delete('Rides', ['id'], {'id': 2}).success
+
+    assert conn.log == ['INSERT INTO Rides', 'DELETE FROM Rides WHERE id=%s', 'COMMIT']
+
+
+def test_ignored_failure_rolls_back_everything(conn):
+    db = SQLDB()
+
+    with pytest.raises(Exception, match="doesn't exist"):
+        with db.transaction():
+            db.create('Rides', ['id'], {'id': 1})
+            # The caller only gets a failed Response, and carries on
+            assert not db.create('Broken', ['id'], {'id': 1}).success
+            db.create('Rides', ['id'], {'id': 2})
+
+    assert conn.log == ['INSERT INTO Rides', 'INSERT INTO Rides', 'ROLLBACK']
+    assert SQLDB.getPool().stats()['idle'] == 1
+
+
+def test_exception_in_the_block_rolls_back(conn):
+    db = SQLDB()
+
+    with pytest.raises(ValueError):
+        with db.transaction():
+            db.create('Rides', ['id'], {'id': 1})
+            raise ValueError('no such rider')
+
+    assert conn.log == ['INSERT INTO Rides', 'ROLLBACK']
+
+
+def test_failed_commit_rolls_back(conn):
+    db = SQLDB()
+    conn.failCommit = True
+
+    with pytest.raises(Exception, match='Lost connection'):
+        with db.transaction():
+            db.create('Rides', ['id'], {'id': 1})
+
+    assert conn.log == ['INSERT INTO Rides', 'ROLLBACK']
+
+
+def test_connection_that_cant_roll_back_is_replaced(conn):
+    db = SQLDB()
+    conn.canRollBack = False
+
+    with pytest.raises(ValueError):
+        with db.transaction():
+            raise ValueError('no such rider')
+
+    assert conn.log == ['CLOSE']
+    assert SQLDB.getPool().stats()['size'] == 0
+
+
+def test_statements_after_the_transaction_commit_on_their_own(conn):
+    db = SQLDB()
+    with db.transaction():
+        db.create('Rides', ['id'], {'id': 1})
+
+    db.create('Rides', ['id'], {'id': 2})
+
+    assert conn.log == ['INSERT INTO Rides', 'COMMIT', 'INSERT INTO Rides', 'COMMIT']
+
+
+def test_transactions_dont_nest(conn):
+    db = SQLDB()
+
+    with pytest.raises(Exception, match='already in a transaction'):
+        with db.transaction():
+            with db.transaction():
+                pass
+
+    assert conn.log == ['ROLLBACK']
@@ -0,0 +1,382 @@
+#
+# The asyncio server mode.
+#
+# In the threaded mode (the default) every vehicle connection gets a thread
+# that blocks on its socket. In the asyncio mode every connection is a coroutine
+# on one event loop instead, so the server holds thousands of vehicles
+# without thousands of threads.
+#
+# The FSM and the Command classes are the same as GoodStrategy's;
+# only the waiting differs. Everything that talks to the databases blocks,
+# so it runs in a bounded thread pool (the DB executor) that the loop awaits.
+#
+# A gateway connection (see gateway.py) is served the same way: each of its
+# vehicles is a coroutine reading its channel, rather than a thread.
+#
+# Not supported in this mode (yet): pipelining.
+# A vehicle that asks for pipelining gets a plain connection.
+#
+
+import asyncio
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from command import *
+from communication import Communication
+from gateway import AsyncGatewayConnection
+from network.comm_strategy import CommStrategy, GoodStrategy
+from network.vehicle_util import *
+
+# Hacky work-around to be able to import from a folder above this one.
+import sys
+import os
+
+sys.path.append(os.path.abspath('../databases'))
+from sqldb import SQLDB
+
+import logging
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(formatter)
+logging_path = os.path.dirname(os.path.realpath(__file__)).split("src/")[0] + "src/server_log"
+fh = logging.FileHandler(logging_path)
+fh.setLevel(logging.DEBUG)
+fh.setFormatter(formatter)
+logger.addHandler(ch)
+logger.addHandler(fh)
+logger.setLevel(logging.DEBUG)
+
+
+class AsyncStream(object):
+    """
+    One vehicle connection, as asyncio streams.
+
+    Stands in for the vehicle's socket: sendFrame() queues a frame on the
+    transport without blocking, so Command.send() can use it directly,
+    and recvFrame() is a coroutine.
+    Only use it from the event loop's thread.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def recvFrame(self):
+        lengthBytes = await self.readExactly(Communication.msgSizeLen, True)
+        payloadLength = struct.unpack(Communication.intByteRep, lengthBytes)[0]
+        Communication.checkFrameLength(payloadLength)
+
+        return await self.readExactly(payloadLength, False)
+
+    async def readExactly(self, n, atFrameStart):
+        try:
+            return await self.reader.readexactly(n)
+        except asyncio.IncompleteReadError as e:
+            received = len(e.partial)
+
+        Communication.raiseClosed(atFrameStart and received == 0)
+
+    def sendFrame(self, payload):
+        self.sendFrameParts([payload])
+
+    #
+    # Send one frame whose payload is the given parts, one after the other
+    #
+
+    def sendFrameParts(self, parts):
+        lengthBytes = struct.pack(Communication.intByteRep, sum(len(p) for p in parts))
+        self.writer.writelines([lengthBytes] + list(parts))
+
+    #
+    # Wait until the transport's buffer is back under its limit
+    #
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncStrategy(GoodStrategy):
+    """
+    GoodStrategy's FSM as a coroutine.
+
+    startServer() and pingPongServer() mirror GoodStrategy's, step for step;
+    each of their DB steps is one of GoodStrategy's on*()/check*() methods,
+    run in the DB executor.
+
+    stream is the connection's AsyncStream, or a channel of a gateway
+    connection (an AsyncGatewayChannel).
+    """
+
+    def __init__(self, stream, dbExecutor):
+        super().__init__(stream)
+
+        self.loop = asyncio.get_running_loop()
+        self.dbExecutor = dbExecutor
+
+        # An asyncio.Event in place of the threading.Event (see wake())
+        self.wakeEvent = asyncio.Event()
+
+    #
+    # Run func(*args) in the DB executor, and return what it returns
+    #
+
+    def inExecutor(self, func, *args):
+        return self.loop.run_in_executor(self.dbExecutor, func, *args)
+
+    #
+    # Send/receive a Command on this connection, using its negotiated codec.
+    #
+
+    async def sendCommand(self, command):
+        command.send(self.sock, self.codec, onFallback=self.codecFellBack)
+        await self.sock.drain()
+
+    def sendPayload(self, payload, urgent=False, onSent=None):
+        # On the loop's thread (e.g. from a signal handler), write it right away
+        try:
+            onLoop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            onLoop = False
+
+        if (onLoop):
+            self.writePayload(payload, onSent)
+        else:
+            self.loop.call_soon_threadsafe(self.writePayload, payload, onSent)
+
+    def writePayload(self, payload, onSent):
+        try:
+            self.sock.sendFrame(payload)
+        except Exception as e:
+            logger.debug(f"Failed to send a frame to vehicle {getattr(self, 'vName', None)}: {e}")
+            return
+
+        if (onSent is not None):
+            onSent()
+
+    async def recvCommand(self):
+        start = time.time()
+        try:
+            return Command.decode(await self.reader.recvFrame(), self.delta)
+        finally:
+            self.vehicleWait += time.time() - start
+
+    async def exchange(self, request, ackClass, urgent=False):
+        await self.sendCommand(request)
+        response = await self.recvCommand()
+
+        FSMUtil.expectClass(response, ackClass)
+        return response
+
+    def push(self, request):
+        raise Exception('Cannot push %s: the connection is not pipelined' % request.__class__.__name__)
+
+    async def waitTick(self, timeout):
+        if (timeout > 0):
+            timers = self.theServer.timers
+            timers.schedule(self, timeout)
+            await self.wakeEvent.wait()
+            timers.cancel(self)
+        self.wakeEvent.clear()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.wakeEvent.set)
+
+    async def startServer(self, theServer):
+        # Register the vehicle
+        try:
+            self.theServer = theServer
+
+            self.db = await self.inExecutor(SQLDB)
+            self.cadence = theServer.cadence
+            self.to_rider_time = None
+            self.to_dest_time = None
+
+            # Make initial handshake (init request and init acknowledge)
+            initRequest = await self.recvCommand()
+
+            # A gateway carries many vehicles over this one connection.
+            # Serve it here; each of its vehicles gets a session of its own.
+            if (isinstance(initRequest, GatewayHello)):
+                gateway = AsyncGatewayConnection(self.sock, initRequest)
+                await gateway.serve(lambda channel: serveSession(theServer, channel, self.dbExecutor))
+                return
+
+            # Carry on from the session of a dropped connection, or start afresh
+            resumed = self.resume(initRequest)
+            if (not resumed and not await self.inExecutor(self.register, initRequest)):
+                self.sock.close()
+                return
+        except Exception as e:
+            logger.exception('EXCEPTION: %s' % e)
+            self.sock.close()
+            return
+
+        # Now do the handshake then ping pong
+        try:
+            # The InitAck itself still goes out as JSON, since the vehicle
+            # only switches codecs once it has read it
+            initAck = self.makeInitAck(initRequest, canPipeline=False)
+            initAck.send(self.sock)
+            await self.sock.drain()
+            self.onInitAck(initRequest, initAck)
+
+            self.theServer.addSession(self.vName, self)
+
+            # Persist what the vehicle recorded while it was offline
+            for i in range(initRequest.backfill):
+                await self.recvTelemetryBatch()
+
+            if (not resumed):
+                # Assume that it's idle to being with
+                self.vState = State.IDLE
+
+                request = self.makeInitialChargerRequest(initRequest)
+                if (request is not None):
+                    # Should only ever receive a chargingAck back
+                    response = await self.exchange(request, IdleToEnrouteToChargerAck)
+                    self.vState = State.ENROUTE_TO_CHARGER
+
+            # Now do regular communication
+            await self.pingPongServer(initRequest)
+        except Exception as e:
+            logger.exception('EXCEPTION: %s' % e)
+        finally:
+            self.sock.close()
+            await self.inExecutor(self.endSession)
+
+    async def pingPongServer(self, response=None):
+        while (not self.superseded):
+            tickStart = time.time()
+            self.vehicleWait = 0.0
+
+            if (self.finalizeDue()):
+                await self.inExecutor(self.retryFinalize)
+
+            if (self.vState == State.IDLE):
+                self.ride = await self.inExecutor(self.checkRide)
+                if (self.ride is None):
+                    # Send the idle request, and handle its idleAck
+                    if (self.reportDue()):
+                        response = await self.exchange(IdleRequest(), IdleAck)
+                        await self.inExecutor(self.onIdleAck, response)
+
+                else:
+                    logger.info('Setting client to ENROUTE_TO_RIDER')
+                    logger.debug(f"Got a ride: {str(self.ride)}")
+
+                    response = await self.exchange(self.makeIdleToEnrouteToRiderRequest(), IdleToEnrouteToRiderAck)
+                    await self.inExecutor(self.onIdleToEnrouteToRiderAck, response)
+
+            elif (self.vState == State.ENROUTE_TO_RIDER):
+                response = await self.recvCommand()
+                await self.inExecutor(self.onEnrouteToRider, response)
+
+            elif (self.vState == State.TO_RIDER):
+                canceled, pickupConfirmed = await self.inExecutor(self.checkPickup)
+
+                if (canceled):
+                    response = await self.exchange(self.makeCancelRequest(ToRiderCancel), ToRiderCancelAck, urgent=True)
+                    await self.inExecutor(self.onCancelAck, response)
+
+                elif (not pickupConfirmed):
+                    if (self.reportDue()):
+                        await self.inExecutor(self.persistStatus, response, "TO_RIDER", "at the rider's location")
+
+                else:
+                    response = await self.exchange(self.makeToRiderToEnrouteToDestRequest(), ToRiderToEnrouteToDestAck)
+                    await self.inExecutor(self.onToRiderToEnrouteToDestAck, response)
+
+            elif (self.vState == State.ENROUTE_TO_DEST):
+                response = await self.recvCommand()
+                await self.inExecutor(self.onEnrouteToDest, response)
+
+            elif (self.vState == State.TO_DEST):
+                canceled, arrivalConfirmed = await self.inExecutor(self.checkArrival)
+
+                if (canceled):
+                    response = await self.exchange(self.makeCancelRequest(ToDestCancel), ToDestCancelAck, urgent=True)
+                    await self.inExecutor(self.onCancelAck, response)
+
+                elif (not arrivalConfirmed):
+                    if (self.reportDue()):
+                        await self.inExecutor(self.persistStatus, response, "TO_DEST", "at the destination")
+
+                else:
+                    response = await self.exchange(self.makeToDestToIdleRequest(), ToDestToIdleAck)
+                    await self.inExecutor(self.onToDestToIdleAck, response)
+
+            elif (self.vState == State.ENROUTE_TO_CHARGER):
+                logger.debug("Vehicle is enroute to charger")
+
+                response = await self.recvCommand()
+                await self.inExecutor(self.onEnrouteToCharger, response)
+
+            elif (self.vState == State.CHARGING and self.reportDue()):
+                logger.debug("Vehicle is charging")
+
+                response = await self.exchange(self.makeChargingRequest(ChargingToCharging, State.CHARGING), ChargingAck)
+
+                vehicleStateObj = response.toObj()
+
+                if (vehicleStateObj['batteryLife'] >= vehicleStateObj['targetBatteryLife']):
+                    response = await self.exchange(self.makeChargingRequest(ChargingToIdle, State.IDLE), ChargingToIdleAck)
+
+                    self.vState = State.IDLE
+                    logger.info('Vehicle has been charged and will enter idle.')
+
+            # Back off every vehicle's cadence if ticks take the server too long
+            self.cadence.observe(time.time() - tickStart - self.vehicleWait)
+
+            # Ride assignments and ride events wake the session before then
+            if (self.vState not in CommStrategy.vehiclePacedStates):
+                await self.waitTick(self.untilNextTick())
+
+    async def recvTelemetryBatch(self):
+        batch = await self.recvCommand()
+        FSMUtil.expectClass(batch, TelemetryBatch)
+
+        await self.sendCommand(await self.inExecutor(self.onTelemetryBatch, batch))
+
+
+#
+# Serve one vehicle connection (an AsyncStream, or a channel of a gateway connection),
+# or turn it away if theServer's session pool is full
+#
+
+async def serveSession(theServer, stream, dbExecutor):
+    session = AsyncStrategy(stream, dbExecutor)
+    if (not theServer.sessionPool.enter()):
+        theServer.refuseSession(session.sock)
+        return
+
+    try:
+        await session.startServer(theServer)
+    finally:
+        theServer.sessionPool.leave()
+
+
+#
+# Serve every vehicle connection of theServer (a VehicleServer) on the running loop,
+# on its already listening socket. Doesn't return.
+#
+# At most dbWorkers DB calls run at once; the sessions waiting on one
+# queue up in the executor (one call each, at most).
+#
+
+async def serve(theServer, dbWorkers):
+    dbExecutor = ThreadPoolExecutor(max_workers=dbWorkers, thread_name_prefix='vehicle-db')
+
+    async def handleClient(reader, writer):
+        await serveSession(theServer, AsyncStream(reader, writer), dbExecutor)
+
+    server = await asyncio.start_server(handleClient, sock=theServer.sock)
+    logger.info(f"Serving vehicles with asyncio ({dbWorkers} DB threads)")
+
+    async with server:
+        await server.serve_forever()
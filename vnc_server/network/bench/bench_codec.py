@@ -0,0 +1,74 @@
+#
+# Bytes per frame and encode/decode time of a telemetry ack, for each codec,
+# with and without delta-encoded acks.
+#
+import timeit
+
+# Hacky work-around to be able to import from a folder above this one.
+import sys
+import os
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from command import Command, Codec, DeltaState, EnrouteToRiderAck
+
+
+def makeAck():
+    return EnrouteToRiderAck({
+        'name':           'Vehicle K3T9Q',
+        'lat':            35.768664,
+        'lon':            -78.677591,
+        'heading':        271.5,
+        'steering':       -3.25,
+        'speed':          4.5,
+        'batteryLife':    87,
+        'minBatteryLife': 20,
+        'mileage':        1523.75
+    })
+
+
+def benchCodec(codec, n):
+    ack = makeAck()
+    payload = ack.encode(codec)
+
+    encodeTime = timeit.timeit(lambda: ack.encode(codec), number=n)
+    decodeTime = timeit.timeit(lambda: Command.decode(payload), number=n)
+
+    return len(payload), encodeTime / n, decodeTime / n
+
+
+#
+# Steady state of delta mode: only the position changed since the last ack.
+#
+
+def benchDelta(codec, n):
+    ack = makeAck()
+    sender = DeltaState(keyframeInterval=n + 2)
+    receiver = DeltaState()
+    Command.decode(ack.encodeDelta(codec, sender), receiver)
+
+    def move():
+        ack.lat += 0.00001
+        ack.lon += 0.00001
+
+    move()
+    payload = ack.encodeDelta(codec, sender)
+
+    encodeTime = timeit.timeit(lambda: (move(), ack.encodeDelta(codec, sender)), number=n)
+    decodeTime = timeit.timeit(lambda: Command.decode(payload, receiver), number=n)
+
+    return len(payload), encodeTime / n, decodeTime / n
+
+
+def main():
+    n = 100000
+    print('%-14s %12s %12s %12s' % ('codec', 'bytes/frame', 'encode (us)', 'decode (us)'))
+    for codec in Codec.supported:
+        size, encodeTime, decodeTime = benchCodec(codec, n)
+        print('%-14s %12d %12.2f %12.2f' % (codec, size, encodeTime * 1e6, decodeTime * 1e6))
+    for codec in Codec.supported:
+        size, encodeTime, decodeTime = benchDelta(codec, n)
+        print('%-14s %12d %12.2f %12.2f' % (codec + ' (delta)', size, encodeTime * 1e6, decodeTime * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#
+# Many simulated vehicles against one vehicle server, in each of its modes
+# (see VehicleServer.mode): how many it holds, how long the handshake takes,
+# how steadily it polls them, and what that costs it in threads and memory.
+#
+# Starts the server itself, so needs the MySQL database it uses,
+# allowing more connections than there are vehicles. Linux only.
+#
+import asyncio
+import resource
+import struct
+import subprocess
+import time
+
+# Hacky work-around to be able to import from a folder above this one.
+import sys
+import os
+
+networkDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(1, networkDir)
+from command import Command, InitRequest, InitAck, IdleRequest, IdleAck
+from communication import Communication
+
+host = '127.0.0.1'
+port = 12345
+
+modes = ('threaded', 'asyncio')
+fleetSizes = (100, 1000, 5000)
+
+# Seconds to measure for, once every vehicle is connected
+duration = 30.0
+
+# Vehicles connecting at once (more would overflow the server's listen queue)
+connectConcurrency = 100
+
+serverCode = 'import vehicle_server; vehicle_server.VehicleServer(mode=%r).run()'
+
+
+def vehicleState(name):
+    return {
+        'name':           name,
+        'lat':            35.768664,
+        'lon':            -78.677591,
+        'heading':        0.0,
+        'steering':       0.0,
+        'speed':          0.0,
+        'batteryLife':    87,
+        'minBatteryLife': 20,
+        'mileage':        0.0
+    }
+
+
+def sendFrame(writer, payload):
+    writer.writelines([struct.pack(Communication.intByteRep, len(payload)), payload])
+
+
+async def recvFrame(reader):
+    lengthBytes = await reader.readexactly(Communication.msgSizeLen)
+    return await reader.readexactly(struct.unpack(Communication.intByteRep, lengthBytes)[0])
+
+
+class SimulatedVehicle(object):
+    """
+    An idle vehicle: it registers, then answers every IdleRequest.
+    """
+
+    def __init__(self, name):
+        self.state = vehicleState(name)
+        self.idleAck = IdleAck(self.state).encode()
+
+        # Seconds from sending the InitRequest to reading the InitAck
+        self.handshake = None
+
+        # Seconds between two IdleRequests
+        self.pollGaps = []
+
+    async def connect(self, connectSlots):
+        async with connectSlots:
+            start = time.time()
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+            sendFrame(self.writer, InitRequest(self.state).encode())
+            ack = Command.decode(await recvFrame(self.reader))
+            if (not isinstance(ack, InitAck)):
+                raise Exception('Expected an InitAck, got %s' % ack.__class__.__name__)
+            self.handshake = time.time() - start
+
+    async def poll(self, stopAt):
+        lastPoll = None
+        try:
+            while True:
+                frame = await asyncio.wait_for(recvFrame(self.reader), stopAt - time.time())
+                if (isinstance(Command.decode(frame), IdleRequest)):
+                    now = time.time()
+                    if (lastPoll is not None):
+                        self.pollGaps.append(now - lastPoll)
+                    lastPoll = now
+
+                    sendFrame(self.writer, self.idleAck)
+                    await self.writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writer.close()
+
+
+def percentile(values, p):
+    if (len(values) == 0):
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+#
+# Threads and resident memory (in MB) of a running process
+#
+
+def processStats(pid):
+    stats = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            if (key in ('Threads', 'VmRSS')):
+                stats[key] = value.split()[0]
+    return int(stats['Threads']), int(stats['VmRSS']) / 1024.0
+
+
+async def waitForServer():
+    for i in range(100):
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise Exception('Server did not start listening on port %d' % port)
+
+
+async def benchFleet(server, nVehicles):
+    vehicles = [SimulatedVehicle('Bench %05d' % i) for i in range(nVehicles)]
+
+    connectSlots = asyncio.Semaphore(connectConcurrency)
+    results = await asyncio.gather(*[v.connect(connectSlots) for v in vehicles], return_exceptions=True)
+    connected = [v for v, r in zip(vehicles, results) if r is None]
+
+    stopAt = time.time() + duration
+    polling = asyncio.gather(*[v.poll(stopAt) for v in connected])
+
+    # Sample the server while every session is still up
+    await asyncio.sleep(duration / 2)
+    threads, rss = processStats(server.pid)
+    await polling
+
+    handshakes = [v.handshake for v in connected]
+    gaps = [g for v in connected for g in v.pollGaps]
+    return {
+        'connected': len(connected),
+        'handshake50': percentile(handshakes, 50) * 1e3,
+        'handshake99': percentile(handshakes, 99) * 1e3,
+        'pollRate': len(gaps) / duration,
+        'gap50': percentile(gaps, 50),
+        'gap99': percentile(gaps, 99),
+        'threads': threads,
+        'rss': rss
+    }
+
+
+def bench(mode, nVehicles):
+    server = subprocess.Popen([sys.executable, '-c', serverCode % mode], cwd=networkDir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        asyncio.run(waitForServer())
+        return asyncio.run(benchFleet(server, nVehicles))
+    finally:
+        server.kill()
+        server.wait()
+
+
+def main():
+    # Two sockets per vehicle (both ends), and the server inherits this limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    sizes = [int(a) for a in sys.argv[1:]] or fleetSizes
+
+    print('%-9s %9s %9s %14s %14s %9s %11s %11s %8s %9s' % (
+        'mode', 'vehicles', 'connected', 'handshake p50', 'handshake p99',
+        'polls/s', 'poll gap p50', 'poll gap p99', 'threads', 'RSS (MB)'))
+    for nVehicles in sizes:
+        for mode in modes:
+            r = bench(mode, nVehicles)
+            print('%-9s %9d %9d %12.1fms %12.1fms %9.0f %10.2fs %10.2fs %8d %9.1f' % (
+                mode, nVehicles, r['connected'], r['handshake50'], r['handshake99'],
+                r['pollRate'], r['gap50'], r['gap99'], r['threads'], r['rss']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#
+# Sharding vehicle connections over several worker processes.
+#
+# One Python process handles every vehicle, the API and matching under one GIL.
+# With VehicleServer(workers=N), the process the server runs in becomes the broker:
+# it forks N worker processes, which each listen on the vehicle port (with
+# SO_REUSEPORT, so the kernel spreads new connections over them) and hold the
+# sessions of the vehicles they accepted.
+#
+# The broker owns the ride queue and matching (its RideDispatcher). Each worker
+# talks to it over a pipe, with messages that are tuples:
+#   worker -> broker:
+#     ('idle', vName)         the vehicle is idle and waiting for a ride
+#     ('remove', vName)       the idle vehicle can't take rides anymore
+#     ('requeue', ride)       the ride was assigned, but its vehicle is gone
+#   broker -> worker:
+#     ('assign', vName, ride) the dispatcher matched the vehicle with the ride
+#     ('rideEvent', rideID, event)  see RideEvents
+#     ('broadcast', command)  send the command to every vehicle of the worker
+#
+# Needs fork() and SO_REUSEPORT (e.g. Linux).
+#
+
+import multiprocessing
+import threading
+
+from network.vehicle_util import RideEvents
+
+import logging
+import os
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(formatter)
+logging_path = os.path.dirname(os.path.realpath(__file__)).split("src/")[0] + "src/server_log"
+fh = logging.FileHandler(logging_path)
+fh.setLevel(logging.DEBUG)
+fh.setFormatter(formatter)
+logger.addHandler(ch)
+logger.addHandler(fh)
+logger.setLevel(logging.DEBUG)
+
+
+class WorkerChannel(object):
+    """
+    One end of the pipe between the broker and a worker.
+    Messages may be sent from any thread.
+    """
+
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.sendLock = threading.Lock()
+        self.process = None
+
+    def send(self, message):
+        with self.sendLock:
+            self.conn.send(message)
+
+    def recv(self):
+        return self.conn.recv()
+
+
+class WorkerVehicle(object):
+    """
+    Stands in, in the broker's RideDispatcher, for the session of an idle vehicle in a worker.
+    """
+
+    def __init__(self, broker, worker, vName):
+        self.broker = broker
+        self.worker = worker
+        self.vName = vName
+
+    def assign(self, ride):
+        self.broker.assigned(self, ride)
+
+
+class Broker(object):
+    """
+    The broker process's side of a sharded VehicleServer (see the top of this file).
+    """
+
+    # Message kinds
+    IDLE = 'idle'
+    REMOVE = 'remove'
+    REQUEUE = 'requeue'
+    ASSIGN = 'assign'
+    RIDE_EVENT = 'rideEvent'
+    BROADCAST = 'broadcast'
+
+    def __init__(self, theServer, nWorkers):
+        self.theServer = theServer
+        self.nWorkers = nWorkers
+        self.dispatcher = theServer.dispatcher
+
+        self.workers = []
+
+        # Map from vehicle name to the WorkerVehicle of its idle session
+        self.vehicles = {}
+
+        # Map from ride id to the worker holding the vehicle assigned to it
+        self.rideWorkers = {}
+
+        self.lock = threading.Lock()
+
+    #
+    # Fork every worker; each runs theServer.runWorker() with its end of the pipe
+    #
+
+    def start(self):
+        context = multiprocessing.get_context('fork')
+
+        for i in range(self.nWorkers):
+            conn, workerConn = context.Pipe()
+            worker = WorkerChannel(conn, 'worker %d' % i)
+
+            worker.process = context.Process(target=self.theServer.runWorker, args=(workerConn,),
+                                              name=worker.name, daemon=True)
+            worker.process.start()
+
+            # Only the worker keeps its end open, so the broker sees EOF when it dies
+            workerConn.close()
+
+            self.workers.append(worker)
+            threading.Thread(target=self.listen, args=(worker,), daemon=True).start()
+
+        logger.info(f"Broker started {self.nWorkers} workers")
+
+    #
+    # Wait until every worker has exited
+    #
+
+    def join(self):
+        for worker in self.workers:
+            worker.process.join()
+
+    def listen(self, worker):
+        try:
+            while True:
+                message = worker.recv()
+                kind = message[0]
+
+                if (kind == Broker.IDLE):
+                    vName = message[1]
+                    vehicle = WorkerVehicle(self, worker, vName)
+                    with self.lock:
+                        self.vehicles[vName] = vehicle
+                    self.dispatcher.vehicleIdle(vName, vehicle)
+
+                elif (kind == Broker.REMOVE):
+                    self.removeVehicle(worker, message[1])
+
+                elif (kind == Broker.REQUEUE):
+                    ride = message[1]
+                    with self.lock:
+                        self.rideWorkers.pop(str(ride.getRideID()), None)
+                    self.dispatcher.requeue(ride)
+
+                else:
+                    logger.error(f"Unknown message from {worker.name}: {message}")
+        except EOFError:
+            logger.error(f"{worker.name} exited")
+        except Exception as e:
+            logger.exception(f"EXCEPTION on the pipe of {worker.name}: {e}")
+
+        # Its idle vehicles are gone with it
+        with self.lock:
+            vNames = [v.vName for v in self.vehicles.values() if v.worker is worker]
+        for vName in vNames:
+            self.removeVehicle(worker, vName)
+
+    def removeVehicle(self, worker, vName):
+        with self.lock:
+            vehicle = self.vehicles.get(vName)
+            if (vehicle is None or vehicle.worker is not worker):
+                return
+            del self.vehicles[vName]
+
+        self.dispatcher.removeVehicle(vName, vehicle)
+
+    #
+    # The dispatcher matched an idle vehicle with a ride (on its matching thread, see RideDispatcher.match())
+    #
+
+    def assigned(self, vehicle, ride):
+        with self.lock:
+            if (self.vehicles.get(vehicle.vName) is vehicle):
+                del self.vehicles[vehicle.vName]
+            self.rideWorkers[str(ride.getRideID())] = vehicle.worker
+
+        try:
+            vehicle.worker.send((Broker.ASSIGN, vehicle.vName, ride))
+        except Exception as e:
+            logger.error(f"Failed to assign a ride to vehicle {vehicle.vName} on {vehicle.worker.name}: {e}")
+
+    #
+    # Tell the worker serving the ride what happened to it (see RideEvents)
+    #
+
+    def publish(self, rideID, event):
+        with self.lock:
+            worker = self.rideWorkers.get(str(rideID))
+
+            # Nothing more to tell about a ride after these
+            if (event in (RideEvents.ARRIVAL, RideEvents.CANCEL)):
+                self.rideWorkers.pop(str(rideID), None)
+
+        # A ride not assigned yet is checked for cancellation when it is
+        if (worker is not None):
+            worker.send((Broker.RIDE_EVENT, rideID, event))
+
+    def broadcast(self, command):
+        for worker in self.workers:
+            try:
+                worker.send((Broker.BROADCAST, command))
+            except Exception as e:
+                logger.error(f"Failed to broadcast {command.__class__.__name__} to {worker.name}: {e}")
+
+
+class RemoteDispatcher(object):
+    """
+    A worker's stand-in for the broker's RideDispatcher.
+
+    Sessions use it just like a RideDispatcher: it forwards idle vehicles to the broker,
+    and calls assign() on their sessions as the broker matches them.
+    """
+
+    def __init__(self, theServer, conn):
+        self.theServer = theServer
+        self.broker = WorkerChannel(conn, 'broker')
+
+        # Map from vehicle name to its idle session
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def vehicleIdle(self, vName, session):
+        with self.lock:
+            self.idle[vName] = session
+        self.broker.send((Broker.IDLE, vName))
+
+    def removeVehicle(self, vName, session):
+        with self.lock:
+            # A reconnected vehicle may already have a newer session
+            if (self.idle.get(vName) is not session):
+                return
+            del self.idle[vName]
+        self.broker.send((Broker.REMOVE, vName))
+
+    def requeue(self, ride):
+        self.broker.send((Broker.REQUEUE, ride))
+
+    def listen(self):
+        try:
+            while True:
+                message = self.broker.recv()
+                kind = message[0]
+
+                if (kind == Broker.ASSIGN):
+                    vName, ride = message[1:]
+                    with self.lock:
+                        session = self.idle.pop(vName, None)
+
+                    # It left since it said it was idle
+                    if (session is None):
+                        self.requeue(ride)
+                    else:
+                        session.assign(ride)
+
+                elif (kind == Broker.RIDE_EVENT):
+                    self.theServer.rideEvents.publish(message[1], message[2])
+
+                elif (kind == Broker.BROADCAST):
+                    self.theServer.broadcast(message[1])
+
+                else:
+                    logger.error(f"Unknown message from the broker: {message}")
+        except EOFError:
+            logger.error('The broker exited; stopping this worker')
+        except Exception as e:
+            logger.exception(f"EXCEPTION on the pipe to the broker: {e}")
+
+        # Without the broker, no vehicle here would ever get a ride again
+        os._exit(1)
@@ -6,9 +6,15 @@ from abc import ABC, abstractmethod
 import random
 import time
 import json
+import socket
+import threading
+from collections import deque
 from pprint import pprint
 
 from command import *
+from communication import Communication, FrameReader
+from gateway import GatewayConnection
+from pipeline import Pipeline
 from network.vehicle_util import *
 from vehicle import Vehicle
 
@@ -46,9 +52,236 @@ class CommStrategy(ABC):
     Client should call startClient().
     """
 
+    # How long to wait for the ack of a request before giving up on the vehicle
+    ackTimeout = 30.0
+
+    # How many IdleRequests a pipelined connection may have in flight
+    maxIdlePolls = 4
+
+    # How many times a finished ride is tried to be moved to the history (see moveRideToHistory()),
+    # and the seconds before the first retry (doubled for each one after), on a later tick
+    finalizeAttempts = 3
+    finalizeRetryDelay = 0.5
+
+    # States in which the vehicle reports on its own, so a tick waits on it
+    # (in recvCommand()) instead of sleeping
+    vehiclePacedStates = (State.ENROUTE_TO_RIDER, State.ENROUTE_TO_DEST, State.ENROUTE_TO_CHARGER)
+
     def __init__(self, sock):
         self.sock = sock
 
+        # Anything with its own recvFrame() (e.g. a channel of a gateway connection)
+        # hands out its own frames
+        if (hasattr(sock, 'recvFrame')):
+            self.reader = sock
+        else:
+            self.reader = FrameReader(sock)
+
+        # Every connection speaks JSON until the handshake picks a codec,
+        # and whether a command since had to go as JSON anyway (see codecFellBack())
+        self.codec = Codec.JSON
+        self.codecFallbackLogged = False
+
+        # Last full state of the vehicle, if it sends delta-encoded acks
+        self.delta = None
+
+        # Set once the handshake agrees on a pipelined connection (see pipeline.py)
+        self.pipeline = None
+
+        # Set to cut the wait between two ticks short (see wake())
+        self.wakeEvent = threading.Event()
+
+        # Frames may also be sent from other threads (see sendPayload())
+        self.sendLock = threading.Lock()
+
+        # Seconds of the current tick spent waiting on the vehicle
+        self.vehicleWait = 0.0
+
+        # Token of this session's UDP position reports, if it sends any (see telemetry.py)
+        self.telemetryToken = None
+
+        # Token the vehicle may resume this session with, if its connection drops (see resumption.py),
+        # and whether a session of a new connection took over this one's vehicle
+        self.resumeToken = None
+        self.superseded = False
+
+        # When the vehicle should next report, and the state that was for (see reportDue())
+        self.nextReport = 0.0
+        self.reportState = None
+
+        # When the FSM should next read the DB for what happened to its ride (see rideCheckDue())
+        self.nextRideCheck = 0.0
+
+        # Finished rides that failed to move to the history, each as [ride, attempts so far, when to retry]
+        # (see moveRideToHistory())
+        self.unfinalized = []
+
+        # A ride the dispatcher matched the vehicle with, not taken yet (see assign()),
+        # and whether the vehicle is in the dispatcher's idle set
+        self.assignment = None
+        self.awaitingRide = False
+
+    #
+    # Send/receive a Command on this connection, using its negotiated codec.
+    #
+
+    def sendCommand(self, command):
+        if (self.pipeline is not None):
+            self.pipeline.send(command)
+        else:
+            with self.sendLock:
+                command.send(self.sock, self.codec, onFallback=self.codecFellBack)
+
+    #
+    # A command didn't fit the negotiated codec, so it was sent as JSON (see command.py).
+    # Logged once per session: a vehicle whose values don't fit tends to stay that way.
+    #
+
+    def codecFellBack(self, command):
+        if (self.codecFallbackLogged):
+            return
+        self.codecFallbackLogged = True
+        logger.warning(f"Sent {command.__class__.__name__} to vehicle {self.vName} as JSON, "
+                       f"since it doesn't fit the {self.codec} codec: {command}")
+
+    #
+    # Send an already encoded frame (in this connection's codec) that isn't answered,
+    # from any thread. Used for broadcasts, which are encoded once for every vehicle.
+    # onSent, if not None, is called once the frame is sent.
+    #
+
+    def sendPayload(self, payload, urgent=False, onSent=None):
+        if (self.pipeline is not None):
+            self.pipeline.enqueue(payload, urgent, onSent)
+            return
+
+        with self.sendLock:
+            Communication.sendFrame(self.sock, payload)
+        if (onSent is not None):
+            onSent()
+
+    def recvCommand(self):
+        start = time.time()
+        try:
+            if (self.pipeline is not None):
+                # Skip the wake ups; only callers of waitTick() care about those
+                while True:
+                    command = self.pipeline.recv()
+                    if (command is not None):
+                        return command
+            return Command.recv(self.reader, self.delta)
+        finally:
+            self.vehicleWait += time.time() - start
+
+    #
+    # Send a request and return the vehicle's ack, which must be an ackClass.
+    #
+    # On a pipelined connection the request is matched with its ack by seq,
+    # and an urgent one is sent ahead of anything else queued.
+    #
+
+    def exchange(self, request, ackClass, urgent=False):
+        if (self.pipeline is not None):
+            start = time.time()
+            response = self.pipeline.request(request, urgent).result(CommStrategy.ackTimeout)
+            self.vehicleWait += time.time() - start
+        else:
+            self.sendCommand(request)
+            response = self.recvCommand()
+
+        FSMUtil.expectClass(response, ackClass)
+        return response
+
+    #
+    # Push a request to the vehicle right away, from any thread,
+    # and return the Future of its ack.
+    # Only pipelined connections can do this.
+    #
+
+    def push(self, request):
+        if (self.pipeline is None):
+            raise Exception('Cannot push %s: the connection is not pipelined' % request.__class__.__name__)
+
+        return self.pipeline.request(request, urgent=True)
+
+    #
+    # Wait until the next tick, timeout seconds from now, or until someone calls wake().
+    # The server's TimerWheel keeps the deadline, so no thread sleeps on a timer of its own.
+    #
+
+    def waitTick(self, timeout):
+        if (timeout > 0):
+            timers = self.theServer.timers
+            timers.schedule(self, timeout)
+            self.wakeEvent.wait()
+            timers.cancel(self)
+        self.wakeEvent.clear()
+
+    #
+    # Seconds until the session has something to do again, unless woken:
+    # the vehicle's next report, or the next time the DB is read for what happened to its ride
+    #
+
+    def untilNextTick(self):
+        # A new state reports right away
+        if (self.vState != self.reportState):
+            return 0.0
+
+        nextTick = self.nextReport
+        if (self.vState in (State.TO_RIDER, State.TO_DEST)):
+            nextTick = min(nextTick, self.nextRideCheck)
+        for ride, attempts, retryAt in self.unfinalized:
+            nextTick = min(nextTick, retryAt)
+        return max(0.0, nextTick - time.time())
+
+    #
+    # Whether the vehicle is due to report in its current state.
+    # If so, the next report is scheduled (a new state is always due right away).
+    #
+
+    def reportDue(self):
+        now = time.time()
+        if (self.vState == self.reportState and now < self.nextReport):
+            return False
+
+        self.reportState = self.vState
+        self.nextReport = now + self.cadence.interval(self.vState)
+        return True
+
+    #
+    # Make the session act now (e.g. a ride it serves was just canceled)
+    # instead of at its next tick. Safe to call from any thread.
+    #
+
+    def wake(self):
+        self.wakeEvent.set()
+
+    #
+    # Give the vehicle a ride (see dispatcher.py). Safe to call from any thread.
+    # The session takes it on its next tick, which this starts right away.
+    #
+
+    def assign(self, ride):
+        # Set before awaitingRide is cleared, so the session never sees neither
+        self.assignment = ride
+        self.awaitingRide = False
+        self.wake()
+
+    #
+    # A session of a new connection took over this one's vehicle (see resumption.py).
+    # Shut the old connection, so the FSM stops wherever it waits.
+    #
+
+    def supersede(self):
+        self.wake()
+        try:
+            if (hasattr(self.sock, 'shutdown')):
+                self.sock.shutdown(socket.SHUT_RDWR)
+            else:
+                self.sock.close()
+        except Exception as e:
+            logger.debug(f"Failed to shut the superseded connection of vehicle {self.vName}: {e}")
+
     @abstractmethod
     def startServer(self, theServer):
         pass
@@ -57,6 +290,10 @@ class CommStrategy(ABC):
 class GoodStrategy(CommStrategy):
     """
     Actually handle the client in a nice way lol
+
+    The FSM (pingPongServer()) only decides what to send and when;
+    everything it persists is done by the on*() and check*() methods,
+    which AsyncStrategy shares.
     """
 
     def startServer(self, theServer):
@@ -68,19 +305,25 @@ class GoodStrategy(CommStrategy):
             # print('%d rides' % len(list(self.theServer.rides)))
 
             self.db = SQLDB()
+            self.cadence = theServer.cadence
             self.to_rider_time = None
             self.to_dest_time = None
 
             # Make initial handshake (init request and init acknowledge)
-            initRequest = Command.recv(self.sock)
-            registered = VehicleDBUtil.registerVehicle(self.db, initRequest)
-            if (registered == False):
-                logger.error('Failed to register vehicle. Terminating this connection.')
-                self.sock.close()
+            initRequest = self.recvCommand()
+
+            # A gateway carries many vehicles over this one connection.
+            # Serve it here; each of its vehicles gets a session of its own.
+            if (isinstance(initRequest, GatewayHello)):
+                gateway = GatewayConnection(self.sock, self.reader, initRequest)
+                gateway.serve(self.theServer.startSession)
                 return
 
-            # Save the vehicle name for later (for disabling)
-            self.vName = initRequest.name
+            # Carry on from the session of a dropped connection, or start afresh
+            resumed = self.resume(initRequest)
+            if (not resumed and not self.register(initRequest)):
+                self.sock.close()
+                return
         except Exception as e:
             logger.exception('EXCEPTION: %s' % e)
             self.sock.close()
@@ -88,168 +331,86 @@ class GoodStrategy(CommStrategy):
 
         # Now do the handshake then ping pong
         try:
-            initAck = InitAck({})
+            # The InitAck itself still goes out as JSON, since the vehicle
+            # only switches codecs once it has read it
+            initAck = self.makeInitAck(initRequest, canPipeline=True)
             initAck.send(self.sock)
+            self.onInitAck(initRequest, initAck)
 
-            # Assume that it's idle to being with
-            self.vState = State.IDLE
+            # From now on, frames go through the pipeline's own reader and writer
+            if (initAck.pipelined):
+                self.pipeline = Pipeline(self.sock, self.reader, self.codec, self.delta, self.codecFellBack)
+                self.pipeline.start()
 
-            logger.debug(f"InitRequest sent")
-            # Check vehicle response before retrieving a ride
-            logger.debug(f"Vehicle response recieved")
+            # IdleRequests sent but not answered yet, oldest first
+            self.idlePolls = deque()
 
-            response = initRequest.toObj()
-            logger.debug(f"battery life upon init: {str(response['batteryLife'])} ")
-            if (response['batteryLife'] <= response['minBatteryLife']):
-                lat, lon = response['lat'], response['lon']
-                logger.debug(f"Node lat: {str(lat)}, Node lon:{str(lon)} ")
-                #TODO: should be something like vehicle_util.getChargerLocation
-                args = {
-                    'lat': lat,
-                    'lon': lon
-                }
-                request = IdleToEnrouteToCharger(args)
-                request.send(self.sock)
+            self.theServer.addSession(self.vName, self)
 
-                # Should only ever receive a chargingAck back
-                response = Command.recv(self.sock)
-                FSMUtil.expectClass(response, IdleToEnrouteToChargerAck)
-                self.vState = State.ENROUTE_TO_CHARGER
+            # Persist what the vehicle recorded while it was offline
+            for i in range(initRequest.backfill):
+                self.recvTelemetryBatch()
 
+            if (not resumed):
+                # Assume that it's idle to being with
+                self.vState = State.IDLE
+
+                request = self.makeInitialChargerRequest(initRequest)
+                if (request is not None):
+                    # Should only ever receive a chargingAck back
+                    response = self.exchange(request, IdleToEnrouteToChargerAck)
+                    self.vState = State.ENROUTE_TO_CHARGER
 
             # Now do regular communication
-            self.pingPongServer()
+            self.pingPongServer(initRequest)
         except Exception as e:
             logger.exception('EXCEPTION: %s' % e)
         finally:
+            if (self.pipeline is not None):
+                self.pipeline.close()
             self.sock.close()
-            VehicleDBUtil.disableVehicle(self.db, self.vName)
+            self.endSession()
+
+    #
+    # response is the vehicle's last reported state, until it reports again
+    # (a resumed session may persist it before then)
+    #
+
+    def pingPongServer(self, response=None):
+        while (not self.superseded):
+            tickStart = time.time()
+            self.vehicleWait = 0.0
+
+            if (self.finalizeDue()):
+                self.retryFinalize()
 
-    def pingPongServer(self):
-        while True:
             if (self.vState == State.IDLE):
                 #
                 # IDLE
                 #
                 #print('Client is idle')
-                self.ride = self.theServer.getRide(self.vName)
-                if (self.ride is None or RideDBUtil.checkCanceled(self.db, self.ride.rideID)):
-                    # Send the idle request
-                    idleRequest = IdleRequest()
-                    idleRequest.send(self.sock)
-
-                    # Should only ever receive a idleAck back
-                    response = Command.recv(self.sock)
-                    FSMUtil.expectClass(response, IdleAck)
-
-                    vehicleStateObj = response.toObj()
-                    obj = {
-                        "lat": vehicleStateObj["lat"],
-                        "lon": vehicleStateObj["lon"],
-                        "batteryLife": vehicleStateObj["batteryLife"],
-                        "mileage": vehicleStateObj["mileage"],
-                        # "curEdge" ?
-                    }
-                    r = self.db.update('Vehicles', obj, {"name": vehicleStateObj["name"]})
-                    if not r.success:
-                        logger.error(f"Failed to update vehicle state: {r.message}")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                    # TODO double check that there are no issues in the DB when the ride is canceled
-                    vehicleStateObj = response.toObj()
-
-                    r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "WAITING", time.time(), vehicleStateObj["lat"],
-                                                   vehicleStateObj["lon"], vehicleStateObj["batteryLife"], None)
-                    if not r:
-                        logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is idle.")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
+                self.ride = self.checkRide()
+                if (self.ride is None):
+                    # Send the idle request, and handle its idleAck
+                    if (self.reportDue()):
+                        self.pollIdle()
 
                 else:
                     logger.info('Setting client to ENROUTE_TO_RIDER')
                     logger.debug(f"Got a ride: {str(self.ride)}")
 
-                    # Get the latitude and longtitude of the Rider from the Ride we got
-                    lat, lon = self.ride.getRiderLocation()
-
-                    # Create our IdleToEnrouteToRiderRequest arguments from the rider lat and lon
-                    args = {
-                        'lat': lat,
-                        'lon': lon
-                    }
-
-                    # Create our IdleToEnrouteToRiderRequest command and send it to the Vehicle.
-                    idleToRiderRequest = IdleToEnrouteToRiderRequest(args)
-                    idleToRiderRequest.send(self.sock)
-
-                    # Wait for the message we receive back from the Vehicle. This should be an instance of
-                    # IdleToEnrouteToRiderAck and should contain the internal state of the Vehicle. Update
-                    # our database of Vehicles to reflect the current Vehicle state
-                    response = Command.recv(self.sock)
-                    FSMUtil.expectClass(response, IdleToEnrouteToRiderAck)
-
-
-                    # Persist this state to DB
-                    vehicleStateObj = response.toObj()
-
-                    r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "ENROUTE_TO_RIDER", time.time(), vehicleStateObj["lat"],
-                                                   vehicleStateObj["lon"], vehicleStateObj["batteryLife"], self.ride.getRideID())
-                    if not r:
-                        logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is enroute to rider.")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                    # Update the ride with the assigned vehicle name
-                    logger.debug(f"Assigning a vehicle {str(response)} name to a ride {str(self.ride)}")
-                    r = self.db.update('Rides', {"vehicleName": vehicleStateObj["name"], "status": "ENROUTE_TO_RIDER"},
-                                       {"userEmail": self.ride.getRiderEmail()})
-                    if not r.success:
-                        logger.error(f"Failed to assign a vehicle name to the ride: {r.message}")
-                        logger.debug(f"The target ride: {str(self.ride)}")
-                        logger.debug(f"The target vehicle: {str(vehicleStateObj)}")
-
-                    # And set our current state to ENROUTE_TO_RIDER
-                    self.vState = State.ENROUTE_TO_RIDER
-                    logger.info('Client is enroute to rider')
-                self.batteryLife = response.toObj()['batteryLife']
-            elif (self.vState == State.ENROUTE_TO_RIDER):
-                # Get the latest message from the Vehicle.
-                response = Command.recv(self.sock)
-                if(response.__class__ == EnrouteToRiderAck):
-                    # If the command received is an instance of EnrouteToRiderAck we remain in the current state.
-                    # Still need to update the Vehicle database with the current state of this Vehicle
-
-                    self.vState = State.ENROUTE_TO_RIDER
-
-                    # Persist this state to DB
-                    vehicleStateObj = response.toObj()
+                    # Idle acks still in flight are older than this transition
+                    self.drainIdlePolls()
 
-                    r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "ENROUTE_TO_RIDER", time.time(), vehicleStateObj["lat"],
-                                                   vehicleStateObj["lon"], vehicleStateObj["batteryLife"])
-                    if not r:
-                        logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is enroute to rider.")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
+                    # Send the Vehicle to the Rider, then wait for the message we receive back from it.
+                    # This should be an instance of IdleToEnrouteToRiderAck and should contain the internal state of the Vehicle.
+                    response = self.exchange(self.makeIdleToEnrouteToRiderRequest(), IdleToEnrouteToRiderAck)
+                    self.onIdleToEnrouteToRiderAck(response)
 
-                elif (response.__class__ == EnrouteToRiderToToRiderAck):
-                    # If the command received is an instance of EnrouteToRiderToToRiderAck we update the state to TO_RIDER
-                    # Also need to update the Vehicle information in the database
-
-                    # Persist this state to DB
-                    vehicleStateObj = response.toObj()
-
-                    r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "TO_RIDER", time.time(), vehicleStateObj["lat"],
-                                                   vehicleStateObj["lon"], vehicleStateObj["batteryLife"])
-                    if not r:
-                        logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is at the rider's location.")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                    # Update the ride status
-                    r = self.db.update('Rides', {"status": "TO_RIDER"}, {"userEmail": self.ride.getRiderEmail()})
-                    if not r.success:
-                        logger.error(f"Failed to update ride status: {r.message}")
-                        logger.debug(f"The target ride: {str(self.ride)}")
-                        logger.debug(f"The target vehicle: {str(vehicleStateObj)}")
-
-                    self.vState = State.TO_RIDER
-                    logger.info('Client is at the rider\'s location')
+            elif (self.vState == State.ENROUTE_TO_RIDER):
+                # Get the latest message from the Vehicle.
+                response = self.recvCommand()
+                self.onEnrouteToRider(response)
 
             elif (self.vState == State.TO_RIDER):
                 #
@@ -258,167 +419,29 @@ class GoodStrategy(CommStrategy):
                 # print('Client is to rider')
 
                 # Check database for confirmation of pickup and cancellation
-                canceled = RideDBUtil.checkCanceled(self.db, self.ride.rideID)
-                pickupConfirmed = RideDBUtil.checkPickupConfirmation(self.db, self.ride.rideID)
+                canceled, pickupConfirmed = self.checkPickup()
 
                 if (canceled):
-                    lat, lon = self.ride.getRiderLocation()
-                    args = {
-                        'lat': lat,
-                        'lon': lon
-                    }
-
-                    request = ToRiderCancel(args)
-                    request.send(self.sock)
-
                     # Should only ever receive a ToRiderCancelAck back
-                    response = Command.recv(self.sock)
-                    FSMUtil.expectClass(response, ToRiderCancelAck)
-
-                    vehicleStateObj = response.toObj()
-                    r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "WAITING", time.time(), vehicleStateObj["lat"],
-                                                   vehicleStateObj["lon"], vehicleStateObj["batteryLife"], None)
-                    if not r:
-                        logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is at the rider's location.")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                    ride = RideDBUtil.getRide(self.db, self.ride.getRideID())
-                    riderEmail = ride["userEmail"]
-
-                    obj = {
-                        "curRideID": None
-                    }
-                    r = self.db.update('Users', obj, {"email": riderEmail})
-                    if not r.success:
-                        logger.error(f"Failed to set the ride id to NULL when ride is finished to user {riderEmail}: {r.message}")
-
-                    r = self.db.delete('Rides', ['id'], {"id": self.ride.getRideID()})
-                    if not r.success: # TODO Add alternative
-                        logger.error(f"Failed to remove the ride from Rides table to move it to history: {r.message}")
-                        logger.debug(f"The target ride: {str(self.ride)}")
-
-                    tEnd = time.time()
-                    obj = {
-                        "userEmail": riderEmail,
-                        "vehicleName": ride["vehicleName"],
-                        "tStart": ride["tStart"],
-                        "tEnd": int(tEnd),
-                        "startNode": ride["startNode"],
-                        "endNode": ride["endNode"]
-                    }
-
-                    r = self.db.create('RideHistory', list(obj.keys()), obj)
-                    if not r.success: # TODO Add alternative
-                        logger.error(f"Failed to add the ride from to history: {r.message}")
-                        logger.debug(f"The target ride: {str(self.ride)}")
-                        logger.debug(f"The target sql obj: {str(obj)}")
-
-                    self.vState = State.IDLE
-                    logger.info('Client has be canceled and will remain at current location.')
+                    response = self.exchange(self.makeCancelRequest(ToRiderCancel), ToRiderCancelAck, urgent=True)
+                    self.onCancelAck(response)
 
                 elif (not pickupConfirmed):
                     # Rider has not yet confirmed pickup, stay in TO_RIDER state
-                    self.vState = State.TO_RIDER
-
-                    # Mark the time that this state was entered
-                    """ if (not self.to_rider_time):
-                        self.to_rider_time = time.time()
-                        logger.debug(f"Set to_ride_time: {str(self.to_rider_time)}")
-                    if (time.time() - self.to_rider_time > RideDBUtil.WAIT_TIME):
-                        logger.debug(f"Progressing to next state as {str(RideDBUtil.WAIT_TIME)} seconds have passed.")
-                        pickupConfirmed = True
-                    logger.debug(f"Time elapsed: {str(time.time() - self.to_rider_time)}.") """
-
-                    # Persist this state to DB
-                    vehicleStateObj = response.toObj()
-
-                    r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "TO_RIDER", time.time(), vehicleStateObj["lat"],
-                                                   vehicleStateObj["lon"], vehicleStateObj["batteryLife"])
-                    if not r:
-                        logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is at the rider's location.")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                if (pickupConfirmed):
-                    # Rider has confirmed pickup, transition to ENROUTE_TO_DEST
-                    # If the Vehicle is at the Client we need to send it the lat/lon position of the destination
-                    lat = self.ride.destLat
-                    lon = self.ride.destLon
-
-                    # Construct the arguments for our Command from the destination lat/lon
-                    args = {
-                        'lat': lat,
-                        'lon': lon
-                    }
-
-                    # Create and send our ToRiderToEnrouteToDestRequest to the Vehicle
-                    request = ToRiderToEnrouteToDestRequest(args)
-                    request.send(self.sock)
+                    # and persist this state to DB, at this state's report rate
+                    if (self.reportDue()):
+                        self.persistStatus(response, "TO_RIDER", "at the rider's location")
 
+                else:
+                    # Rider has confirmed pickup, transition to ENROUTE_TO_DEST
                     # Should only ever receive a ToRiderToEnrouteToDestAck back
-                    response = Command.recv(self.sock)
-                    FSMUtil.expectClass(response, ToRiderToEnrouteToDestAck)
-
-                    # Persist this state to DB
-                    vehicleStateObj = response.toObj()
-
-                    r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "ENROUTE_TO_DEST", time.time(), vehicleStateObj["lat"],
-                                                   vehicleStateObj["lon"], vehicleStateObj["batteryLife"])
-                    if not r:
-                        logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is enroute to destination.")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                    # Update the ride status
-                    r = self.db.update('Rides', {"status": "ENROUTE_TO_DEST"}, {"userEmail": self.ride.getRiderEmail()})
-                    if not r.success:
-                        logger.error(f"Failed to update ride status: {r.message}")
-                        logger.debug(f"The target ride: {str(self.ride)}")
-                        logger.debug(f"The target vehicle: {str(vehicleStateObj)}")
-
-                    # Finally, update our state to ENROUTE_TO_DEST
-                    self.vState = State.ENROUTE_TO_DEST
-                    logger.info('Client is enroute to destination location with the rider')
-            elif (self.vState == State.ENROUTE_TO_DEST):
+                    response = self.exchange(self.makeToRiderToEnrouteToDestRequest(), ToRiderToEnrouteToDestAck)
+                    self.onToRiderToEnrouteToDestAck(response)
 
+            elif (self.vState == State.ENROUTE_TO_DEST):
                 # Receive a Command from the Vehicle
-                response = Command.recv(self.sock)
-
-                if (response.__class__ == EnrouteToDestAck):
-                    # If the Command is an instance of EnrouteToDestAck stay in the ENROUTE_TO_DEST state
-
-                    # Persist this state to DB
-                    vehicleStateObj = response.toObj()
-
-                    r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "ENROUTE_TO_DEST", time.time(), vehicleStateObj["lat"],
-                                                   vehicleStateObj["lon"], vehicleStateObj["batteryLife"])
-                    if not r:
-                        logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is enroute to destination.")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                    # Maintain our current state
-                    self.vState = State.ENROUTE_TO_DEST
-
-                elif (response.__class__ == EnrouteToDestToToDestAck):
-                    # If the Command is an instance of EnrouteToDestToToDestAck then the Vehicle is at the destination
-
-                    # Persist this state to DB
-                    vehicleStateObj = response.toObj()
-
-                    r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "TO_DEST", time.time(), vehicleStateObj["lat"],
-                                                   vehicleStateObj["lon"], vehicleStateObj["batteryLife"])
-                    if not r:
-                        logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is at the destination.")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                    # Update the ride status
-                    r = self.db.update('Rides', {"status": "TO_DEST"}, {"userEmail": self.ride.getRiderEmail()})
-                    if not r.success:
-                        logger.error(f"Failed to update ride status: {r.message}")
-                        logger.debug(f"The target ride: {str(self.ride)}")
-                        logger.debug(f"The target vehicle: {str(vehicleStateObj)}")
-
-                    # And update our state to TO_DEST
-                    self.vState = State.TO_DEST
-                    logger.info('Waiting on client confirmation of arrival')
+                response = self.recvCommand()
+                self.onEnrouteToDest(response)
 
             elif (self.vState == State.TO_DEST):
                 #
@@ -427,157 +450,24 @@ class GoodStrategy(CommStrategy):
                 # print('Client is to dest')
 
                 # Check database for confirmation of arrival and cancellation
-                arrivalConfirmed = RideDBUtil.checkArrivalConfirmation(self.db, self.ride.rideID)
-                canceled = RideDBUtil.checkCanceled(self.db, self.ride.rideID)
+                canceled, arrivalConfirmed = self.checkArrival()
 
                 if (canceled):
-                    lat, lon = self.ride.getRiderLocation()
-                    args = {
-                        'lat': lat,
-                        'lon': lon
-                    }
-
-                    request = ToDestCancel(args)
-                    request.send(self.sock)
-
-                    # Should only ever receive a ToRiderCancelAck back
-                    response = Command.recv(self.sock)
-                    FSMUtil.expectClass(response, ToDestCancelAck)
-
-                    vehicleStateObj = response.toObj()
-                    r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "WAITING", time.time(), vehicleStateObj["lat"],
-                                                   vehicleStateObj["lon"], vehicleStateObj["batteryLife"], None)
-                    if not r:
-                        logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is at the rider's location.")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                    ride = RideDBUtil.getRide(self.db, self.ride.getRideID())
-                    riderEmail = ride["userEmail"]
-
-                    obj = {
-                        "curRideID": None
-                    }
-                    r = self.db.update('Users', obj, {"email": riderEmail})
-                    if not r.success:
-                        logger.error(f"Failed to set the ride id to NULL when ride is finished to user {riderEmail}: {r.message}")
-
-                    r = self.db.delete('Rides', ['id'], {"id": self.ride.getRideID()})
-                    if not r.success: # TODO Add alternative
-                        logger.error(f"Failed to remove the ride from Rides table to move it to history: {r.message}")
-                        logger.debug(f"The target ride: {str(self.ride)}")
-
-                    tEnd = time.time()
-                    obj = {
-                        "userEmail": riderEmail,
-                        "vehicleName": ride["vehicleName"],
-                        "tStart": ride["tStart"],
-                        "tEnd": int(tEnd),
-                        "startNode": ride["startNode"],
-                        "endNode": ride["endNode"]
-                    }
-
-                    r = self.db.create('RideHistory', list(obj.keys()), obj)
-                    if not r.success: # TODO Add alternative
-                        logger.error(f"Failed to add the ride from to history: {r.message}")
-                        logger.debug(f"The target ride: {str(self.ride)}")
-                        logger.debug(f"The target sql obj: {str(obj)}")
-
-                    self.vState = State.IDLE
-                    logger.info('Client has be canceled and will remain at current location.')
+                    # Should only ever receive a ToDestCancelAck back
+                    response = self.exchange(self.makeCancelRequest(ToDestCancel), ToDestCancelAck, urgent=True)
+                    self.onCancelAck(response)
 
                 elif (not arrivalConfirmed):
                     # Rider has not yet confirmed arrival, stay in TO_DEST state
-                    self.vState = State.TO_DEST
-
-                     # Mark the time that this state was entered
-                    """ if (not self.to_dest_time):
-                        self.to_dest_time = time.time()
-                        logger.debug(f"Set to_dest_time: {str(self.to_dest_time)}")
-                    if (time.time() - self.to_dest_time > RideDBUtil.WAIT_TIME):
-                        logger.debug(f"Progressing to next state as {str(RideDBUtil.WAIT_TIME)} seconds have passed.")
-                        arrivalConfirmed = True
-                    logger.debug(f"Time elapsed: {str(time.time() - self.to_dest_time)}.") """
-
-                    # Persist this state to DB
-                    vehicleStateObj = response.toObj()
-
-                    r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "TO_DEST", time.time(), vehicleStateObj["lat"],
-                                                   vehicleStateObj["lon"], vehicleStateObj["batteryLife"])
-                    if not r:
-                        logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is at the destination.")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                if (arrivalConfirmed):
-                    # Rider has confirmed arrival, transition to IDLE
-                    # Send the lat/lon position of the destination
-                    logger.info("Rider confirmed the arrival.")
-
-                    lat = self.ride.riderLat
-                    lon = self.ride.riderLon
-
-                    # Construct the arguments for our Command from the destination lat/lon
-                    args = {
-                        'lat': lat,
-                        'lon': lon
-                    }
-
-                    # Create and send our ToDestToIdle Request to the Vehicle
-                    request = ToDestToIdle(args)
-                    request.send(self.sock)
+                    # and persist this state to DB, at this state's report rate
+                    if (self.reportDue()):
+                        self.persistStatus(response, "TO_DEST", "at the destination")
 
+                else:
+                    # Rider has confirmed arrival, transition to IDLE
                     # Should only ever receive a ToDestToIdleAck back
-                    response = Command.recv(self.sock)
-                    FSMUtil.expectClass(response, ToDestToIdleAck)
-
-                    # Persist this state to DB
-                    vehicleStateObj = response.toObj()
-
-                    r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "TO_DEST", time.time(), vehicleStateObj["lat"],
-                                                   vehicleStateObj["lon"], vehicleStateObj["batteryLife"], None)
-                    if not r:
-                        logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is at the destination.")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                    # Update the ride status
-                    # The ride is completed. Remove it from the Rides table and add it to the RidesHistory table
-                    tEnd = time.time()
-                    r = RideDBUtil.getRide(self.db, self.ride.getRideID())
-                    if r is None: # TODO Add alternative
-                        logger.error(f"Failed to get a ride to remove it from db when moving to history")
-                        logger.debug(f"The target ride: {str(self.ride)}")
-                        logger.debug(f"The target vehicle: {str(vehicleStateObj)}")
-                    else:
-                        ride = r
-
-                        riderEmail = ride["userEmail"]
-                        obj = {
-                            "curRideID": None
-                        }
-                        r = self.db.update('Users', obj, {"email": riderEmail})
-                        if not r.success:
-                            logger.error(f"Failed to set the ride id to NULL when ride is finished to user {riderEmail}: {r.message}")
-
-                        obj = {
-                            "userEmail": riderEmail,
-                            "vehicleName": ride["vehicleName"],
-                            "tStart": ride["tStart"],
-                            "tEnd": int(tEnd),
-                            "startNode": ride["startNode"],
-                            "endNode": ride["endNode"]
-                        }
-                        r = self.db.delete('Rides', ['id'], {"id": self.ride.getRideID()})
-                        if not r.success: # TODO Add alternative
-                            logger.error(f"Failed to remove the ride from Rides table to move it to history: {r.message}")
-                            logger.debug(f"The target ride: {str(self.ride)}")
-
-                        r = self.db.create('RideHistory', list(obj.keys()), obj)
-                        if not r.success: # TODO Add alternative
-                            logger.error(f"Failed to add the ride from to history: {r.message}")
-                            logger.debug(f"The target ride: {str(self.ride)}")
-                            logger.debug(f"The target sql obj: {str(obj)}")
-
-                    # Finally, update our state to ENROUTE_TO_DEST
-                    self.vState = State.IDLE
+                    response = self.exchange(self.makeToDestToIdleRequest(), ToDestToIdleAck)
+                    self.onToDestToIdleAck(response)
 
             elif (self.vState == State.ENROUTE_TO_CHARGER):
                 #
@@ -587,95 +477,701 @@ class GoodStrategy(CommStrategy):
                 logger.debug("Vehicle is enroute to charger")
 
                 # Receive a Command from the Vehicle
-                response = Command.recv(self.sock)
-
-                if (response.__class__ == EnrouteToChargerAck):
-                    # If the Command is an instance of EnrouteToChargerAck stay in the ENROUTE_TO_CHARGER state
-
-                    # Persist this state to DB
-                    vehicleState = response.fields
-                    vehicleStateObj = response.toObj()
-
-                    # TODO Marked for highlighting
-                    # Let's choose the things the db wants to see
-                    obj = {
-                        "lat": vehicleStateObj["lat"],
-                        "lon": vehicleStateObj["lon"],
-                        "batteryLife": vehicleStateObj["batteryLife"],
-                        "mileage": vehicleStateObj["mileage"],
-                        # "curEdge" ?
-                    }
-                    r = self.db.update('Vehicles', obj, {"name": vehicleStateObj["name"]})
-                    if not r.success:
-                        logger.error(f"Failed to update vehicle state: {r.message}")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                    # Maintain our current state
-                    self.vState = State.ENROUTE_TO_CHARGER
+                response = self.recvCommand()
+                self.onEnrouteToCharger(response)
 
-                elif (response.__class__ == EnrouteToChargerToChargingAck):
-                    # If the Command is an instance of EnrouteToChargerToChargingAck then the Vehicle is at the Charger
-
-                    # Persist this state to DB
-                    vehicleState = response.fields
-                    vehicleStateObj = response.toObj()
-
-                    # TODO Marked for highlighting
-                    # Let's choose the things the db wants to see
-                    obj = {
-                        "lat": vehicleStateObj["lat"],
-                        "lon": vehicleStateObj["lon"],
-                        "batteryLife": vehicleStateObj["batteryLife"],
-                        "mileage": vehicleStateObj["mileage"],
-                        # "curEdge" ?
-                    }
-                    r = self.db.update('Vehicles', obj, {"name": vehicleStateObj["name"]})
-                    if not r.success:
-                        logger.error(f"Failed to update vehicle state: {r.message}")
-                        logger.debug(f"The target state: {str(vehicleStateObj)}")
-
-                    # And update our state to CHARGING
-                    self.vState = State.CHARGING
-
-            elif (self.vState == State.CHARGING):
+            elif (self.vState == State.CHARGING and self.reportDue()):
                 #
-                # Vehicle state is CHARGING
+                # Vehicle state is CHARGING, and it's time to poll it
                 #
 
                 logger.debug("Vehicle is charging")
 
-                # Construct the arguments for our Command from the destination lat/lon
-                args = {
-                    'lat': -1,
-                    'lon': -1
-                }
-
-                # Create and send our ChargingToCharging Request to the Vehicle
-                request = ChargingToCharging(args)
-                request.send(self.sock)
-
-                # Should only ever receive a ToDestToIdleAck back
-                response = Command.recv(self.sock)
-                FSMUtil.expectClass(response, ChargingAck)
+                # Should only ever receive a ChargingAck back
+                response = self.exchange(self.makeChargingRequest(ChargingToCharging, State.CHARGING), ChargingAck)
 
                 vehicleStateObj = response.toObj()
 
                 if (vehicleStateObj['batteryLife'] >= vehicleStateObj['targetBatteryLife']):
-                    # Construct the arguments for our Command from the destination lat/lon
-                    args = {
-                        'lat': -1,
-                        'lon': -1
-                    }
-
-                    # Create and send our ChargingToIdle Request to the Vehicle
-                    request = ChargingToIdle(args)
-                    request.send(self.sock)
-
                     # Should only ever receive a CharginToIdleAck back
-                    response = Command.recv(self.sock)
-                    FSMUtil.expectClass(response, ChargingToIdleAck)
+                    response = self.exchange(self.makeChargingRequest(ChargingToIdle, State.IDLE), ChargingToIdleAck)
 
                     self.vState = State.IDLE
                     logger.info('Vehicle has been charged and will enter idle.')
 
-            time.sleep(0.20)
+            # Back off every vehicle's cadence if ticks take the server too long
+            self.cadence.observe(time.time() - tickStart - self.vehicleWait)
+
+            # Ride assignments and ride events wake the session before then
+            if (self.vState not in CommStrategy.vehiclePacedStates):
+                self.waitTick(self.untilNextTick())
+
+    #
+    # Receive one TelemetryBatch, persist all of it at once, and acknowledge it
+    #
+
+    def recvTelemetryBatch(self):
+        batch = self.recvCommand()
+        FSMUtil.expectClass(batch, TelemetryBatch)
+
+        self.sendCommand(self.onTelemetryBatch(batch))
+
+    #
+    # One IDLE tick: ask the vehicle for its state, and persist it.
+    #
+    # A pipelined connection doesn't wait on the round trip: it keeps up to
+    # maxIdlePolls IdleRequests in flight, and handles each idleAck on the
+    # first tick after it arrives.
+    #
+
+    def pollIdle(self):
+        if (self.pipeline is None):
+            self.onIdleAck(self.exchange(IdleRequest(), IdleAck))
+            return
+
+        while (len(self.idlePolls) > 0 and self.idlePolls[0].done()):
+            self.onIdleAck(self.idlePolls.popleft().result())
+
+        if (len(self.idlePolls) < CommStrategy.maxIdlePolls):
+            self.idlePolls.append(self.pipeline.request(IdleRequest()))
+
+    #
+    # Wait for and handle every IdleRequest still in flight,
+    # so that none of them is persisted after a transition out of IDLE
+    #
+
+    def drainIdlePolls(self):
+        while (len(self.idlePolls) > 0):
+            self.onIdleAck(self.idlePolls.popleft().result(CommStrategy.ackTimeout))
+
+    #
+    # Everything below runs the session's DB work; none of it talks to the vehicle.
+    # AsyncStrategy runs these in its DB executor.
+    #
+
+    #
+    # Register the vehicle of an InitRequest.
+    # Returns False if the connection should be dropped.
+    #
+
+    def register(self, initRequest):
+        registered = VehicleDBUtil.registerVehicle(self.db, initRequest)
+        if (registered == False):
+            logger.error('Failed to register vehicle. Terminating this connection.')
+            return False
+
+        # Save the vehicle name for later (for disabling)
+        self.vName = initRequest.name
+
+        # Its session starts out idle, so it can be matched before its first IdleAck
+        self.theServer.fleet.register(self.vName, initRequest.lat, initRequest.lon, initRequest.batteryLife, 'WAITING')
+        return True
+
+    #
+    # Take over the parked session (see resumption.py) whose token the InitRequest has, if any.
+    # The vehicle is still registered, and carries on in the state and with the ride it had.
+    # Returns whether it did.
+    #
+
+    def resume(self, initRequest):
+        resumption = self.theServer.resumption
+        if (resumption is None):
+            return False
+
+        parked = resumption.resume(initRequest.resumeToken, initRequest.name)
+        if (parked is None):
+            return False
+
+        self.vName = parked.vName
+        self.vState = parked.vState
+
+        # An idle one's ride was never acknowledged, so its session requeues it (see endSession())
+        if (self.vState != State.IDLE):
+            self.ride = getattr(parked, 'ride', None)
+        if (getattr(self, 'ride', None) is not None):
+            self.theServer.rideEvents.subscribe(self.ride.rideID, self)
+
+        # And finish moving its rides to the history, from the first attempt
+        self.unfinalized = [[ride, 0, 0.0] for ride, attempts, retryAt in parked.unfinalized]
+
+        logger.info(f"Vehicle {self.vName} resumed its session in state {self.vState}")
+        return True
+
+    def makeInitAck(self, initRequest, canPipeline):
+        # Let the vehicle send position reports over UDP too
+        telemetry = self.theServer.telemetry
+        if (initRequest.udpTelemetry and telemetry is not None):
+            self.telemetryToken = telemetry.register(self.vName)
+
+        # And resume this session, if its connection drops
+        if (self.theServer.resumption is not None):
+            self.resumeToken = self.theServer.resumption.issue(self)
+
+        return InitAck({
+            'codec':     Codec.negotiate(initRequest.codecs),
+            'deltaAcks': initRequest.keyframeInterval > 0,
+            'pipelined': initRequest.pipelining and canPipeline,
+            'reportInterval': self.cadence.interval(State.IDLE),
+            'telemetryToken': self.telemetryToken.hex() if self.telemetryToken else '',
+            'telemetryPort': telemetry.port if self.telemetryToken else 0,
+            'resumeToken': self.resumeToken or ''
+        })
+
+    #
+    # The InitAck was sent: switch to what it agreed on
+    #
+
+    def onInitAck(self, initRequest, initAck):
+        self.codec = initAck.codec
+
+        # Rebuild delta-encoded acks from the state the vehicle registered with
+        if (initAck.deltaAcks):
+            self.delta = DeltaState()
+            self.delta.remember(initRequest)
+
+    #
+    # The session is over, one way or another
+    #
+
+    def endSession(self):
+        if (not hasattr(self, 'vName')):
+            return
+
+        self.theServer.removeSession(self.vName, self)
+
+        # A ride it was matched with but never took goes to another vehicle
+        self.theServer.dispatcher.removeVehicle(self.vName, self)
+        if (self.assignment is not None):
+            self.theServer.dispatcher.requeue(self.assignment)
+            self.assignment = None
+
+        # So does one it was sent, but never acknowledged
+        if (getattr(self, 'vState', None) == State.IDLE and getattr(self, 'ride', None) is not None):
+            self.theServer.dispatcher.requeue(self.ride)
+            self.ride = None
+
+        if (self.telemetryToken is not None):
+            self.theServer.telemetry.unregister(self.telemetryToken)
+
+        # Keep the vehicle, and its ride, for a while in case it reconnects.
+        # If it already did, they went to its new session.
+        if (self.resumeToken is not None and hasattr(self, 'vState')):
+            self.theServer.resumption.park(self)
+        elif (not self.superseded):
+            self.closeSession()
+
+    #
+    # Let go of the vehicle (when its session ends, or once it was parked for too long)
+    #
+
+    def closeSession(self):
+        if (self.resumeToken is not None):
+            self.theServer.resumption.forget(self)
+
+        if (getattr(self, 'ride', None) is not None):
+            self.theServer.rideEvents.unsubscribe(self.ride.rideID, self)
+
+        # A newer session of the vehicle already took over (e.g. it reconnected without resuming)
+        current = self.theServer.sessions.get(self.vName)
+        if (current is not None and current is not self):
+            return
+
+        self.theServer.fleet.remove(self.vName, self.db)
+        VehicleDBUtil.disableVehicle(self.db, self.vName)
+
+    #
+    # Persist a TelemetryBatch, and return the ack to send back
+    #
+
+    def onTelemetryBatch(self, batch):
+        if (VehicleDBUtil.insertCoordHistory(self.db, self.vName, batch.samples)):
+            count = len(batch.samples)
+        else:
+            logger.error(f"Failed to persist {len(batch.samples)} backfilled samples of vehicle {self.vName}")
+            count = 0
+
+        return TelemetryBatchAck({'count': count})
+
+    #
+    # The ride this vehicle should serve next, if any
+    #
+
+    def checkRide(self):
+        # Wait in the dispatcher's idle set, unless a ride was already assigned
+        if (self.assignment is None and not self.awaitingRide):
+            self.awaitingRide = True
+            self.theServer.dispatcher.vehicleIdle(self.vName, self)
+
+        ride = self.assignment
+        if (ride is None):
+            return None
+        self.assignment = None
+
+        events = self.theServer.rideEvents
+        if (events.happened(ride.rideID, RideEvents.CANCEL) or RideDBUtil.checkCanceled(self.db, ride.rideID)):
+            events.forget(ride.rideID)
+            return None
+        return ride
+
+    #
+    # Whether to read the DB for what happened to the ride.
+    # Events published in this process (see RideEvents) are seen right away;
+    # the DB is only read every RideEvents.fallbackInterval seconds, for the rest.
+    #
+
+    def rideCheckDue(self):
+        now = time.time()
+        if (now < self.nextRideCheck):
+            return False
+
+        self.nextRideCheck = now + RideEvents.fallbackInterval
+        return True
+
+    #
+    # Whether the ride was canceled, and whether the rider confirmed pickup
+    #
+
+    def checkPickup(self):
+        events = self.theServer.rideEvents
+        canceled = events.happened(self.ride.rideID, RideEvents.CANCEL)
+        pickupConfirmed = events.happened(self.ride.rideID, RideEvents.PICKUP)
+
+        if (not (canceled or pickupConfirmed) and self.rideCheckDue()):
+            canceled = RideDBUtil.checkCanceled(self.db, self.ride.rideID)
+            pickupConfirmed = RideDBUtil.checkPickupConfirmation(self.db, self.ride.rideID)
+
+        # Mark the time that this state was entered
+        """ if (not self.to_rider_time):
+            self.to_rider_time = time.time()
+            logger.debug(f"Set to_ride_time: {str(self.to_rider_time)}")
+        if (time.time() - self.to_rider_time > RideDBUtil.WAIT_TIME):
+            logger.debug(f"Progressing to next state as {str(RideDBUtil.WAIT_TIME)} seconds have passed.")
+            pickupConfirmed = True
+        logger.debug(f"Time elapsed: {str(time.time() - self.to_rider_time)}.") """
+
+        return canceled, pickupConfirmed
+
+    #
+    # Whether the ride was canceled, and whether the rider confirmed arrival
+    #
+
+    def checkArrival(self):
+        events = self.theServer.rideEvents
+        canceled = events.happened(self.ride.rideID, RideEvents.CANCEL)
+        arrivalConfirmed = events.happened(self.ride.rideID, RideEvents.ARRIVAL)
+
+        if (not (canceled or arrivalConfirmed) and self.rideCheckDue()):
+            arrivalConfirmed = RideDBUtil.checkArrivalConfirmation(self.db, self.ride.rideID)
+            canceled = RideDBUtil.checkCanceled(self.db, self.ride.rideID)
+
+        # Mark the time that this state was entered
+        """ if (not self.to_dest_time):
+            self.to_dest_time = time.time()
+            logger.debug(f"Set to_dest_time: {str(self.to_dest_time)}")
+        if (time.time() - self.to_dest_time > RideDBUtil.WAIT_TIME):
+            logger.debug(f"Progressing to next state as {str(RideDBUtil.WAIT_TIME)} seconds have passed.")
+            arrivalConfirmed = True
+        logger.debug(f"Time elapsed: {str(time.time() - self.to_dest_time)}.") """
+
+        return canceled, arrivalConfirmed
+
+    #
+    # The requests the FSM sends
+    #
+
+    #
+    # Send the low-battery vehicle of an InitRequest to charge, or None if it doesn't need to
+    #
+
+    def makeInitialChargerRequest(self, initRequest):
+        response = initRequest.toObj()
+        logger.debug(f"battery life upon init: {str(response['batteryLife'])} ")
+        if (response['batteryLife'] > response['minBatteryLife']):
+            return None
+
+        lat, lon = response['lat'], response['lon']
+        logger.debug(f"Node lat: {str(lat)}, Node lon:{str(lon)} ")
+        #TODO: should be something like vehicle_util.getChargerLocation
+        args = {
+            'lat': lat,
+            'lon': lon,
+            'reportInterval': self.cadence.interval(State.ENROUTE_TO_CHARGER)
+        }
+        return IdleToEnrouteToCharger(args)
+
+    def makeIdleToEnrouteToRiderRequest(self):
+        # Get the latitude and longtitude of the Rider from the Ride we got
+        lat, lon = self.ride.getRiderLocation()
+
+        # Create our IdleToEnrouteToRiderRequest arguments from the rider lat and lon
+        args = {
+            'lat': lat,
+            'lon': lon,
+            'reportInterval': self.cadence.interval(State.ENROUTE_TO_RIDER)
+        }
+
+        return IdleToEnrouteToRiderRequest(args)
+
+    #
+    # ToRiderCancel or ToDestCancel: the ride was canceled, stay at the current location
+    #
+
+    def makeCancelRequest(self, requestClass):
+        lat, lon = self.ride.getRiderLocation()
+        args = {
+            'lat': lat,
+            'lon': lon,
+            'reportInterval': self.cadence.interval(State.IDLE)
+        }
+
+        return requestClass(args)
+
+    def makeToRiderToEnrouteToDestRequest(self):
+        # If the Vehicle is at the Client we need to send it the lat/lon position of the destination
+        lat = self.ride.destLat
+        lon = self.ride.destLon
+
+        # Construct the arguments for our Command from the destination lat/lon
+        args = {
+            'lat': lat,
+            'lon': lon,
+            'reportInterval': self.cadence.interval(State.ENROUTE_TO_DEST)
+        }
+
+        return ToRiderToEnrouteToDestRequest(args)
+
+    def makeToDestToIdleRequest(self):
+        # Send the lat/lon position of the destination
+        lat = self.ride.riderLat
+        lon = self.ride.riderLon
+
+        # Construct the arguments for our Command from the destination lat/lon
+        args = {
+            'lat': lat,
+            'lon': lon,
+            'reportInterval': self.cadence.interval(State.IDLE)
+        }
+
+        return ToDestToIdle(args)
+
+    #
+    # ChargingToCharging or ChargingToIdle, for a vehicle that will then be in newState
+    #
+
+    def makeChargingRequest(self, requestClass, newState):
+        args = {
+            'lat': -1,
+            'lon': -1,
+            'reportInterval': self.cadence.interval(newState)
+        }
+
+        return requestClass(args)
+
+    #
+    # Handle the vehicle's answers, and move the FSM along
+    #
+
+    def onIdleAck(self, response):
+        # Should only ever receive a idleAck back
+        FSMUtil.expectClass(response, IdleAck)
+
+        # TODO double check that there are no issues in the DB when the ride is canceled
+        vehicleStateObj = response.toObj()
+
+        r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "WAITING", time.time(), vehicleStateObj["lat"],
+                                       vehicleStateObj["lon"], vehicleStateObj["batteryLife"], None, vehicleStateObj["mileage"],
+                                       fleet=self.theServer.fleet, history=self.theServer.coordHistory)
+        if not r:
+            logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is idle.")
+            logger.debug(f"The target state: {str(vehicleStateObj)}")
+
+        self.batteryLife = vehicleStateObj['batteryLife']
+
+    def onIdleToEnrouteToRiderAck(self, response):
+        # Persist this state to DB
+        vehicleStateObj = response.toObj()
+
+        r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "ENROUTE_TO_RIDER", time.time(), vehicleStateObj["lat"],
+                                       vehicleStateObj["lon"], vehicleStateObj["batteryLife"], self.ride.getRideID(), fleet=self.theServer.fleet,
+                                       history=self.theServer.coordHistory)
+        if not r:
+            logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is enroute to rider.")
+            logger.debug(f"The target state: {str(vehicleStateObj)}")
+
+        # Update the ride with the assigned vehicle name
+        logger.debug(f"Assigning a vehicle {str(response)} name to a ride {str(self.ride)}")
+        r = self.db.update('Rides', {"vehicleName": vehicleStateObj["name"], "status": "ENROUTE_TO_RIDER"},
+                           {"userEmail": self.ride.getRiderEmail()})
+        if not r.success:
+            logger.error(f"Failed to assign a vehicle name to the ride: {r.message}")
+            logger.debug(f"The target ride: {str(self.ride)}")
+            logger.debug(f"The target vehicle: {str(vehicleStateObj)}")
+
+        # Hear about pickup, arrival and cancellation of the ride as soon as they happen
+        self.theServer.rideEvents.subscribe(self.ride.rideID, self)
+
+        # And set our current state to ENROUTE_TO_RIDER
+        self.vState = State.ENROUTE_TO_RIDER
+        logger.info('Client is enroute to rider')
+        self.batteryLife = vehicleStateObj['batteryLife']
+
+    def onEnrouteToRider(self, response):
+        if(response.__class__ == EnrouteToRiderAck):
+            # If the command received is an instance of EnrouteToRiderAck we remain in the current state.
+            # Still need to update the Vehicle database with the current state of this Vehicle
+
+            self.vState = State.ENROUTE_TO_RIDER
+
+            # Persist this state to DB
+            vehicleStateObj = response.toObj()
+
+            r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "ENROUTE_TO_RIDER", time.time(), vehicleStateObj["lat"],
+                                           vehicleStateObj["lon"], vehicleStateObj["batteryLife"], fleet=self.theServer.fleet,
+                                           history=self.theServer.coordHistory)
+            if not r:
+                logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is enroute to rider.")
+                logger.debug(f"The target state: {str(vehicleStateObj)}")
+
+        elif (response.__class__ == EnrouteToRiderToToRiderAck):
+            # If the command received is an instance of EnrouteToRiderToToRiderAck we update the state to TO_RIDER
+            # Also need to update the Vehicle information in the database
+
+            # Persist this state to DB
+            vehicleStateObj = response.toObj()
+
+            r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "TO_RIDER", time.time(), vehicleStateObj["lat"],
+                                           vehicleStateObj["lon"], vehicleStateObj["batteryLife"], fleet=self.theServer.fleet,
+                                           history=self.theServer.coordHistory)
+            if not r:
+                logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is at the rider's location.")
+                logger.debug(f"The target state: {str(vehicleStateObj)}")
+
+            # Update the ride status
+            r = self.db.update('Rides', {"status": "TO_RIDER"}, {"userEmail": self.ride.getRiderEmail()})
+            if not r.success:
+                logger.error(f"Failed to update ride status: {r.message}")
+                logger.debug(f"The target ride: {str(self.ride)}")
+                logger.debug(f"The target vehicle: {str(vehicleStateObj)}")
+
+            self.vState = State.TO_RIDER
+            logger.info('Client is at the rider\'s location')
+
+    #
+    # The vehicle is waiting (at the rider or the destination); persist its last known state
+    #
+
+    def persistStatus(self, response, status, where):
+        vehicleStateObj = response.toObj()
+
+        r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], status, time.time(), vehicleStateObj["lat"],
+                                       vehicleStateObj["lon"], vehicleStateObj["batteryLife"], fleet=self.theServer.fleet,
+                                       history=self.theServer.coordHistory)
+        if not r:
+            logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is {where}.")
+            logger.debug(f"The target state: {str(vehicleStateObj)}")
+
+    #
+    # The vehicle acknowledged a ToRiderCancel or ToDestCancel:
+    # it waits where it is, and the ride moves to the history
+    #
+
+    def onCancelAck(self, response):
+        vehicleStateObj = response.toObj()
+        r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "WAITING", time.time(), vehicleStateObj["lat"],
+                                       vehicleStateObj["lon"], vehicleStateObj["batteryLife"], None, fleet=self.theServer.fleet,
+                                       history=self.theServer.coordHistory)
+        if not r:
+            logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is at the rider's location.")
+            logger.debug(f"The target state: {str(vehicleStateObj)}")
+
+        self.moveRideToHistory()
+
+        self.theServer.rideEvents.forget(self.ride.rideID)
+        self.ride = None
+
+        self.vState = State.IDLE
+        logger.info('Client has be canceled and will remain at current location.')
+
+    #
+    # The ride is over (completed or canceled): free its rider, remove it from the Rides table
+    # and add it to the RideHistory table, all in one transaction.
+    #
+    # If the transaction fails, the ride is left pending and retried on a later tick
+    # (see retryFinalize()), so neither the session nor a DB thread waits in between.
+    # After the last attempt, this raises, which ends the session: rather than leave the
+    # ride in the Rides table, a session that resumes the vehicle (see resumption.py) finishes it.
+    #
+
+    def moveRideToHistory(self, ride=None, attempt=1):
+        if (ride is None):
+            ride = self.ride
+
+        try:
+            self.finalizeRide(ride)
+            return
+        except Exception as e:
+            logger.error(f"Failed to move ride {ride.getRideID()} to history "
+                         f"(attempt {attempt} of {CommStrategy.finalizeAttempts}): {e}")
+            if (attempt == CommStrategy.finalizeAttempts):
+                # For a session that resumes the vehicle to take over
+                self.unfinalized.append([ride, attempt, time.time()])
+                raise
+
+        delay = CommStrategy.finalizeRetryDelay * 2 ** (attempt - 1)
+        self.unfinalized.append([ride, attempt, time.time() + delay])
+
+    #
+    # Whether a ride that failed to move to the history is due to be tried again
+    #
+
+    def finalizeDue(self):
+        now = time.time()
+        return any(retryAt <= now for ride, attempts, retryAt in self.unfinalized)
+
+    def retryFinalize(self):
+        now = time.time()
+        for entry in [u for u in self.unfinalized if u[2] <= now]:
+            self.unfinalized.remove(entry)
+            ride, attempts, retryAt = entry
+            self.moveRideToHistory(ride, attempts + 1)
+
+    def finalizeRide(self, ride):
+        with self.db.transaction():
+            rideID = ride.getRideID()
+            ride = RideDBUtil.getRide(self.db, rideID)
+            if ride is None:
+                # Already gone from the Rides table, so there is nothing to move
+                logger.warning(f"Ride {rideID} isn't in the Rides table, so it can't be moved to history")
+                return
+
+            riderEmail = ride["userEmail"]
+            obj = {
+                "curRideID": None
+            }
+            self.db.update('Users', obj, {"email": riderEmail})
+
+            self.db.delete('Rides', ['id'], {"id": rideID})
+
+            tEnd = time.time()
+            obj = {
+                "userEmail": riderEmail,
+                "vehicleName": ride["vehicleName"],
+                "tStart": ride["tStart"],
+                "tEnd": int(tEnd),
+                "startNode": ride["startNode"],
+                "endNode": ride["endNode"]
+            }
+            self.db.create('RideHistory', list(obj.keys()), obj)
+
+    def onToRiderToEnrouteToDestAck(self, response):
+        # Persist this state to DB
+        vehicleStateObj = response.toObj()
+
+        r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "ENROUTE_TO_DEST", time.time(), vehicleStateObj["lat"],
+                                       vehicleStateObj["lon"], vehicleStateObj["batteryLife"], fleet=self.theServer.fleet,
+                                       history=self.theServer.coordHistory)
+        if not r:
+            logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is enroute to destination.")
+            logger.debug(f"The target state: {str(vehicleStateObj)}")
+
+        # Update the ride status
+        r = self.db.update('Rides', {"status": "ENROUTE_TO_DEST"}, {"userEmail": self.ride.getRiderEmail()})
+        if not r.success:
+            logger.error(f"Failed to update ride status: {r.message}")
+            logger.debug(f"The target ride: {str(self.ride)}")
+            logger.debug(f"The target vehicle: {str(vehicleStateObj)}")
+
+        # Finally, update our state to ENROUTE_TO_DEST
+        self.vState = State.ENROUTE_TO_DEST
+        logger.info('Client is enroute to destination location with the rider')
+
+    def onEnrouteToDest(self, response):
+        if (response.__class__ == EnrouteToDestAck):
+            # If the Command is an instance of EnrouteToDestAck stay in the ENROUTE_TO_DEST state
+
+            # Persist this state to DB
+            vehicleStateObj = response.toObj()
+
+            r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "ENROUTE_TO_DEST", time.time(), vehicleStateObj["lat"],
+                                           vehicleStateObj["lon"], vehicleStateObj["batteryLife"], fleet=self.theServer.fleet,
+                                           history=self.theServer.coordHistory)
+            if not r:
+                logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is enroute to destination.")
+                logger.debug(f"The target state: {str(vehicleStateObj)}")
+
+            # Maintain our current state
+            self.vState = State.ENROUTE_TO_DEST
+
+        elif (response.__class__ == EnrouteToDestToToDestAck):
+            # If the Command is an instance of EnrouteToDestToToDestAck then the Vehicle is at the destination
+
+            # Persist this state to DB
+            vehicleStateObj = response.toObj()
+
+            r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "TO_DEST", time.time(), vehicleStateObj["lat"],
+                                           vehicleStateObj["lon"], vehicleStateObj["batteryLife"], fleet=self.theServer.fleet,
+                                           history=self.theServer.coordHistory)
+            if not r:
+                logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is at the destination.")
+                logger.debug(f"The target state: {str(vehicleStateObj)}")
+
+            # Update the ride status
+            r = self.db.update('Rides', {"status": "TO_DEST"}, {"userEmail": self.ride.getRiderEmail()})
+            if not r.success:
+                logger.error(f"Failed to update ride status: {r.message}")
+                logger.debug(f"The target ride: {str(self.ride)}")
+                logger.debug(f"The target vehicle: {str(vehicleStateObj)}")
+
+            # And update our state to TO_DEST
+            self.vState = State.TO_DEST
+            logger.info('Waiting on client confirmation of arrival')
+
+    def onToDestToIdleAck(self, response):
+        logger.info("Rider confirmed the arrival.")
+
+        # Persist this state to DB
+        vehicleStateObj = response.toObj()
+
+        r = VehicleDBUtil.updateStatus(self.db, vehicleStateObj["name"], "TO_DEST", time.time(), vehicleStateObj["lat"],
+                                       vehicleStateObj["lon"], vehicleStateObj["batteryLife"], None, fleet=self.theServer.fleet,
+                                       history=self.theServer.coordHistory)
+        if not r:
+            logger.error(f"Failed to update vehicle state when vehicle {vehicleStateObj['name']} is at the destination.")
+            logger.debug(f"The target state: {str(vehicleStateObj)}")
+
+        # Update the ride status
+        # The ride is completed. Remove it from the Rides table and add it to the RidesHistory table
+        self.moveRideToHistory()
+
+        self.theServer.rideEvents.forget(self.ride.rideID)
+        self.ride = None
+
+        # Finally, update our state to IDLE
+        self.vState = State.IDLE
+
+    def onEnrouteToCharger(self, response):
+        if (response.__class__ == EnrouteToChargerAck):
+            # If the Command is an instance of EnrouteToChargerAck stay in the ENROUTE_TO_CHARGER state
+            newState = State.ENROUTE_TO_CHARGER
+        elif (response.__class__ == EnrouteToChargerToChargingAck):
+            # If the Command is an instance of EnrouteToChargerToChargingAck then the Vehicle is at the Charger
+            newState = State.CHARGING
+        else:
+            return
+
+        # Persist this state to DB
+        vehicleStateObj = response.toObj()
+
+        # TODO Marked for highlighting
+        # Let's choose the things the db wants to see
+        obj = {
+            "lat": vehicleStateObj["lat"],
+            "lon": vehicleStateObj["lon"],
+            "batteryLife": vehicleStateObj["batteryLife"],
+            "mileage": vehicleStateObj["mileage"],
+            # "curEdge" ?
+        }
+        self.theServer.fleet.update(vehicleStateObj["name"], obj)
+
+        # Maintain our current state, or update it to CHARGING
+        self.vState = newState
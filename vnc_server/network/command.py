@@ -12,11 +12,190 @@
 # in its base classes.
 #
 from abc import abstractmethod
+import struct
 
 from communication import Communication
 
 
-class Command():
+class Codec(object):
+    """
+    The encodings a Command can be sent with.
+
+    JSON is always understood and is what every connection starts with.
+    A vehicle lists the codecs it understands in its InitRequest,
+    and the server names the one it picked in its InitAck.
+    """
+
+    JSON = 'json'
+    STRUCT = 'struct'
+
+    supported = (JSON, STRUCT)
+
+    @staticmethod
+    def negotiate(offered):
+        """Returns the most compact codec that both sides understand
+        """
+        if (offered is not None and Codec.STRUCT in offered):
+            return Codec.STRUCT
+        return Codec.JSON
+
+
+#
+# Wire layout of each field under the struct codec.
+# A Command can only be struct-encoded if all of its fields are listed here.
+#
+# 'd' is a double, 'f' a float and 'h' a short (big-endian, see struct docs).
+# str fields are sent as a one-byte length then UTF-8,
+# after all of the fixed-width fields.
+#
+# The two codecs don't always decode to the same values:
+# - 'f' fields are rounded to 32 bits (about 7 significant digits, e.g. a heading
+#   of 123.456789 arrives as 123.45678710...). JSON sends them as they are.
+#   Compare them within a tolerance, not with ==.
+# - A value that doesn't fit its format (a fractional or out-of-range 'h', such as
+#   a batteryLife of 85.5, or a str over 255 bytes) sends the whole frame as JSON
+#   instead (see Command.encode()), so it arrives exactly.
+# - A Command with a field not listed here is always sent as JSON. That includes
+#   InitRequest (its codecs is a list), which goes before a codec is picked anyway.
+#
+structFieldFormats = {
+    'name':              str,
+    'lat':               'd',
+    'lon':               'd',
+    'heading':           'f',
+    'steering':          'f',
+    'speed':             'f',
+    'batteryLife':       'h',
+    'minBatteryLife':    'h',
+    'targetBatteryLife': 'h',
+    'mileage':           'd',
+    'reportInterval':    'f'
+}
+
+
+class DeltaState(object):
+    """
+    The last full state of a vehicle, as seen by one end of a connection
+    that uses delta-encoded acks.
+
+    Instead of every field, the vehicle may send only the fields that changed
+    since its previous frame, plus a full keyframe every keyframeInterval frames.
+    The server rebuilds each full Command from the fields it last saw.
+    Both ends keep one of these per connection (see Command.send() and Command.recv()).
+
+    Frames are never lost or reordered on the TCP connection,
+    so the previous frame sent is also the last one the server has.
+    """
+
+    def __init__(self, keyframeInterval=0):
+        # Only used by the sending end
+        self.keyframeInterval = keyframeInterval
+        self.framesSinceKeyframe = None
+
+        # Map from field name to its last value, across all Command classes
+        self.fields = {}
+
+    def remember(self, command):
+        self.fields.update(zip(command.allFields, command.toTuple()))
+
+    #
+    # Whether the next frame sent must be a full one
+    #
+
+    def keyframeDue(self):
+        return (self.framesSinceKeyframe is None
+                or self.framesSinceKeyframe + 1 >= self.keyframeInterval)
+
+
+#
+# Generate a function that returns the given attributes of an instance
+# as a tuple, and one that sets them from a tuple.
+#
+# This is what namedtuple and dataclasses do under the hood;
+# the generated code has no loop and no per-field dict lookups.
+#
+
+def _makeTupleGetter(fieldNames):
+    if (len(fieldNames) == 0):
+        return lambda self: ()
+
+    src = 'def getter(self):\n'
+    src += '    return (%s)\n' % ''.join('self.%s, ' % f for f in fieldNames)
+
+    namespace = {}
+    exec(src, namespace)
+    return namespace['getter']
+
+
+def _makeTupleSetter(fieldNames):
+    if (len(fieldNames) == 0):
+        return lambda self, values: None
+
+    src = 'def setter(self, values):\n'
+    src += '    %s = values\n' % ''.join('self.%s, ' % f for f in fieldNames)
+
+    namespace = {}
+    exec(src, namespace)
+    return namespace['setter']
+
+
+class CommandMeta(type):
+    """
+    The metaclass of Command.
+
+    Defining a subclass of Command registers it (by class name, and by
+    command id for the struct codec) and precompiles everything that
+    sending or receiving it needs:
+
+    - __slots__ for its fields, so instances have no __dict__
+    - allFields, the tuple of required then optional field names
+    - toTuple()/fromTuple(), generated fast paths to and from a tuple
+    - its struct layout (see Command.structLayout())
+    - the encoded payload of each codec, if it has no fields at all
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        if (len(bases) > 0):
+            # Only add slots for fields that a base class doesn't already have
+            inherited = set()
+            for base in bases:
+                inherited.update(getattr(base, 'allFields', ()))
+
+            fields = namespace.get('fields', None)
+            if (fields is None):
+                fields = getattr(bases[0], 'fields', [])
+            optionalFields = namespace.get('optionalFields', None)
+            if (optionalFields is None):
+                optionalFields = getattr(bases[0], 'optionalFields', {})
+
+            allFields = tuple(fields) + tuple(optionalFields)
+            namespace['__slots__'] = tuple(f for f in allFields if f not in inherited)
+            namespace['allFields'] = allFields
+
+        cls = super().__new__(mcs, name, bases, namespace)
+
+        if (len(bases) > 0):
+            cls._compile()
+            Command.registry[name] = cls
+            if (cls.commandID is not None):
+                if (cls.commandID >= Command.maxCommandID):
+                    raise Exception('Command id %d of %s is too large' % (cls.commandID, name))
+                if (cls.commandID in commandsByID):
+                    raise Exception('Duplicate command id %d: %s and %s' % (
+                        cls.commandID, commandsByID[cls.commandID].__name__, name))
+                commandsByID[cls.commandID] = cls
+
+        return cls
+
+
+#
+# Map from struct codec command id to the concrete class.
+# Filled in by CommandMeta.
+#
+commandsByID = {}
+
+
+class Command(metaclass=CommandMeta):
     """
     The base, abstract Command class.
     All Commands inherit from Command.
@@ -41,25 +220,107 @@ class Command():
     print(initAck)
     """
 
-    # Recommended amount of time to sleep after a request/ack
+    # Instances only hold their fields (see CommandMeta),
+    # and the sequence number of a pipelined connection (see pipeline.py).
+    # seq is None on connections that aren't pipelined.
+    __slots__ = ('seq',)
+
+    # Map from class name to every concrete Command class.
+    # Filled in by CommandMeta.
+    registry = {}
+
+    allFields = ()
+
+    # Recommended amount of time to sleep after a request/ack,
+    # for a vehicle that wasn't given a reportInterval
     sleepTime = 0.50
 
+    # One-byte id identifying the concrete class under the struct codec.
+    # Must stay below maxCommandID, so that the first byte of a struct frame
+    # (the id, maybe with flags set) is never Communication.jsonMarker.
+    commandID = None
+    maxCommandID = 0x3B
+
+    # Set on the command id of a struct frame that only carries some fields
+    deltaFlag = 0x80
+
+    # Set on the command id of a struct frame that carries a sequence number
+    seqFlag = 0x40
+    seqByteRep = '>I'
+
+    # Fields that older peers may leave out, mapped to their default value
+    optionalFields = {}
+
+    #
+    # Precompute the tuple fast paths, struct layout and constant payloads
+    # of this class. Called once by CommandMeta when the class is defined.
+    #
+
+    @classmethod
+    def _compile(cls):
+        cls.toTuple = _makeTupleGetter(cls.allFields)
+        cls._setFromTuple = _makeTupleSetter(cls.allFields)
+
+        cls._structLayout = None
+        if (cls.commandID is not None and all(f in structFieldFormats for f in cls.allFields)):
+            fixedFields = tuple(f for f in cls.allFields if structFieldFormats[f] is not str)
+            strFields = tuple(f for f in cls.allFields if structFieldFormats[f] is str)
+            fmt = ''.join(structFieldFormats[f] for f in fixedFields)
+            cls._structLayout = (struct.Struct('>B' + fmt), fixedFields, strFields)
+            # The same, with a sequence number after the command id
+            cls._seqPacker = struct.Struct('>BI' + fmt)
+            cls._getFixed = _makeTupleGetter(fixedFields)
+            cls._setFixed = _makeTupleSetter(fixedFields)
+
+        # Struct layouts of delta frames, by the mask of the fields they carry.
+        # Filled in as masks are seen (see deltaLayout()).
+        cls._deltaLayouts = {}
+
+        # A Command without fields always encodes to the same bytes,
+        # so do it once here instead of on every send()
+        cls._constantPayloads = None
+        if (len(cls.allFields) == 0):
+            cls._constantPayloads = {}
+            instance = cls.fromTuple(())
+            for codec in Codec.supported:
+                cls._constantPayloads[codec] = instance.encode(codec)
+
     #
     # Update this instance's fields to agree with the input object
     #
 
     def __init__(self, obj={}):
         for f in self.__class__.fields:
-            self.__dict__[f] = obj[f]
+            setattr(self, f, obj[f])
+        for f, default in self.__class__.optionalFields.items():
+            setattr(self, f, obj.get(f, default))
+        self.seq = obj.get('seq')
+
+    #
+    # Return the tuple of this instance's fields, in allFields order.
+    # Generated per class by CommandMeta.
+    #
+
+    def toTuple(self):
+        return ()
+
+    #
+    # Create an instance from a tuple of its fields, in allFields order.
+    #
+
+    @classmethod
+    def fromTuple(cls, values):
+        self = cls.__new__(cls)
+        cls._setFromTuple(self, values)
+        self.seq = None
+        return self
 
     #
     # Return the object representation of this instance's fields.
     #
 
     def toObj(self):
-        return {
-            f: self.__dict__[f] for f in self.__class__.fields
-        }
+        return dict(zip(self.__class__.allFields, self.toTuple()))
 
     #
     # Each Command should know how to create an instance of itself
@@ -80,34 +341,199 @@ class Command():
 
     def __str__(self):
         out = '%s{' % self.__class__.__name__
-        out += ', '.join(['%s=%s' % (f, self.__dict__[f])
+        out += ', '.join(['%s=%s' % (f, getattr(self, f))
                           for f in self.__class__.fields])
         out += '}'
 
         return out
 
+    #
+    # The struct layout of this class, or None if it can't be struct-encoded.
+    #
+    # The layout is (packer, fixed-width fields, str fields),
+    # where packer covers the command id and the fixed-width fields.
+    #
+
+    @classmethod
+    def structLayout(cls):
+        return cls._structLayout
+
+    #
+    # The struct layout of a delta frame of this class carrying the fields
+    # whose bits are set in mask (bit i is allFields[i]).
+    #
+    # The layout is (packer, fixed-width fields, str fields),
+    # where packer only covers the fixed-width fields.
+    #
+
+    @classmethod
+    def deltaLayout(cls, mask):
+        layout = cls._deltaLayouts.get(mask)
+        if (layout is None):
+            present = [f for i, f in enumerate(cls.allFields) if mask & (1 << i)]
+            fixedFields = tuple(f for f in present if structFieldFormats[f] is not str)
+            strFields = tuple(f for f in present if structFieldFormats[f] is str)
+            fmt = '>' + ''.join(structFieldFormats[f] for f in fixedFields)
+            layout = (struct.Struct(fmt), fixedFields, strFields)
+            cls._deltaLayouts[mask] = layout
+
+        return layout
+
     #
     # Do NOT override this function.
     #
-    # Send the object representing this command over a socket.
-    # Always add the class name.
-    # NOTE: If a Command uses className, it will get clobbered.
+    # Serialize this command to the bytes of one frame.
+    # Under the JSON codec, always add the class name (and seq, if set).
+    # NOTE: If a Command uses className or seq, it will get clobbered.
     #
+    # If the struct codec was asked for but this command doesn't fit its layout
+    # (e.g. a value is out of range), JSON is used for this frame instead,
+    # and onFallback (if not None) is called with this command.
+    #
+
+    def encode(self, codec=Codec.JSON, onFallback=None):
+        constantPayloads = self.__class__._constantPayloads
+        if (constantPayloads is not None and self.seq is None and codec in constantPayloads):
+            return constantPayloads[codec]
+
+        if (codec == Codec.STRUCT):
+            payload = self.encodeStruct()
+            if (payload is not None):
+                return payload
+            if (onFallback is not None):
+                onFallback(self)
 
-    def send(self, sock):
         objToSend = self.toObj()
         objToSend['className'] = self.__class__.__name__
-        Communication.sendObject(sock, objToSend)
+        if (self.seq is not None):
+            objToSend['seq'] = self.seq
+        return Communication.encodeObject(objToSend)
+
+    def encodeStruct(self):
+        cls = self.__class__
+        if (cls._structLayout is None):
+            return None
+
+        packer, fixedFields, strFields = cls._structLayout
+        try:
+            if (self.seq is None):
+                payload = packer.pack(cls.commandID, *cls._getFixed(self))
+            else:
+                payload = cls._seqPacker.pack(
+                    cls.commandID | Command.seqFlag, self.seq, *cls._getFixed(self))
+            for f in strFields:
+                raw = getattr(self, f).encode()
+                payload += struct.pack('>B', len(raw)) + raw
+        except (struct.error, AttributeError):
+            return None
+
+        return payload
+
+    #
+    # Do NOT override this function.
+    #
+    # Serialize only the fields of this command that differ from the given
+    # DeltaState, unless a keyframe is due. Then remember this command's fields.
+    #
+    # A JSON delta frame is the usual object with only the changed fields
+    # and 'delta' set. A struct delta frame is the command id with deltaFlag set,
+    # the sequence number (if any), a two-byte mask of the fields present,
+    # then those fields.
+    #
+
+    def encodeDelta(self, codec, delta, onFallback=None):
+        cls = self.__class__
+        values = self.toTuple()
+
+        if (delta.keyframeDue() or len(cls.allFields) > 16):
+            payload = self.encode(codec, onFallback)
+            delta.framesSinceKeyframe = 0
+        else:
+            mask = 0
+            changed = {}
+            for i, (f, v) in enumerate(zip(cls.allFields, values)):
+                if (f not in delta.fields or delta.fields[f] != v):
+                    mask |= 1 << i
+                    changed[f] = v
+
+            payload = None
+            if (codec == Codec.STRUCT):
+                payload = self.encodeStructDelta(mask, changed)
+                if (payload is None and onFallback is not None):
+                    onFallback(self)
+            if (payload is None):
+                changed['className'] = cls.__name__
+                changed['delta'] = True
+                if (self.seq is not None):
+                    changed['seq'] = self.seq
+                payload = Communication.encodeObject(changed)
+            delta.framesSinceKeyframe += 1
+
+        delta.fields.update(zip(cls.allFields, values))
+        return payload
+
+    def encodeStructDelta(self, mask, changed):
+        cls = self.__class__
+        if (cls._structLayout is None):
+            return None
+
+        packer, fixedFields, strFields = cls.deltaLayout(mask)
+        try:
+            if (self.seq is None):
+                payload = struct.pack('>BH', cls.commandID | Command.deltaFlag, mask)
+            else:
+                payload = struct.pack('>BIH', cls.commandID | Command.deltaFlag | Command.seqFlag,
+                                      self.seq, mask)
+            payload += packer.pack(*[changed[f] for f in fixedFields])
+            for f in strFields:
+                raw = changed[f].encode()
+                payload += struct.pack('>B', len(raw)) + raw
+        except (struct.error, AttributeError):
+            return None
+
+        return payload
+
+    #
+    # Do NOT override this function.
+    #
+    # Send the object representing this command over a socket.
+    # Pass the connection's DeltaState to only send what changed.
+    #
+
+    def send(self, sock, codec=Codec.JSON, delta=None, onFallback=None):
+        if (delta is None):
+            payload = self.encode(codec, onFallback)
+        else:
+            payload = self.encodeDelta(codec, delta, onFallback)
+        Communication.sendFrame(sock, payload)
 
     #
     # Do NOT override this function.
     #
-    # Get an instance of the Command represented by the given object.
+    # Get an instance of the Command represented by the given frame.
+    # Both codecs are always accepted; the first byte says which one was used.
+    #
+    # If the connection uses delta-encoded acks, pass its DeltaState:
+    # fields a delta frame leaves out are filled in from it,
+    # and it is updated with every Command decoded.
     #
 
     @staticmethod
-    def recv(sock):
-        obj = Communication.recvObject(sock)
+    def decode(payload, delta=None):
+        command = Command.decodeFrame(payload, delta)
+        if (delta is not None):
+            delta.remember(command)
+        return command
+
+    @staticmethod
+    def decodeFrame(payload, delta):
+        if (len(payload) == 0):
+            raise Exception('Received frame was empty')
+
+        if (payload[0] != Communication.jsonMarker):
+            return Command.decodeStruct(payload, delta)
+
+        obj = Communication.decodeObject(payload)
         # print('Command.recv(%s)' % obj)
 
         if (obj == None):
@@ -116,32 +542,184 @@ class Command():
         if ('className' not in obj):
             raise Exception('Received object has no className field: %s' % obj)
 
-        commandClass = eval(obj['className'])
-        if (not issubclass(commandClass, Command) or commandClass == Command):
+        commandClass = Command.registry.get(obj['className'])
+        if (commandClass is None):
             raise Exception(
                 'Class must be subclass of Command, and not Command itself: %s' % obj)
 
+        if (obj.get('delta', False)):
+            command = Command.fillFromDelta(commandClass, obj, delta)
+            command.seq = obj.get('seq')
+            return command
+
         # fromObj() is abstract, so it must be implemented
         return commandClass.fromObj(commandClass, obj)
 
+    @staticmethod
+    def decodeStruct(payload, delta=None):
+        commandID = payload[0] & ~(Command.deltaFlag | Command.seqFlag)
+        commandClass = commandsByID.get(commandID)
+        if (commandClass is None):
+            raise Exception('Received frame has unknown command id: %d' % commandID)
+
+        if (commandClass._structLayout is None):
+            raise Exception('Command cannot be struct-encoded: %s' % commandClass.__name__)
+
+        if (payload[0] & Command.deltaFlag):
+            return Command.decodeStructDelta(commandClass, payload, delta)
+
+        packer, fixedFields, strFields = commandClass._structLayout
+        command = commandClass.__new__(commandClass)
+
+        # values[0] is the command id, then maybe the sequence number
+        if (payload[0] & Command.seqFlag):
+            packer = commandClass._seqPacker
+            values = packer.unpack_from(payload, 0)
+            command.seq = values[1]
+            commandClass._setFixed(command, values[2:])
+        else:
+            values = packer.unpack_from(payload, 0)
+            command.seq = None
+            commandClass._setFixed(command, values[1:])
+
+        offset = packer.size
+        for f in strFields:
+            length = payload[offset]
+            offset += 1
+            setattr(command, f, bytes(payload[offset:offset + length]).decode('utf-8'))
+            offset += length
+
+        return command
+
+    @staticmethod
+    def decodeStructDelta(commandClass, payload, delta):
+        seq = None
+        offset = 1
+        if (payload[0] & Command.seqFlag):
+            seq = struct.unpack_from(Command.seqByteRep, payload, offset)[0]
+            offset += 4
+
+        mask = struct.unpack_from('>H', payload, offset)[0]
+        offset += 2
+        packer, fixedFields, strFields = commandClass.deltaLayout(mask)
+
+        obj = dict(zip(fixedFields, packer.unpack_from(payload, offset)))
+
+        offset += packer.size
+        for f in strFields:
+            length = payload[offset]
+            offset += 1
+            obj[f] = bytes(payload[offset:offset + length]).decode('utf-8')
+            offset += length
+
+        command = Command.fillFromDelta(commandClass, obj, delta)
+        command.seq = seq
+        return command
+
+    #
+    # Rebuild the full Command of a delta frame from the last known state
+    #
+
+    @staticmethod
+    def fillFromDelta(commandClass, obj, delta):
+        if (delta is None):
+            raise Exception('Received a delta frame on a connection not using delta acks: %s' % obj)
+
+        last = delta.fields
+        try:
+            values = tuple([obj[f] if f in obj else last[f] for f in commandClass.allFields])
+        except KeyError as e:
+            raise Exception('Delta frame left out a field that was never sent: %s' % e)
+
+        return commandClass.fromTuple(values)
+
+    #
+    # Do NOT override this function.
+    #
+    # Receive one frame from a socket (or a FrameReader) and decode it.
+    #
+
+    @staticmethod
+    def recv(sock, delta=None):
+        return Command.decode(Communication.recvFrame(sock), delta)
+
 
 # SERVER COMMANDS BELOW
 
 # Server: Acknowledge the initialization request of the Client
 class InitAck(Command):
+    commandID = 1
     fields = [
         
     ]
+    optionalFields = {
+        # The codec the vehicle should use from now on (see Codec)
+        'codec': Codec.JSON,
+        # Whether the vehicle may send delta-encoded acks (see DeltaState)
+        'deltaAcks': False,
+        # Whether the connection is pipelined (see pipeline.py):
+        # requests carry a seq, and the vehicle answers with the same seq
+        'pipelined': False,
+        # Seconds between two reports in the vehicle's first state
+        'reportInterval': Command.sleepTime,
+        # Where and with what token to send UDP position reports (see telemetry.py).
+        # An empty token means the vehicle may not.
+        'telemetryToken': '',
+        'telemetryPort': 0,
+        # What to send as the InitRequest's resumeToken, to carry on with this session
+        # after the connection drops. Empty if the session can't be resumed.
+        'resumeToken': ''
+    }
+
+# Server: The base of every request that moves the vehicle to another state.
+# Not sent itself.
+class TransitionRequest(Command):
+    fields = []
+    optionalFields = {
+        # Seconds between two reports in the new state (see ReportCadence)
+        'reportInterval': Command.sleepTime
+    }
+
+# Server: Acknowledge a gateway connection (see gateway.py)
+# From now on, every frame on the connection carries a channel id
+class GatewayAck(Command):
+    commandID = 13
+    fields = []
+
+# Server: Stop wherever you are and wait, e.g. because the server is shutting down.
+# Broadcast to every vehicle (see VehicleServer.broadcast()); not answered.
+class StopAll(Command):
+    commandID = 15
+    fields = []
+
+# Server: The server is at capacity and won't serve this connection (see session_pool.py).
+# Sent (as JSON) instead of an InitAck or GatewayAck, then the connection is closed.
+class ServerBusy(Command):
+    commandID = 35
+    fields = [
+        # Seconds to wait before reconnecting
+        'retryAfter'
+    ]
+
+# Server: Acknowledge a TelemetryBatch, once its samples are persisted
+class TelemetryBatchAck(Command):
+    commandID = 14
+    fields = [
+        # How many samples were persisted
+        'count'
+    ]
 
 # Server: Idle --> Idle
 # No information required because there is no transition
 class IdleRequest(Command):
+    commandID = 2
     fields = []
 
 
 # Server: Idle --> EnrouteToRider
 # Server sends this Command to the Client to transition it from IDLE to ENROUTE_TO_RIDER
-class IdleToEnrouteToRiderRequest(Command):
+class IdleToEnrouteToRiderRequest(TransitionRequest):
+    commandID = 3
     fields = [
         # Server sends the latitude/longitude coordinates of the rider to the vehicle
         'lat', 
@@ -151,7 +729,8 @@ class IdleToEnrouteToRiderRequest(Command):
 # Server: ToRider -> EnrouteToDest
 # Server sends this Command to the Client to transition it from TO_RIDER to ENROUTE_TO_DEST
 # Occurs when confirmPickup is called
-class ToRiderToEnrouteToDestRequest(Command):
+class ToRiderToEnrouteToDestRequest(TransitionRequest):
+    commandID = 4
     fields = [
         # Server sends the latitude/longitude coordinates of the rider to the vehicle
         'lat', 
@@ -161,7 +740,8 @@ class ToRiderToEnrouteToDestRequest(Command):
 # Server: ToDest -> Idle
 # Server sends this Command to the Client to transition it from TO_DEST to IDLE
 # Occurs when confirmArrival is called
-class ToDestToIdle(Command):
+class ToDestToIdle(TransitionRequest):
+    commandID = 5
     fields = [
         # Server sends the latitude/longitude coordinates of the rider to the vehicle
         'lat', 
@@ -171,7 +751,8 @@ class ToDestToIdle(Command):
 # Server: ToRider -> Idle
 # Server sends this Command to the Client to transition it from TO_RIDER to IDLE
 # Occurs when ride is canceled and vehicle is in the first half of its trip (heading towards rider)
-class ToRiderCancel(Command):
+class ToRiderCancel(TransitionRequest):
+    commandID = 6
     fields = [
         # Server sends the latitude/longitude coordinates of the rider to the vehicle
         'lat', 
@@ -181,7 +762,8 @@ class ToRiderCancel(Command):
 # Server: ToDest -> Idle
 # Server sends this Command to the Client to transition it from TO_DEST to IDLE
 # Occurs when ride is canceled and vehicle is in the second half of its trip (heading towards destination)
-class ToDestCancel(Command):
+class ToDestCancel(TransitionRequest):
+    commandID = 7
     fields = [
         # Server sends the latitude/longitude coordinates of the rider to the vehicle
         'lat', 
@@ -190,7 +772,8 @@ class ToDestCancel(Command):
 
 # Server: Idle -> Enroute To Charger
 # Server sends this Command to the Client to transition it from IDLE to ENROUTE_TO_CHARGER
-class IdleToEnrouteToCharger(Command):
+class IdleToEnrouteToCharger(TransitionRequest):
+    commandID = 8
     fields = [
         # Server sends the latitude/longitude coordinates of the charging station to the vehicle
         'lat', 
@@ -200,7 +783,8 @@ class IdleToEnrouteToCharger(Command):
 # Server: Enroute To Charger -> Charging
 # Server sends this Command to the Client to transition it from ENROUTE_TO_CHARGER to CHARGING
 # Occurs when vehicle
-class EnrouteToChargerToCharging(Command):
+class EnrouteToChargerToCharging(TransitionRequest):
+    commandID = 9
     fields = [
         # Server sends the latitude/longitude coordinates of the charging station to the vehicle
         'lat', 
@@ -210,7 +794,8 @@ class EnrouteToChargerToCharging(Command):
 # Server: Charging -> Charging
 # Server sends this Command to the Client to transition it from Charging to CHARGING
 # Occurs when vehicle
-class ChargingToCharging(Command):
+class ChargingToCharging(TransitionRequest):
+    commandID = 10
     fields = [
         # Server sends the latitude/longitude coordinates of the charging station to the vehicle
         'lat', 
@@ -219,7 +804,8 @@ class ChargingToCharging(Command):
 
 # Server: Charging -> Idle
 # Server sends this Command to the Client to transition it from CHARING to IDLE
-class ChargingToIdle(Command):
+class ChargingToIdle(TransitionRequest):
+    commandID = 11
     fields = [
         # Server sends the latitude/longitude coordinates of the charging station to the vehicle
         'lat', 
@@ -231,6 +817,7 @@ class ChargingToIdle(Command):
 # Client: Register with the server
 # To register the vehicle with the Vehicle Server.
 class InitRequest(Command):
+    commandID = 16
     fields = [
         'name',
         'lat',
@@ -242,10 +829,45 @@ class InitRequest(Command):
         'minBatteryLife',
         'mileage'
     ]
+    optionalFields = {
+        # The codecs this vehicle understands (see Codec)
+        'codecs': [Codec.JSON],
+        # How often the vehicle would send a full ack if allowed to send deltas.
+        # 0 means it only sends full acks.
+        'keyframeInterval': 0,
+        # Whether the vehicle can answer requests out of lock-step (see pipeline.py)
+        'pipelining': False,
+        # Whether the vehicle can also send position reports over UDP (see telemetry.py)
+        'udpTelemetry': False,
+        # How many TelemetryBatch frames the vehicle sends right after reading the InitAck
+        'backfill': 0,
+        # The InitAck's resumeToken of the vehicle's last connection, if it dropped (see resumption.py)
+        'resumeToken': ''
+    }
+
+# Client: Open a gateway connection that carries many vehicles (see gateway.py)
+# Sent instead of an InitRequest, as the first frame of the connection
+class GatewayHello(Command):
+    commandID = 33
+    fields = [
+        'name'
+    ]
+
+# Client: The states the vehicle recorded while it couldn't reach the server.
+# Sent right after the InitAck (see InitRequest's 'backfill'); each is answered with a TelemetryBatchAck.
+class TelemetryBatch(Command):
+    commandID = 34
+    fields = [
+        'name',
+        # Oldest first. Each sample is [t, lat, lon, status],
+        # where status is as in VehicleDBUtil.updateStatus()
+        'samples'
+    ]
 
 # Client: Idle --> Idle
 # Client sends this Command to the Server while it is spinning in the IDLE state
 class IdleAck(Command):
+    commandID = 17
     fields = [
         'name',
         'lat',
@@ -261,6 +883,7 @@ class IdleAck(Command):
 # Client: Idle --> EnrouteToRider
 # Client sends this Command to the Server when it transitions from the IDLE state to the ENROUTE_TO_RIDER state
 class IdleToEnrouteToRiderAck(Command):
+    commandID = 18
     fields = [
         'name',
         'lat',
@@ -276,6 +899,7 @@ class IdleToEnrouteToRiderAck(Command):
 # Client: EnrouteToRider -> EnrouteToRider
 # Client sends this Command to the Server while it is spinning in the ENROUTE_TO_RIDER state
 class EnrouteToRiderAck(Command):
+    commandID = 19
     fields = [
         'name',
         'lat',
@@ -292,6 +916,7 @@ class EnrouteToRiderAck(Command):
 # Client: EnrouteToRider -> ToRider
 # Client sends this Command to the Server when it transitions from the ENROUTE_TO_RIDER state to the TO_RIDER state
 class EnrouteToRiderToToRiderAck(Command):
+    commandID = 20
     fields = [
         'name',
         'lat',
@@ -307,6 +932,7 @@ class EnrouteToRiderToToRiderAck(Command):
 # Client: ToRider -> EnrouteToDest
 # Client sends this Command to the Server when it transitions from the TO_RIDER state to the ENROUTE_TO_DEST state
 class ToRiderToEnrouteToDestAck(Command):
+    commandID = 21
     fields = [
         'name',
         'lat',
@@ -322,6 +948,7 @@ class ToRiderToEnrouteToDestAck(Command):
 # Client: EnrouteToDest -> EnrouteToDest
 # Client sends this Command to the Server while it is spinning in the ENROUTE_TO_DEST state
 class EnrouteToDestAck(Command):
+    commandID = 22
     fields = [
         'name',
         'lat',
@@ -338,6 +965,7 @@ class EnrouteToDestAck(Command):
 # Client: EnrouteToDest -> ToDest
 # Client sends this Command to the Server when it transitions from the ENROUTE_TO_DEST state to the TO_DEST state
 class EnrouteToDestToToDestAck(Command):
+    commandID = 23
     fields = [
         'name',
         'lat',
@@ -353,6 +981,7 @@ class EnrouteToDestToToDestAck(Command):
 # Client: ToDest -> Idle
 # Client sends this Command to the Server when it transitions from the TO_DEST state to the IDLE state
 class ToDestToIdleAck(Command):
+    commandID = 24
     fields = [
         'name',
         'lat',
@@ -368,6 +997,7 @@ class ToDestToIdleAck(Command):
 # Client: ToRider -> Idle
 # Client sends this Command to the Server when it transitions from the TO_RIDER state to the IDLE state
 class ToRiderCancelAck(Command):
+    commandID = 25
     fields = [
         'name',
         'lat',
@@ -383,6 +1013,7 @@ class ToRiderCancelAck(Command):
 # Client: ToDest -> Idle
 # Client sends this Command to the Server when it transitions from the TO_DEST state to the IDLE state
 class ToDestCancelAck(Command):
+    commandID = 26
     fields = [
         'name',
         'lat',
@@ -398,6 +1029,7 @@ class ToDestCancelAck(Command):
 # Client: Idle -> Enroute to Charger
 # Client sends this Command to the Server when it transitions from the IDLE state to the ENROUTE_TO_CHARGER state
 class IdleToEnrouteToChargerAck(Command):
+    commandID = 27
     fields = [
         'name',
         'lat',
@@ -414,6 +1046,7 @@ class IdleToEnrouteToChargerAck(Command):
 # Client: Enroute to Charger -> Charging
 # Client sends this Command to the Server when it transitions from the ENROUTE_TO_CHARGER state to the CHARGING state
 class EnrouteToChargerToChargingAck(Command):
+    commandID = 28
     fields = [
         'name',
         'lat',
@@ -430,6 +1063,7 @@ class EnrouteToChargerToChargingAck(Command):
 # Client: Charging -> Idle
 # Client sends this Command to the Server when it transitions from the CHARGING state to the IDLE state
 class ChargingToIdleAck(Command):
+    commandID = 29
     fields = [
         'name',
         'lat',
@@ -446,6 +1080,7 @@ class ChargingToIdleAck(Command):
 # Client: EnrouteToCharger -> EnrouteToCharger
 # Client sends this Command to the Server while it is spinning in the ENROUTE_TO_CHARGER state
 class EnrouteToChargerAck(Command):
+    commandID = 30
     fields = [
         'name',
         'lat',
@@ -462,6 +1097,7 @@ class EnrouteToChargerAck(Command):
 # Client: Charging -> Charging
 # Client sends this Command to the Server while it is spinning in the CHARGING state
 class ChargingAck(Command):
+    commandID = 31
     fields = [
         'name',
         'lat',
@@ -479,6 +1115,7 @@ class ChargingAck(Command):
 # Server to Client.
 #
 class SendRequest(Command):
+    commandID = 12
     fields = [
         'lat',
         'lon'
@@ -489,6 +1126,7 @@ class SendRequest(Command):
 # Client to Server.
 #
 class SendAck(Command):
+    commandID = 32
     fields = [
         'lat',
         'lon'
@@ -502,7 +1140,7 @@ def main():
     print(InitRequest)
     print(type(InitRequest).__name__)
 
-    something = eval('InitRequest')
+    something = Command.registry['InitRequest']
     print(something)
     print(type(something).__name__)
 
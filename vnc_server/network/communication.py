@@ -16,6 +16,14 @@ class Communication(object):
     # How to represent the integer length in bytes
     intByteRep = ">I"
 
+    # Every JSON payload starts with this byte.
+    # Binary (struct) payloads start with a command id, which is always lower,
+    # so the receiver can tell the two apart from the first byte alone.
+    jsonMarker = ord('{')
+
+    # Largest payload a receiver will accept
+    maxFrameSize = 16 * 1024 * 1024
+
     #
     # No constructor because this is for static methods
     #
@@ -24,53 +32,244 @@ class Communication(object):
         pass
 
     #
-    # To send an object, it is:
-    #   1) Serialized to JSON
-    #   2) Converted from that JSON string to an array of bytes
-    #   3) The length of that bytes array is sent (length MUST be 4 bytes wide)
-    #   4) The bytes array itself is sent
+    # To send a frame, it is:
+    #   1) The length of the payload is sent (length MUST be 4 bytes wide)
+    #   2) The payload bytes themselves are sent
+    #
+    # The target can be a socket, or anything with its own sendFrame().
     #
 
     @staticmethod
-    def sendObject(sock, obj):
-        # Get the JSON string then bytes array
-        objJSON = json.dumps(obj)
-        # print(objJSON)
-        objJSONBytes = objJSON.encode()
+    def sendFrame(sock, payload):
+        if (hasattr(sock, 'sendFrame')):
+            sock.sendFrame(payload)
+            return
+
+        Communication.sendFrameParts(sock, [payload])
+
+    #
+    # Send one frame whose payload is the given parts, one after the other,
+    # without concatenating them first.
+    #
 
+    @staticmethod
+    def sendFrameParts(sock, parts):
         # Get the length of the bytes array, then represent that as bytes too
-        objJSONBytesLength = len(objJSONBytes)
-        lengthBytes = struct.pack(Communication.intByteRep, objJSONBytesLength)
+        payloadLength = sum(len(p) for p in parts)
+        lengthBytes = struct.pack(Communication.intByteRep, payloadLength)
 
         # The number of bytes of the object must be represented with and exact number of bytes
         if (len(lengthBytes) != Communication.msgSizeLen):
             raise Exception('Serialized object bytes length length != %d; was %s' % (
                 Communication.msgSizeLen, len(lengthBytes)))
 
-        # Send the size of the object then the object itself
-        # (in one sendall() to be slightly more efficient)
-        sock.sendall(lengthBytes + objJSONBytes)
+        buffers = [lengthBytes] + list(parts)
+
+        # No scatter/gather I/O on this platform (e.g. Windows)
+        if (not hasattr(sock, 'sendmsg')):
+            sock.sendall(b''.join(buffers))
+            return
+
+        # Send the size of the object then the object itself in one system call
+        sent = sock.sendmsg(buffers)
+
+        # sendmsg() may send only part of the frame, so finish it off
+        if (sent < len(lengthBytes) + payloadLength):
+            for b in buffers:
+                if (sent >= len(b)):
+                    sent -= len(b)
+                    continue
+                sock.sendall(memoryview(b)[sent:])
+                sent = 0
 
     #
-    # To receive an object, it:
-    #   1) Receives the bytes representin the length of the bytes array
+    # To receive a frame, it:
+    #   1) Receives the bytes representin the length of the payload
     #   2) Converts that to an integer
-    #   3) Receives that many bytes (the whole object)
-    #   4) Decodes that to a JSON string
-    #   5) Deserializes that JSON string to an object
+    #   3) Receives that many bytes (the whole payload)
+    #
+    # The source can be a socket, or anything with its own recvFrame()
+    # (e.g. a FrameReader, which should be preferred for long-lived connections).
     #
 
     @staticmethod
-    def recvObject(sock):
+    def recvFrame(sock):
+        if (hasattr(sock, 'recvFrame')):
+            return sock.recvFrame()
+
         # Get the length of the object
-        # MSG_WAITALL is like how sendall guarantees to send all data
-        lengthBytes = sock.recv(Communication.msgSizeLen, socket.MSG_WAITALL)
-        objJSONBytesLength = struct.unpack(
+        lengthBytes = Communication.recvExactly(sock, Communication.msgSizeLen, True)
+        payloadLength = struct.unpack(
             Communication.intByteRep, lengthBytes)[0]
+        Communication.checkFrameLength(payloadLength)
+
+        # Now get the payload itself
+        return Communication.recvExactly(sock, payloadLength, False)
+
+    #
+    # Receive exactly n bytes.
+    # MSG_WAITALL is like how sendall guarantees to send all data,
+    # but it can still come back short (e.g. on a signal), so loop until done.
+    #
+
+    @staticmethod
+    def recvExactly(sock, n, atFrameStart):
+        buf = bytearray(n)
+        view = memoryview(buf)
+        received = 0
+        while (received < n):
+            nRecv = sock.recv_into(view[received:], n - received, socket.MSG_WAITALL)
+            if (nRecv == 0):
+                Communication.raiseClosed(atFrameStart and received == 0)
+            received += nRecv
+
+        return buf
+
+    @staticmethod
+    def raiseClosed(atFrameStart):
+        if (atFrameStart):
+            raise ConnectionError('Peer closed the connection')
+        raise ConnectionError('Peer closed the connection mid-frame')
+
+    #
+    # A corrupt length would otherwise make the receiver wait for (and allocate) gigabytes
+    #
+
+    @staticmethod
+    def checkFrameLength(payloadLength):
+        if (payloadLength > Communication.maxFrameSize):
+            raise Exception('Frame of %d bytes is larger than the maximum of %d' % (
+                payloadLength, Communication.maxFrameSize))
+
+    #
+    # Serialize an object to the bytes of its JSON string
+    #
+
+    @staticmethod
+    def encodeObject(obj):
+        return json.dumps(obj).encode()
+
+    #
+    # Deserialize the bytes of a JSON string to an object
+    # (json.loads() takes the UTF-8 bytes directly, no need to decode to str,
+    # but it won't take a memoryview, so that one copy is unavoidable)
+    #
+
+    @staticmethod
+    def decodeObject(payload):
+        if (isinstance(payload, memoryview)):
+            payload = payload.tobytes()
+        return json.loads(payload)
+
+    #
+    # To send an object, it is:
+    #   1) Serialized to JSON
+    #   2) Converted from that JSON string to an array of bytes
+    #   3) Sent as one frame
+    #
+
+    @staticmethod
+    def sendObject(sock, obj):
+        Communication.sendFrame(sock, Communication.encodeObject(obj))
+
+    #
+    # To receive an object, it:
+    #   1) Receives one frame
+    #   2) Deserializes that JSON to an object
+    #
+
+    @staticmethod
+    def recvObject(sock):
+        return Communication.decodeObject(Communication.recvFrame(sock))
+
+
+class FrameReader(object):
+    """
+    Reads the frames of one connection (see Communication.recvFrame()).
+
+    Each recv_into() fills as much of one reusable buffer as the socket has
+    ready, so several frames can come out of one read,
+    and a frame is handed out as a memoryview slice of that buffer rather than
+    as a fresh bytes object.
+
+    The memoryview returned by recvFrame() is only valid until the next call.
+    """
+
+    # Starting size of the buffer. It grows to fit the largest frame seen.
+    initialSize = 4096
+
+    def __init__(self, sock, size=initialSize):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+
+        # Received bytes that haven't been handed out yet are buf[start:end]
+        self.start = 0
+        self.end = 0
+
+        # The last frame handed out
+        self.frame = None
+
+    def recvFrame(self):
+        self.releaseFrame()
+
+        headerLen = Communication.msgSizeLen
+        self.fill(headerLen)
+        payloadLength = struct.unpack_from(Communication.intByteRep, self.buf, self.start)[0]
+        Communication.checkFrameLength(payloadLength)
+
+        self.fill(headerLen + payloadLength)
+        begin = self.start + headerLen
+        self.start = begin + payloadLength
+
+        self.frame = self.view[begin:self.start]
+        return self.frame
+
+    def releaseFrame(self):
+        if (self.frame is not None):
+            self.frame.release()
+            self.frame = None
+
+    #
+    # Make sure at least n unread bytes are in the buffer,
+    # reading from the socket as needed.
+    #
+
+    def fill(self, n):
+        if (self.end - self.start >= n):
+            return
+
+        # Everything has been handed out, so start over at the front for free
+        if (self.start == self.end):
+            self.start = 0
+            self.end = 0
+
+        if (self.start + n > len(self.buf)):
+            self.makeRoom(n)
+
+        while (self.end - self.start < n):
+            nRecv = self.sock.recv_into(self.view[self.end:])
+            if (nRecv == 0):
+                Communication.raiseClosed(self.end == self.start)
+            self.end += nRecv
+
+    #
+    # Move the unread bytes to the front of the buffer,
+    # growing it if even that isn't enough for n bytes.
+    #
+
+    def makeRoom(self, n):
+        unread = self.end - self.start
 
-        # Now get the object itself
-        objJSONBytes = sock.recv(objJSONBytesLength, socket.MSG_WAITALL)
-        objJSON = objJSONBytes.decode('utf-8')
-        obj = json.loads(objJSON)
+        if (n <= len(self.buf)):
+            # Copy out first, since the two ranges may overlap
+            self.buf[0:unread] = self.view[self.start:self.end].tobytes()
+        else:
+            newBuf = bytearray(max(n, 2 * len(self.buf)))
+            newBuf[0:unread] = self.view[self.start:self.end]
+            self.view.release()
+            self.buf = newBuf
+            self.view = memoryview(self.buf)
 
-        return obj
+        self.start = 0
+        self.end = unread
@@ -0,0 +1,226 @@
+#
+# Write-behind ingestion of the CoordHistory table.
+#
+# Every session reports its vehicle's position and status on each tick, and
+# each report is a row of CoordHistory. Rather than insert and commit each one
+# on the session's thread, sessions add them to the CoordHistoryBuffer, and
+# its flusher thread inserts them many rows at a time: as soon as batchSize
+# rows are waiting, or flushInterval seconds after the last flush.
+#
+# Adding a row never waits on the database. The buffer holds at most maxRows;
+# once full, each new row drops the oldest one (a newer position of a vehicle
+# is worth more than an older one). A batch that fails to insert is put back
+# in front of the newer rows, as long as there is room.
+#
+# On shutdown, close() stops the flusher and inserts what is still waiting,
+# since the flusher is a daemon thread and would take those rows with it.
+#
+# A row whose vehicle and time (t, the table's key) are already in the table
+# updates that row, as VehicleDBUtil.updateStatus() does.
+#
+
+import threading
+import time
+from collections import deque
+
+# Hacky work-around to be able to import from a folder above this one.
+import sys
+import os
+
+sys.path.append(os.path.abspath('../databases'))
+from sqldb import SQLDB
+
+import logging
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(formatter)
+logging_path = os.path.dirname(os.path.realpath(__file__)).split("src/")[0] + "src/server_log"
+fh = logging.FileHandler(logging_path)
+fh.setLevel(logging.DEBUG)
+fh.setFormatter(formatter)
+logger.addHandler(ch)
+logger.addHandler(fh)
+logger.setLevel(logging.DEBUG)
+
+
+class CoordHistoryBuffer(object):
+    """
+    The CoordHistory rows not inserted yet, oldest first.
+    """
+
+    cols = ['vehicleName', 't', 'lat', 'lon', 'status']
+
+    # Rows per multi-row insert; a flush starts as soon as this many are waiting
+    batchSize = 500
+
+    # Seconds between flushes, at most
+    flushInterval = 1.0
+
+    # Rows the buffer holds at most, before it drops the oldest
+    maxRows = 50000
+
+    # Flushes close() runs at most, to insert the rows still waiting
+    closeAttempts = 3
+
+    def __init__(self):
+        # Each row, with when it was added
+        self.rows = deque()
+
+        self.cond = threading.Condition()
+
+        # Only used by the flusher thread (and by close(), once it stopped)
+        self.db = None
+
+        self.thread = None
+        self.closing = threading.Event()
+
+        # Metrics
+        self.added = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.flushTotal = 0.0
+        self.flushMax = 0.0
+        self.lagMax = 0.0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.flushForever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Stops the flusher thread, and inserts the rows still waiting
+
+        Gives up after closeAttempts flushes, counting the rows left as dropped.
+
+        :return: whether every row was inserted
+        :rtype: bool
+        """
+        with self.cond:
+            self.closing.set()
+            self.cond.notify()
+
+        if (self.thread is not None):
+            self.thread.join()
+
+        for attempt in range(CoordHistoryBuffer.closeAttempts):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f"EXCEPTION while flushing the coordinate history: {e}")
+
+            with self.cond:
+                if (len(self.rows) == 0):
+                    return True
+
+        with self.cond:
+            logger.error(f"Dropped {len(self.rows)} rows of CoordHistory on close")
+            self.dropped += len(self.rows)
+            self.rows.clear()
+        return False
+
+    #
+    # Queue a row of CoordHistory, as VehicleDBUtil.updateStatus() would have inserted it
+    #
+
+    def add(self, vName, status, t, lat, lon):
+        with self.cond:
+            if (len(self.rows) >= CoordHistoryBuffer.maxRows):
+                self.rows.popleft()
+                self.dropped += 1
+
+            self.rows.append(((vName, t, lat, lon, status), time.time()))
+            self.added += 1
+
+            if (len(self.rows) == CoordHistoryBuffer.batchSize):
+                self.cond.notify()
+
+    def flushForever(self):
+        while True:
+            with self.cond:
+                if (len(self.rows) < CoordHistoryBuffer.batchSize and not self.closing.is_set()):
+                    self.cond.wait(CoordHistoryBuffer.flushInterval)
+
+            # close() flushes what is left
+            if (self.closing.is_set()):
+                return
+
+            try:
+                if (self.flush()):
+                    continue
+            except Exception as e:
+                logger.exception(f"EXCEPTION while flushing the coordinate history: {e}")
+
+            # Don't retry right away, even if enough rows wait for a batch
+            self.closing.wait(CoordHistoryBuffer.flushInterval)
+
+    #
+    # Insert every waiting row, batchSize at a time. False if a batch failed.
+    #
+
+    def flush(self):
+        with self.cond:
+            rows, self.rows = self.rows, deque()
+
+        if (len(rows) == 0):
+            return True
+
+        if (self.db is None):
+            self.db = SQLDB()
+
+        rows = list(rows)
+        for i in range(0, len(rows), CoordHistoryBuffer.batchSize):
+            batch = rows[i:i + CoordHistoryBuffer.batchSize]
+
+            start = time.time()
+            response = self.db.upsertMany('CoordHistory', CoordHistoryBuffer.cols,
+                                          [row for row, added in batch], ['lat', 'lon', 'status'])
+            end = time.time()
+
+            with self.cond:
+                self.flushes += 1
+                self.flushTotal += end - start
+                self.flushMax = max(self.flushMax, end - start)
+
+                if (response.success):
+                    self.written += len(batch)
+                    self.lagMax = max(self.lagMax, end - batch[0][1])
+                    continue
+
+                logger.error(f"Failed to insert {len(batch)} rows into CoordHistory: {response.message}")
+                self.requeueLocked(rows[i:])
+                return False
+
+        return True
+
+    #
+    # Put rows that failed to insert back in front of the ones added since, as far as there is room
+    #
+
+    def requeueLocked(self, rows):
+        room = max(CoordHistoryBuffer.maxRows - len(self.rows), 0)
+        kept = rows[len(rows) - room:] if room < len(rows) else rows
+        self.dropped += len(rows) - len(kept)
+
+        self.rows.extendleft(reversed(kept))
+
+    def stats(self):
+        """Returns the metrics of the buffer
+
+        :return: 'queued' (rows now), and 'added', 'written' and 'dropped' (rows) and 'flushes' so far,
+            with the seconds each insert took ('flushLatencyAvg', 'flushLatencyMax'), and the most
+            seconds a row waited before it was inserted ('flushLagMax')
+        :rtype: dict
+        """
+        with self.cond:
+            return {
+                'queued': len(self.rows),
+                'added': self.added,
+                'written': self.written,
+                'dropped': self.dropped,
+                'flushes': self.flushes,
+                'flushLatencyAvg': self.flushTotal / self.flushes if self.flushes else 0.0,
+                'flushLatencyMax': self.flushMax,
+                'flushLagMax': self.lagMax
+            }
@@ -0,0 +1,250 @@
+#
+# Matching rides to idle vehicles.
+#
+# Sessions don't ask for a ride on every tick. Instead, an idle session
+# registers with the dispatcher once, and the dispatcher matches rides
+# to the idle vehicles only when something changes: a ride is added,
+# or a vehicle becomes idle. A match is pushed to the vehicle's session
+# (see GoodStrategy.assign()), which wakes up and takes it.
+#
+
+from collections import OrderedDict
+import threading
+import time
+
+import logging
+import os
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(formatter)
+logging_path = os.path.dirname(os.path.realpath(__file__)).split("src/")[0] + "src/server_log"
+fh = logging.FileHandler(logging_path)
+fh.setLevel(logging.DEBUG)
+fh.setFormatter(formatter)
+logger.addHandler(ch)
+logger.addHandler(fh)
+logger.setLevel(logging.DEBUG)
+
+
+class MeteredLock(object):
+    """
+    A lock (used with 'with') that keeps track of how long it was waited for, and held.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        self.acquisitions = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+        self.holdTotal = 0.0
+        self.holdMax = 0.0
+        self.acquiredAt = None
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquiredAt = time.perf_counter()
+
+        wait = self.acquiredAt - start
+        self.acquisitions += 1
+        self.waitTotal += wait
+        self.waitMax = max(self.waitMax, wait)
+        return self
+
+    def __exit__(self, *exc):
+        hold = time.perf_counter() - self.acquiredAt
+        self.holdTotal += hold
+        self.holdMax = max(self.holdMax, hold)
+        self.lock.release()
+
+    def stats(self):
+        """Returns the lock's metrics so far, in seconds
+
+        :return: 'acquisitions', and the average and longest 'lockWait' and 'lockHold'
+        :rtype: dict
+        """
+        # Read without the lock, so a long hold doesn't hold this up too
+        n = self.acquisitions
+        return {
+            'acquisitions': n,
+            'lockWaitAvg': self.waitTotal / n if n else 0.0,
+            'lockWaitMax': self.waitMax,
+            'lockHoldAvg': self.holdTotal / n if n else 0.0,
+            'lockHoldMax': self.holdMax
+        }
+
+
+class RideDispatcher(object):
+    """
+    The queue of rides waiting for a vehicle, and the set of idle vehicles waiting for a ride.
+
+    Matching is done by one VehicleSelectorStrategy (see vehicle_util.py),
+    kept for the lifetime of the dispatcher, for each idle vehicle in the
+    order they became idle, until either side runs out.
+    The selector gets the vehicles' locations from fleet (a FleetRegistry), if given.
+
+    Its lock is only held to change the queue and the idle set, and to take a
+    snapshot of them. The selector (which may read the Vehicles table, or ask
+    Google for directions) works on the snapshot, without the lock; ride rows
+    are written and read without it too (see VehicleServer.addRide()).
+    """
+
+    def __init__(self, selector, fleet=None):
+        self.selector = selector
+        self.fleet = fleet
+
+        # Rides not yet matched, oldest first
+        self.rides = []
+
+        # Map from vehicle name to its session, in the order they became idle
+        self.idle = OrderedDict()
+
+        self.lock = MeteredLock()
+
+        # Only one thread matches at a time (see match()); the others ask it to match again
+        self.matchLock = threading.Lock()
+        self.rematch = False
+
+    def addRide(self, ride):
+        with self.lock:
+            self.rides.append(ride)
+        self.match()
+
+    #
+    # Queue many rides at once (e.g. reloaded on startup), in the given order
+    #
+
+    def addRides(self, rides):
+        with self.lock:
+            self.rides.extend(rides)
+        self.match()
+
+    #
+    # A ride was matched, but its vehicle never took it (e.g. it disconnected).
+    # It goes back to the front of the queue.
+    #
+
+    def requeue(self, ride):
+        with self.lock:
+            self.rides.insert(0, ride)
+        self.match()
+
+    #
+    # The ride was canceled before it got a vehicle
+    #
+
+    def removeRide(self, rideID):
+        with self.lock:
+            self.rides = [r for r in self.rides if str(r.getRideID()) != str(rideID)]
+        self.selector.forget(rideID)
+
+    #
+    # The vehicle vName (served by session) is idle and waiting for a ride.
+    # If one is waiting too, session.assign() is called, by this thread
+    # or by the one already matching.
+    #
+
+    def vehicleIdle(self, vName, session):
+        with self.lock:
+            self.idle[vName] = session
+        self.match()
+
+    #
+    # The vehicle can't take rides anymore (e.g. it disconnected)
+    #
+
+    def removeVehicle(self, vName, session):
+        with self.lock:
+            # A reconnected vehicle may already have a newer session
+            if (self.idle.get(vName) is session):
+                del self.idle[vName]
+
+    def stats(self):
+        """Returns the metrics of the ride queue
+
+        :return: 'queuedRides' and 'idleVehicles' (now), and the metrics of the lock (see :func:`MeteredLock.stats`)
+        :rtype: dict
+        """
+        with self.lock:
+            stats = {
+                'queuedRides': len(self.rides),
+                'idleVehicles': len(self.idle)
+            }
+        stats.update(self.lock.stats())
+        return stats
+
+    #
+    # Match waiting rides to idle vehicles. Don't hold the lock.
+    #
+    # One thread matches at a time: if another one already is, it matches
+    # again once it is done (with what changed since), and this returns.
+    #
+
+    def match(self):
+        with self.lock:
+            self.rematch = True
+
+        while True:
+            if (not self.matchLock.acquire(blocking=False)):
+                return
+
+            try:
+                while True:
+                    with self.lock:
+                        if (not self.rematch):
+                            break
+                        self.rematch = False
+                    self.matchSnapshot()
+            finally:
+                self.matchLock.release()
+
+            # Asked again between the last check and the release
+            with self.lock:
+                if (not self.rematch):
+                    return
+
+    #
+    # Run the selector on a snapshot of the queue and the idle vehicles, then hand out
+    # each match that is still good: its ride still queued, and its vehicle still idle.
+    # Only called with the matchLock.
+    #
+
+    def matchSnapshot(self):
+        with self.lock:
+            rides = list(self.rides)
+            idle = list(self.idle.items())
+
+        for vName, session in idle:
+            if (len(rides) == 0):
+                return
+
+            try:
+                ride = self.selector.selectRide(vName, queue=rides, fleet=self.fleet)
+            except Exception as e:
+                logger.exception(f"EXCEPTION while selecting a ride for vehicle {vName}: {e}")
+                continue
+
+            if (ride is None):
+                continue
+
+            with self.lock:
+                queued = [i for i, r in enumerate(self.rides) if r is ride]
+                stillIdle = self.idle.get(vName) is session
+
+                if (len(queued) > 0 and stillIdle):
+                    del self.rides[queued[0]]
+                    del self.idle[vName]
+                elif (len(queued) > 0):
+                    # The vehicle left; another one may take the ride
+                    self.rematch = True
+
+            if (len(queued) == 0):
+                # Canceled since the snapshot; the selector may have counted it again
+                self.selector.forget(ride.getRideID())
+
+            if (len(queued) > 0 and stillIdle):
+                logger.debug(f"Dispatching {str(ride)} to vehicle {vName}")
+                session.assign(ride)
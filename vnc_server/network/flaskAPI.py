@@ -205,6 +205,113 @@ def getRideVehicle(rideID):
     ride = vs.findVehicle(rideID)
     return Response(json.dumps(ride), mimetype='application/json')
 
+"""
+Get the metrics of the ride queue.
+"""
+@app.route("/metrics/rides", methods=['GET'])
+def getRideQueueMetrics():
+    """Returns the json string with the metrics of the server's ride queue
+
+    The lock times are in seconds. The sample return JSON string will look like:
+
+    {
+        "queuedRides": 3,
+        "idleVehicles": 0,
+        "acquisitions": 5120,
+        "lockWaitAvg": 0.00001,
+        "lockWaitMax": 0.0021,
+        "lockHoldAvg": 0.00002,
+        "lockHoldMax": 0.0009
+    }
+
+    :return: the json string of the ride queue metrics
+    :rtype: str
+    """
+    return Response(json.dumps(vs.getRideQueueStats()), mimetype='application/json')
+
+"""
+Get the metrics of the vehicle sessions.
+"""
+@app.route("/metrics/sessions", methods=['GET'])
+def getSessionMetrics():
+    """Returns the json string with the metrics of the server's vehicle sessions
+
+    The sample return JSON string will look like:
+
+    {
+        "sessions": 812,
+        "queued": 0,
+        "maxSessions": 1000,
+        "admitted": 1540,
+        "rejected": 12,
+        "queueWaitAvg": 0.0004,
+        "queueWaitMax": 0.31,
+        "scheduled": 790,
+        "woken": 48210,
+        "wakeupsPerSlot": 12.5,
+        "parked": 2,
+        "resumed": 31,
+        "expired": 4
+    }
+
+    :return: the json string of the session metrics
+    :rtype: str
+    """
+    return Response(json.dumps(vs.getSessionStats()), mimetype='application/json')
+
+"""
+Get the metrics of the coordinate history ingestion.
+"""
+@app.route("/metrics/coordHistory", methods=['GET'])
+def getCoordHistoryMetrics():
+    """Returns the json string with the metrics of the CoordHistory rows waiting to be inserted
+
+    The latencies are in seconds. The sample return JSON string will look like:
+
+    {
+        "queued": 120,
+        "added": 96200,
+        "written": 96080,
+        "dropped": 0,
+        "flushes": 310,
+        "flushLatencyAvg": 0.004,
+        "flushLatencyMax": 0.09,
+        "flushLagMax": 1.1
+    }
+
+    :return: the json string of the coordinate history metrics
+    :rtype: str
+    """
+    return Response(json.dumps(vs.getCoordHistoryStats()), mimetype='application/json')
+
+"""
+Get the metrics of the database connections.
+"""
+@app.route("/metrics/db", methods=['GET'])
+def getDBMetrics():
+    """Returns the json string with the metrics of the API's pool of MySQL connections, and of its schema cache
+
+    The wait times are in seconds. The sample return JSON string will look like:
+
+    {
+        "size": 6,
+        "idle": 5,
+        "maxSize": 32,
+        "checkouts": 20480,
+        "connects": 6,
+        "timeouts": 0,
+        "healthFailures": 1,
+        "checkoutWaitAvg": 0.00002,
+        "checkoutWaitMax": 0.012,
+        "tables": 4,
+        "reflections": 4
+    }
+
+    :return: the json string of the connection pool metrics
+    :rtype: str
+    """
+    return Response(json.dumps(vs.getDBStats()), mimetype='application/json')
+
 """
 Get information about all locationNodes.
 """
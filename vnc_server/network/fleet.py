@@ -0,0 +1,213 @@
+#
+# The current state of the fleet, in memory.
+#
+# Every session reports its vehicle's position and status on each tick. Those
+# go to the FleetRegistry, which the API and ride matching read instead of the
+# Vehicles table. A flusher thread writes the vehicles that changed to the
+# Vehicles table every flushInterval seconds, in batches, so the table is at
+# most that far behind. On shutdown, close() stops the flusher and writes what
+# changed since its last flush.
+#
+# Each process holding vehicle sessions has its own registry. A broker (see
+# broker.py) holds none, and reads the Vehicles table instead.
+#
+
+import threading
+
+# Hacky work-around to be able to import from a folder above this one.
+import sys
+import os
+
+sys.path.append(os.path.abspath('../databases'))
+from sqldb import SQLDB
+
+import logging
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(formatter)
+logging_path = os.path.dirname(os.path.realpath(__file__)).split("src/")[0] + "src/server_log"
+fh = logging.FileHandler(logging_path)
+fh.setLevel(logging.DEBUG)
+fh.setFormatter(formatter)
+logger.addHandler(ch)
+logger.addHandler(fh)
+logger.setLevel(logging.DEBUG)
+
+
+class FleetRegistry(object):
+    """
+    The connected vehicles, by name, each as a dict of its Vehicles columns
+    ('name', 'status', 'lat', 'lon', 'batteryLife', 'curRideID', 'mileage'),
+    those known so far.
+    """
+
+    # Seconds between writes of the changed vehicles to the Vehicles table
+    flushInterval = 1.0
+
+    def __init__(self):
+        self.vehicles = {}
+
+        # Map from vehicle name to its columns changed since the last flush
+        self.dirty = {}
+
+        self.lock = threading.Lock()
+
+        # Only used by the flusher thread (and by close(), once it stopped)
+        self.db = None
+
+        self.thread = None
+        self.closing = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.flushForever, daemon=True)
+        self.thread.start()
+
+    #
+    # Stop the flusher thread, and write the vehicles that changed since its last flush
+    #
+
+    def close(self):
+        self.closing.set()
+        if (self.thread is not None):
+            self.thread.join()
+
+        self.flush()
+
+        with self.lock:
+            if (len(self.dirty) > 0):
+                logger.error(f"Failed to write {len(self.dirty)} vehicles to the Vehicles table on close")
+
+    #
+    # The vehicle connected, in the given status (a new session starts out WAITING).
+    # VehicleDBUtil.registerVehicle() already wrote the rest to the table; the status is flushed.
+    #
+
+    def register(self, vName, lat, lon, batteryLife, status):
+        with self.lock:
+            self.vehicles[vName] = {
+                'name': vName,
+                'status': status,
+                'lat': lat,
+                'lon': lon,
+                'batteryLife': batteryLife
+            }
+            self.dirty[vName] = {'status': status}
+
+    #
+    # Set some of the vehicle's columns (e.g. {'lat', 'lon', 'status'})
+    #
+
+    def update(self, vName, attrs):
+        with self.lock:
+            vehicle = self.vehicles.get(vName)
+            if (vehicle is None):
+                vehicle = self.vehicles[vName] = {'name': vName}
+            vehicle.update(attrs)
+
+            self.dirty.setdefault(vName, {}).update(attrs)
+
+    #
+    # The vehicle disconnected: write what the table is missing, and forget it.
+    # db is the caller's, so this doesn't wait for the flusher.
+    #
+
+    def remove(self, vName, db):
+        with self.lock:
+            self.vehicles.pop(vName, None)
+            changes = self.dirty.pop(vName, None)
+
+        if (changes):
+            FleetRegistry.write(db, {vName: changes})
+
+    def getVehicles(self, waitingOnly=True):
+        """Returns the name, status, lat and lon of each vehicle, like :func:`vehicle_util.VehicleDBUtil.getVehiclesLite`
+
+        :param waitingOnly: whether to only include the vehicles waiting for a ride. Defaults to True
+        :type waitingOnly: bool
+        :return: the tuple of vehicles
+        :rtype: Tuple[dict]
+        """
+        with self.lock:
+            return tuple({
+                'name': v['name'],
+                'status': v.get('status'),
+                'lat': v.get('lat'),
+                'lon': v.get('lon')
+            } for v in self.vehicles.values() if (not waitingOnly or v.get('status') == 'WAITING'))
+
+    #
+    # The (lat, lon) of a vehicle, or None if it isn't connected here
+    #
+
+    def getLocation(self, vName):
+        with self.lock:
+            vehicle = self.vehicles.get(vName)
+            if (vehicle is None or vehicle.get('lat') is None):
+                return None
+            return vehicle['lat'], vehicle['lon']
+
+    #
+    # The name, status, lat and lon of the vehicle serving a ride, or None if none here is
+    #
+
+    def getVehicleForRide(self, rideID):
+        with self.lock:
+            for v in self.vehicles.values():
+                if (v.get('curRideID') is not None and str(v['curRideID']) == str(rideID)):
+                    return {
+                        'name': v['name'],
+                        'status': v.get('status'),
+                        'lat': v.get('lat'),
+                        'lon': v.get('lon')
+                    }
+        return None
+
+    def flushForever(self):
+        while (not self.closing.wait(FleetRegistry.flushInterval)):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f"EXCEPTION while flushing the fleet: {e}")
+
+    def flush(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+
+        if (len(dirty) == 0):
+            return
+
+        if (self.db is None):
+            self.db = SQLDB()
+
+        if (FleetRegistry.write(self.db, dirty)):
+            return
+
+        # Try again next time, under anything that changed since
+        with self.lock:
+            for vName, changes in dirty.items():
+                if (vName in self.vehicles):
+                    changes.update(self.dirty.get(vName, {}))
+                    self.dirty[vName] = changes
+
+    #
+    # Write the changed columns of each vehicle ({vName: {column: value}}) to the Vehicles table.
+    # Vehicles that changed the same columns are written together.
+    #
+
+    @staticmethod
+    def write(db, dirty):
+        batches = {}
+        for vName, changes in dirty.items():
+            setCols = tuple(sorted(changes))
+            batches.setdefault(setCols, []).append(tuple(changes[c] for c in setCols) + (vName,))
+
+        wasSuccessful = True
+        for setCols, rows in batches.items():
+            response = db.updateMany('Vehicles', list(setCols), ['name'], rows)
+            if (response.success != True):
+                logger.error(f"Failed to write {len(rows)} vehicles to the Vehicles table: {response.message}")
+                wasSuccessful = False
+
+        return wasSuccessful
@@ -0,0 +1,286 @@
+#
+# Multiplexed gateway connections.
+#
+# A gateway (e.g. a depot gateway or a fleet simulator) carries many vehicles
+# over one TCP connection instead of opening one per vehicle.
+#
+# The gateway opens the connection with a GatewayHello (instead of an InitRequest),
+# and the server answers with a GatewayAck. From then on, the payload of every frame is:
+#   1) A 2-byte channel id, chosen by the gateway, one per vehicle
+#   2) The usual Command payload of that vehicle
+#
+# The first frame on a new channel id starts a vehicle session (it should hold an InitRequest).
+# A frame with a channel id and nothing else closes that channel, in either direction.
+#
+# In the asyncio mode (see async_strategy.py), AsyncGatewayConnection serves the
+# connection, and each of its channels is a coroutine instead of a thread.
+#
+
+import asyncio
+import struct
+import threading
+import queue
+
+from communication import Communication
+from command import GatewayAck
+
+import logging
+import os
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(formatter)
+logging_path = os.path.dirname(os.path.realpath(__file__)).split("src/")[0] + "src/server_log"
+fh = logging.FileHandler(logging_path)
+fh.setLevel(logging.DEBUG)
+fh.setFormatter(formatter)
+logger.addHandler(ch)
+logger.addHandler(fh)
+logger.setLevel(logging.DEBUG)
+
+
+class GatewayConnection(object):
+    """
+    The server end of one gateway connection.
+
+    serve() reads every frame of the connection and hands each one to its
+    channel, starting a vehicle session for each new channel.
+    Sessions send their frames back through the shared socket.
+    """
+
+    # How to represent the channel id in bytes
+    channelByteRep = '>H'
+    channelIDLen = 2
+
+    def __init__(self, sock, reader, hello):
+        self.sock = sock
+        self.reader = reader
+        self.name = hello.name
+
+        # Sessions on different threads share the socket
+        self.sendLock = threading.Lock()
+
+        # Map from channel id to its open GatewayChannel
+        self.channels = {}
+        self.channelsLock = threading.Lock()
+
+        self.closed = False
+
+    #
+    # Run the connection until the gateway goes away.
+    #
+    # startSession is called with each new GatewayChannel,
+    # and should run a vehicle session on it (e.g. VehicleServer.startSession()).
+    #
+
+    def serve(self, startSession):
+        logger.info(f"Gateway {self.name} connected")
+        GatewayAck({}).send(self.sock)
+
+        try:
+            while True:
+                self.onFrame(self.reader.recvFrame(), startSession)
+        except ConnectionError as e:
+            logger.info(f"Gateway {self.name} disconnected: {e}")
+        except Exception as e:
+            logger.exception(f"EXCEPTION on gateway {self.name}: {e}")
+        finally:
+            self.close()
+
+    #
+    # Hand a frame of the connection to its channel, opening (and starting a session on) a new one
+    #
+
+    def onFrame(self, frame, startSession):
+        if (len(frame) < GatewayConnection.channelIDLen):
+            raise Exception('Gateway frame has no channel id')
+
+        channelID = struct.unpack_from(GatewayConnection.channelByteRep, frame, 0)[0]
+
+        # The reader's buffer is reused for the next frame,
+        # and the session reads this one later, so copy it out
+        payload = bytes(frame[GatewayConnection.channelIDLen:])
+
+        with self.channelsLock:
+            channel = self.channels.get(channelID)
+
+            if (len(payload) == 0):
+                # The gateway closed this channel
+                if (channel is not None):
+                    del self.channels[channelID]
+                    channel.closeFromGateway()
+                return
+
+            isNew = channel is None
+            if (isNew):
+                channel = self.newChannel(channelID)
+                self.channels[channelID] = channel
+
+        channel.deliver(payload)
+        if (isNew):
+            startSession(channel)
+
+    def newChannel(self, channelID):
+        return GatewayChannel(self, channelID)
+
+    def sendFrame(self, channelID, payload):
+        if (self.closed):
+            raise ConnectionError('Gateway %s is disconnected' % self.name)
+
+        channelBytes = struct.pack(GatewayConnection.channelByteRep, channelID)
+        with self.sendLock:
+            Communication.sendFrameParts(self.sock, [channelBytes, payload])
+
+    #
+    # A session is done with its channel; tell the gateway
+    #
+
+    def closeChannel(self, channelID):
+        with self.channelsLock:
+            if (self.channels.pop(channelID, None) is None):
+                return
+
+        try:
+            self.sendFrame(channelID, b'')
+        except Exception as e:
+            logger.debug(f"Failed to close channel {channelID} of gateway {self.name}: {e}")
+
+    #
+    # The connection is gone, and so is every channel on it
+    #
+
+    def close(self):
+        self.closed = True
+
+        with self.channelsLock:
+            channels = list(self.channels.values())
+            self.channels = {}
+
+        for channel in channels:
+            channel.closeFromGateway()
+
+        self.sock.close()
+
+
+class GatewayChannel(object):
+    """
+    One vehicle's session on a gateway connection.
+
+    Stands in for the vehicle's socket: it has recvFrame()/sendFrame(),
+    so Command.recv()/Command.send() (and a CommStrategy) can use it directly.
+    """
+
+    queueClass = queue.Queue
+
+    def __init__(self, gateway, channelID):
+        self.gateway = gateway
+        self.channelID = channelID
+
+        # Payloads received for this channel, not yet read by its session.
+        # None means the channel was closed.
+        self.frames = self.queueClass()
+
+    def recvFrame(self):
+        return self.checkOpen(self.frames.get())
+
+    #
+    # The payload read off the queue, unless the channel was closed
+    #
+
+    def checkOpen(self, payload):
+        if (payload is None):
+            # Let any other reader see it too
+            self.frames.put_nowait(None)
+            raise ConnectionError('Channel %d of gateway %s closed' % (
+                self.channelID, self.gateway.name))
+
+        return payload
+
+    def deliver(self, payload):
+        self.frames.put_nowait(payload)
+
+    def sendFrame(self, payload):
+        self.gateway.sendFrame(self.channelID, payload)
+
+    def close(self):
+        self.gateway.closeChannel(self.channelID)
+        self.deliver(None)
+
+    def closeFromGateway(self):
+        self.deliver(None)
+
+
+class AsyncGatewayChannel(GatewayChannel):
+    """
+    One vehicle's session on a gateway connection, in the asyncio mode.
+
+    Stands in for an AsyncStream: recvFrame() and drain() are coroutines.
+    Only use it from the event loop's thread.
+    """
+
+    queueClass = asyncio.Queue
+
+    async def recvFrame(self):
+        return self.checkOpen(await self.frames.get())
+
+    async def drain(self):
+        await self.gateway.drain()
+
+
+class AsyncGatewayConnection(GatewayConnection):
+    """
+    The server end of one gateway connection, in the asyncio mode.
+
+    stream is the connection's AsyncStream. serve() is a coroutine, and each
+    of the channels' sessions runs as a task of its own on the event loop.
+    Only use it from the loop's thread.
+    """
+
+    def __init__(self, stream, hello):
+        super().__init__(stream, stream, hello)
+
+        # Sessions share the stream, and only one may wait for it to drain at a time
+        self.drainLock = asyncio.Lock()
+
+        # The running session tasks (the loop only keeps weak references to them)
+        self.sessions = set()
+
+    #
+    # Run the connection until the gateway goes away.
+    #
+    # startSession is a coroutine function, run as a task with each new AsyncGatewayChannel.
+    #
+
+    async def serve(self, startSession):
+        logger.info(f"Gateway {self.name} connected")
+        GatewayAck({}).send(self.sock)
+
+        try:
+            while True:
+                self.onFrame(await self.reader.recvFrame(), lambda channel: self.spawn(startSession(channel)))
+        except ConnectionError as e:
+            logger.info(f"Gateway {self.name} disconnected: {e}")
+        except Exception as e:
+            logger.exception(f"EXCEPTION on gateway {self.name}: {e}")
+        finally:
+            self.close()
+
+    def newChannel(self, channelID):
+        return AsyncGatewayChannel(self, channelID)
+
+    def spawn(self, session):
+        task = asyncio.ensure_future(session)
+        self.sessions.add(task)
+        task.add_done_callback(self.sessions.discard)
+
+    def sendFrame(self, channelID, payload):
+        if (self.closed):
+            raise ConnectionError('Gateway %s is disconnected' % self.name)
+
+        channelBytes = struct.pack(GatewayConnection.channelByteRep, channelID)
+        self.sock.sendFrameParts([channelBytes, payload])
+
+    async def drain(self):
+        async with self.drainLock:
+            await self.sock.drain()
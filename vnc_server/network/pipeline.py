@@ -0,0 +1,207 @@
+#
+# Pipelined command channels.
+#
+# On a plain connection the server sends one request, then blocks reading
+# until its ack arrives, so a command can only go out between two acks.
+#
+# A vehicle whose InitRequest sets 'pipelining' (and whose InitAck sets 'pipelined')
+# instead has every request carry a sequence number (Command.seq),
+# and answers each one with an ack carrying the same seq.
+# Acks the vehicle sends on its own (e.g. EnrouteToRiderAck) carry no seq.
+#
+# So the server can have several requests in flight at once,
+# and can push an urgent command (e.g. a cancellation) at any time.
+#
+
+import itertools
+import threading
+import queue
+from concurrent.futures import Future
+
+from communication import Communication
+from command import Codec, Command
+
+import logging
+import os
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(formatter)
+logging_path = os.path.dirname(os.path.realpath(__file__)).split("src/")[0] + "src/server_log"
+fh = logging.FileHandler(logging_path)
+fh.setLevel(logging.DEBUG)
+fh.setFormatter(formatter)
+logger.addHandler(ch)
+logger.addHandler(fh)
+logger.setLevel(logging.DEBUG)
+
+
+class Pipeline(object):
+    """
+    The server end of one pipelined connection.
+
+    A writer thread sends frames from a per-connection queue,
+    where urgent commands jump ahead of everything not yet sent.
+    A reader thread matches each ack to its request by seq;
+    anything else goes to an inbox for the session to recv().
+
+    request() returns a concurrent.futures.Future that gets the ack.
+    """
+
+    # Priorities in the writer queue (lowest goes first)
+    URGENT = 0
+    NORMAL = 1
+
+    # Largest sequence number before wrapping around (it's sent as 4 bytes)
+    maxSeq = 0xFFFFFFFF
+
+    # Put in the inbox to wake up recv() without a command
+    wakeMarker = object()
+
+    # Put in the inbox once the connection is gone
+    closedMarker = object()
+
+    def __init__(self, sock, reader, codec=Codec.JSON, delta=None, onFallback=None):
+        self.sock = sock
+        self.reader = reader
+        self.codec = codec
+        self.delta = delta
+
+        # Called with a command that had to be sent as JSON (see Command.encode())
+        self.onFallback = onFallback
+
+        # Map from seq to the Future of its ack, for requests not answered yet
+        self.pending = {}
+        self.nextSeq = 1
+        self.lock = threading.Lock()
+
+        # (priority, order, payload, onSent) of frames not sent yet.
+        # order keeps frames of the same priority first in first out.
+        # onSent, if not None, is called once the frame is sent.
+        self.outbox = queue.PriorityQueue()
+        self.order = itertools.count()
+
+        # Commands received that don't answer a request
+        self.inbox = queue.Queue()
+
+        self.closed = False
+        self.error = None
+
+    def start(self):
+        threading.Thread(target=self.readLoop, daemon=True).start()
+        threading.Thread(target=self.writeLoop, daemon=True).start()
+
+    #
+    # Send a request, and return the Future of its ack.
+    # An urgent request is sent before every frame still queued.
+    #
+
+    def request(self, command, urgent=False):
+        future = Future()
+        with self.lock:
+            if (self.closed):
+                raise ConnectionError('Pipeline is closed: %s' % self.error)
+
+            command.seq = self.nextSeq
+            self.nextSeq = self.nextSeq % Pipeline.maxSeq + 1
+            self.pending[command.seq] = future
+
+        self.enqueue(command.encode(self.codec, self.onFallback), urgent)
+        return future
+
+    #
+    # Send a command that isn't answered
+    #
+
+    def send(self, command, urgent=False):
+        if (self.closed):
+            raise ConnectionError('Pipeline is closed: %s' % self.error)
+
+        command.seq = None
+        self.enqueue(command.encode(self.codec, self.onFallback), urgent)
+
+    def enqueue(self, payload, urgent, onSent=None):
+        priority = Pipeline.URGENT if urgent else Pipeline.NORMAL
+        self.outbox.put((priority, next(self.order), payload, onSent))
+
+    #
+    # Return the next command that doesn't answer a request.
+    # Returns None if the timeout runs out, or if wake() was called.
+    #
+
+    def recv(self, timeout=None):
+        try:
+            item = self.inbox.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        if (item is Pipeline.wakeMarker):
+            return None
+
+        if (item is Pipeline.closedMarker):
+            # Let any other reader see it too
+            self.inbox.put(item)
+            raise ConnectionError('Pipeline is closed: %s' % self.error)
+
+        return item
+
+    def wake(self):
+        self.inbox.put(Pipeline.wakeMarker)
+
+    def readLoop(self):
+        try:
+            while True:
+                command = Command.recv(self.reader, self.delta)
+
+                future = None
+                if (command.seq is not None):
+                    with self.lock:
+                        future = self.pending.pop(command.seq, None)
+
+                if (future is not None):
+                    future.set_result(command)
+                else:
+                    self.inbox.put(command)
+        except Exception as e:
+            self.fail(e)
+
+    def writeLoop(self):
+        try:
+            while True:
+                priority, order, payload, onSent = self.outbox.get()
+                if (payload is None):
+                    return
+                Communication.sendFrame(self.sock, payload)
+                if (onSent is not None):
+                    onSent()
+        except Exception as e:
+            self.fail(e)
+
+    #
+    # The connection is gone: fail every request still waiting on an ack,
+    # and stop both threads.
+    #
+
+    def fail(self, error):
+        with self.lock:
+            if (self.closed):
+                return
+            self.closed = True
+            self.error = error
+            pending = self.pending
+            self.pending = {}
+
+        if (not isinstance(error, ConnectionError)):
+            logger.exception(f"EXCEPTION on pipelined connection: {error}")
+
+        for future in pending.values():
+            future.set_exception(ConnectionError('Pipeline is closed: %s' % error))
+
+        self.inbox.put(Pipeline.closedMarker)
+
+        # Goes ahead of any frame still queued
+        self.outbox.put((Pipeline.URGENT, -1, None, None))
+
+    def close(self):
+        self.fail(ConnectionError('Closed by the server'))
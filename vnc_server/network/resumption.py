@@ -0,0 +1,146 @@
+#
+# Resuming a vehicle's session after its connection drops.
+#
+# Every InitAck carries a resume token ('resumeToken'). When the connection
+# drops, the session is parked here for resumeWindow seconds instead of ending:
+# its vehicle stays enabled, and keeps its state and ride. A vehicle that
+# reconnects within that time, with the token in its InitRequest, isn't
+# registered again; its new session carries on from the parked one (see
+# GoodStrategy.resume()). Otherwise the parked session ends then, as it would
+# have when the connection dropped.
+#
+# The server may not have noticed the drop yet when the vehicle reconnects
+# (e.g. it waits on a pickup, so it isn't using the connection). Then the new
+# session takes over the old one, which is superseded: its connection is shut,
+# and it ends without letting go of the vehicle or its ride.
+#
+# Sessions are parked in the process that served them, so a sharded server
+# (see broker.py), whose vehicles may reconnect to another worker, doesn't
+# hand out tokens.
+#
+
+import secrets
+import threading
+
+import logging
+import os
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(formatter)
+logging_path = os.path.dirname(os.path.realpath(__file__)).split("src/")[0] + "src/server_log"
+fh = logging.FileHandler(logging_path)
+fh.setLevel(logging.DEBUG)
+fh.setFormatter(formatter)
+logger.addHandler(ch)
+logger.addHandler(fh)
+logger.setLevel(logging.DEBUG)
+
+
+class SessionResumption(object):
+    """
+    The sessions that handed out a resume token, by token, until they are resumed or end.
+    """
+
+    # Seconds a parked session waits for its vehicle to reconnect
+    resumeWindow = 30.0
+
+    # Bytes of a token (sent in hex)
+    tokenLen = 16
+
+    def __init__(self):
+        # Map from token to its session, and from the token of a parked session to the timer that ends it
+        self.sessions = {}
+        self.parked = {}
+        self.lock = threading.Lock()
+
+        self.resumed = 0
+        self.expired = 0
+
+    def issue(self, session):
+        token = secrets.token_hex(SessionResumption.tokenLen)
+        with self.lock:
+            self.sessions[token] = session
+        return token
+
+    #
+    # The session's connection dropped: keep it until its vehicle reconnects,
+    # or call its closeSession() after resumeWindow seconds.
+    # Nothing to do if another session already took over.
+    #
+
+    def park(self, session):
+        token = session.resumeToken
+        timer = threading.Timer(SessionResumption.resumeWindow, self.expire, args=(token,))
+        timer.daemon = True
+
+        with self.lock:
+            if (self.sessions.get(token) is not session):
+                return
+            self.parked[token] = timer
+        timer.start()
+
+        logger.info(f"Parked the session of vehicle {session.vName} for {SessionResumption.resumeWindow}s")
+
+    #
+    # The session of vehicle vName with this token, which the caller takes over,
+    # or None if there is none (e.g. it expired). If it is still running, it is superseded.
+    #
+
+    def resume(self, token, vName):
+        if (not token):
+            return None
+
+        with self.lock:
+            session = self.sessions.get(token)
+            if (session is None or session.vName != vName or not hasattr(session, 'vState')):
+                return None
+            del self.sessions[token]
+            timer = self.parked.pop(token, None)
+
+            # Before it can park, so it won't
+            if (timer is None):
+                session.superseded = True
+            self.resumed += 1
+
+        if (timer is not None):
+            timer.cancel()
+        else:
+            session.supersede()
+        return session
+
+    #
+    # The session ended for good
+    #
+
+    def forget(self, session):
+        with self.lock:
+            if (self.sessions.get(session.resumeToken) is session):
+                del self.sessions[session.resumeToken]
+
+    def expire(self, token):
+        with self.lock:
+            session = self.sessions.pop(token, None)
+            if (self.parked.pop(token, None) is None):
+                return
+            self.expired += 1
+
+        logger.info(f"Vehicle {session.vName} did not reconnect in time; ending its session")
+        try:
+            session.closeSession()
+        except Exception as e:
+            logger.exception(f"EXCEPTION while ending the parked session of vehicle {session.vName}: {e}")
+
+    def stats(self):
+        """Returns the metrics of session resumption
+
+        :return: 'parked' (sessions now), and 'resumed' and 'expired' (so far)
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                'parked': len(self.parked),
+                'resumed': self.resumed,
+                'expired': self.expired
+            }
@@ -0,0 +1,132 @@
+#
+# Admission control for vehicle sessions.
+#
+# Every session holds a thread (in the threaded mode) and a DB connection
+# for as long as its vehicle stays connected, so the server only takes as
+# many as it can hold. Connections beyond that are answered with a ServerBusy
+# and closed, instead of piling up threads (e.g. when a whole fleet reconnects
+# at once after a network blip).
+#
+
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import time
+
+import logging
+import os
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(formatter)
+logging_path = os.path.dirname(os.path.realpath(__file__)).split("src/")[0] + "src/server_log"
+fh = logging.FileHandler(logging_path)
+fh.setLevel(logging.DEBUG)
+fh.setFormatter(formatter)
+logger.addHandler(ch)
+logger.addHandler(fh)
+logger.setLevel(logging.DEBUG)
+
+
+class SessionPool(object):
+    """
+    At most maxSessions sessions at once, plus at most maxQueued waiting for one to end.
+
+    In the threaded mode, submit() runs a session on one of maxSessions threads.
+    In the asyncio mode, sessions are coroutines, and only use enter() and leave().
+    Either way, a connection turned away should get a ServerBusy with retryAfter().
+    """
+
+    # Seconds a vehicle turned away should wait before reconnecting.
+    # Each gets a random wait up to twice this, so they don't all come back at once.
+    backoff = 5.0
+
+    def __init__(self, maxSessions, maxQueued):
+        self.maxSessions = maxSessions
+        self.maxQueued = maxQueued
+        self.executor = None
+
+        self.active = 0
+        self.queued = 0
+        self.lock = threading.Lock()
+
+        # Metrics (see stats())
+        self.admitted = 0
+        self.rejected = 0
+        self.queueWaitTotal = 0.0
+        self.queueWaitMax = 0.0
+
+    #
+    # Run handler(*args) as a session on the handler pool.
+    # Returns False (without running it) if the pool is full.
+    #
+
+    def submit(self, handler, *args):
+        with self.lock:
+            if (self.active + self.queued >= self.maxSessions + self.maxQueued):
+                self.rejected += 1
+                return False
+            self.queued += 1
+
+            if (self.executor is None):
+                self.executor = ThreadPoolExecutor(max_workers=self.maxSessions, thread_name_prefix='vehicle-session')
+
+        self.executor.submit(self.run, time.time(), handler, args)
+        return True
+
+    def run(self, submittedAt, handler, args):
+        wait = time.time() - submittedAt
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+            self.admitted += 1
+            self.queueWaitTotal += wait
+            self.queueWaitMax = max(self.queueWaitMax, wait)
+
+        try:
+            handler(*args)
+        except Exception as e:
+            logger.exception(f"EXCEPTION in a session: {e}")
+        finally:
+            self.leave()
+
+    #
+    # Count a session that runs elsewhere (e.g. as a coroutine).
+    # Returns False if there is no room for it.
+    #
+
+    def enter(self):
+        with self.lock:
+            if (self.active >= self.maxSessions):
+                self.rejected += 1
+                return False
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+    def retryAfter(self):
+        return round(random.uniform(SessionPool.backoff, 2 * SessionPool.backoff), 1)
+
+    def stats(self):
+        """Returns the session metrics
+
+        :return: 'sessions' (running now), 'queued' (waiting for a thread),
+            'maxSessions', 'admitted' and 'rejected' (so far),
+            and the average and longest 'queueWait' (seconds from accept to start) so far
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                'sessions': self.active,
+                'queued': self.queued,
+                'maxSessions': self.maxSessions,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'queueWaitAvg': self.queueWaitTotal / self.admitted if self.admitted else 0.0,
+                'queueWaitMax': self.queueWaitMax
+            }
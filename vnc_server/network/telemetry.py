@@ -0,0 +1,185 @@
+#
+# The UDP fast path for position reports.
+#
+# Position reports are fire-and-forget, so a vehicle whose InitRequest sets
+# 'udpTelemetry' may also send them as UDP datagrams, as often as it likes,
+# without holding up the FSM on its TCP connection.
+#
+# Its InitAck carries a session token ('telemetryToken', in hex) and the UDP port
+# ('telemetryPort'). Each datagram is:
+#   1) The 8-byte session token
+#   2) A 4-byte sequence number, one higher for each datagram sent
+#   3) lat, lon (doubles), heading, speed (floats), batteryLife (short)
+# all big-endian. Datagrams with an unknown token, or that arrive after a
+# later one (by sequence number), are dropped.
+#
+
+import secrets
+import socket
+import struct
+import threading
+import time
+
+import logging
+import os
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(formatter)
+logging_path = os.path.dirname(os.path.realpath(__file__)).split("src/")[0] + "src/server_log"
+fh = logging.FileHandler(logging_path)
+fh.setLevel(logging.DEBUG)
+fh.setFormatter(formatter)
+logger.addHandler(ch)
+logger.addHandler(fh)
+logger.setLevel(logging.DEBUG)
+
+
+class TelemetryStream(object):
+    """
+    The position reports of one vehicle session.
+    """
+
+    def __init__(self, vName):
+        self.vName = vName
+
+        # Sequence number of the newest datagram accepted
+        self.lastSeq = None
+
+        # The newest report, as a dict, and when it arrived
+        self.latest = None
+        self.receivedAt = None
+
+        self.received = 0
+        self.dropped = 0
+
+    #
+    # Whether seq is newer than every datagram accepted so far.
+    # Sequence numbers wrap around, so "newer" means less than half the range ahead.
+    #
+
+    def isNewer(self, seq):
+        if (self.lastSeq is None):
+            return True
+
+        ahead = (seq - self.lastSeq) & TelemetryServer.maxSeq
+        return 0 < ahead < TelemetryServer.maxSeq // 2
+
+
+class TelemetryServer(object):
+    """
+    Receives the UDP position reports of every vehicle session.
+
+    A session calls register() to get the token it hands out in its InitAck,
+    and unregister() when it ends. Readers get each vehicle's newest report
+    from latest().
+    """
+
+    # token, seq, lat, lon, heading, speed, batteryLife
+    datagram = struct.Struct('>8sIddffh')
+    tokenLen = 8
+    maxSeq = 0xFFFFFFFF
+
+    def __init__(self, host, port):
+        self.port = port
+
+        # AF_INET means IPv4,
+        # SOCK_DGRAM means UDP
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+
+        # Map from token to its TelemetryStream, and from vehicle name to the same
+        self.streams = {}
+        self.streamsByName = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    #
+    # Start accepting reports for a vehicle session, and return its token
+    #
+
+    def register(self, vName):
+        token = secrets.token_bytes(TelemetryServer.tokenLen)
+        stream = TelemetryStream(vName)
+
+        with self.lock:
+            self.streams[token] = stream
+            self.streamsByName[vName] = stream
+
+        return token
+
+    def unregister(self, token):
+        with self.lock:
+            stream = self.streams.pop(token, None)
+            if (stream is not None and self.streamsByName.get(stream.vName) is stream):
+                del self.streamsByName[stream.vName]
+
+        if (stream is not None):
+            logger.debug(f"Telemetry of {stream.vName}: {stream.received} received, {stream.dropped} dropped")
+
+    #
+    # The newest report of a vehicle ({'lat', 'lon', 'heading', 'speed', 'batteryLife'}),
+    # or None if it never sent one
+    #
+
+    def latest(self, vName):
+        stream = self.streamsByName.get(vName)
+        if (stream is None):
+            return None
+        return stream.latest
+
+    #
+    # A copy of a vehicle dict (e.g. from VehicleDBUtil.getVehiclesLite())
+    # with its position replaced by its newest report, if it sent any
+    #
+
+    def withLatestPosition(self, vehicle):
+        latest = self.latest(vehicle.get('name'))
+        if (latest is None):
+            return vehicle
+
+        vehicle = dict(vehicle)
+        vehicle['lat'] = latest['lat']
+        vehicle['lon'] = latest['lon']
+        return vehicle
+
+    def serve(self):
+        buf = bytearray(TelemetryServer.datagram.size + 1)
+        view = memoryview(buf)
+
+        while True:
+            try:
+                nRecv, addr = self.sock.recvfrom_into(buf)
+                self.handle(view[:nRecv])
+            except Exception as e:
+                logger.exception(f"EXCEPTION on telemetry socket: {e}")
+
+    def handle(self, datagram):
+        if (len(datagram) != TelemetryServer.datagram.size):
+            return
+
+        token, seq, lat, lon, heading, speed, batteryLife = TelemetryServer.datagram.unpack(datagram)
+
+        stream = self.streams.get(token)
+        if (stream is None):
+            return
+
+        # Only this thread writes to a stream, so no lock needed
+        if (not stream.isNewer(seq)):
+            stream.dropped += 1
+            return
+
+        stream.lastSeq = seq
+        stream.latest = {
+            'lat': lat,
+            'lon': lon,
+            'heading': heading,
+            'speed': speed,
+            'batteryLife': batteryLife
+        }
+        stream.receivedAt = time.time()
+        stream.received += 1
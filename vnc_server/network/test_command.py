@@ -0,0 +1,141 @@
+#
+# Unit tests of the Command codecs (see command.py). No server or database needed.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_command.py
+#
+import json
+
+import pytest
+
+from command import Codec, Command, DeltaState, IdleAck, InitRequest, StopAll, commandsByID
+
+
+def makeIdleAck(**changes):
+    obj = {
+        'name': 'Vehicle 1',
+        'lat': 35.7796,
+        'lon': -78.6382,
+        'heading': 90.5,
+        'steering': -0.25,
+        'speed': 4.0,
+        'batteryLife': 87,
+        'minBatteryLife': 20,
+        'mileage': 1234.5
+    }
+    obj.update(changes)
+    return IdleAck(obj)
+
+
+def isDeltaFrame(payload):
+    if (payload[0] == ord('{')):
+        return json.loads(bytes(payload)).get('delta', False)
+    return bool(payload[0] & Command.deltaFlag)
+
+
+def test_classes_are_registered_by_name_and_id():
+    assert Command.registry['IdleAck'] is IdleAck
+    assert commandsByID[IdleAck.commandID] is IdleAck
+
+
+@pytest.mark.parametrize('codec', Codec.supported)
+def test_round_trip(codec):
+    ack = makeIdleAck()
+
+    decoded = Command.decode(ack.encode(codec))
+
+    assert isinstance(decoded, IdleAck)
+    assert decoded.toObj() == ack.toObj()
+    assert decoded.seq is None
+
+
+@pytest.mark.parametrize('codec', Codec.supported)
+def test_round_trip_with_seq(codec):
+    ack = makeIdleAck()
+    ack.seq = 0xFFFFFFFF
+
+    decoded = Command.decode(ack.encode(codec))
+
+    assert decoded.seq == 0xFFFFFFFF
+    assert decoded.toObj() == ack.toObj()
+
+
+def test_struct_frames_are_smaller_and_start_with_the_command_id():
+    ack = makeIdleAck()
+
+    payload = ack.encode(Codec.STRUCT)
+
+    assert payload[0] == IdleAck.commandID
+    assert len(payload) < len(ack.encode(Codec.JSON))
+
+
+def test_commands_without_fields_encode_once():
+    assert StopAll({}).encode(Codec.STRUCT) is StopAll({}).encode(Codec.STRUCT)
+    assert isinstance(Command.decode(StopAll({}).encode(Codec.STRUCT)), StopAll)
+
+
+def test_struct_rounds_floats_to_32_bits():
+    ack = makeIdleAck(heading=123.456789)
+
+    decoded = Command.decode(ack.encode(Codec.STRUCT))
+
+    assert decoded.heading != 123.456789
+    assert decoded.heading == pytest.approx(123.456789, rel=1e-6)
+    assert Command.decode(ack.encode(Codec.JSON)).heading == 123.456789
+
+
+@pytest.mark.parametrize('changes', [{'batteryLife': 85.5}, {'batteryLife': 40000}, {'name': 'x' * 256}])
+def test_struct_falls_back_to_json(changes):
+    ack = makeIdleAck(**changes)
+    fellBack = []
+
+    payload = ack.encode(Codec.STRUCT, fellBack.append)
+
+    assert payload[0] == ord('{')
+    assert fellBack == [ack]
+    assert Command.decode(payload).toObj() == ack.toObj()
+
+
+def test_init_request_is_always_json():
+    request = InitRequest(dict(makeIdleAck().toObj(), codecs=[Codec.JSON, Codec.STRUCT]))
+    fellBack = []
+
+    assert InitRequest.structLayout() is None
+    payload = request.encode(Codec.STRUCT, fellBack.append)
+
+    assert payload[0] == ord('{')
+    assert fellBack == [request]
+    assert Command.decode(payload).codecs == [Codec.JSON, Codec.STRUCT]
+
+
+@pytest.mark.parametrize('codec', Codec.supported)
+def test_deltas_between_keyframes(codec):
+    sent = DeltaState(keyframeInterval=3)
+    received = DeltaState()
+    acks = [makeIdleAck(), makeIdleAck(lat=35.78), makeIdleAck(lat=35.78, batteryLife=86), makeIdleAck(lat=35.79)]
+
+    payloads = [ack.encodeDelta(codec, sent) for ack in acks]
+
+    assert [isDeltaFrame(p) for p in payloads] == [False, True, True, False]
+    for ack, payload in zip(acks, payloads):
+        assert Command.decode(payload, received).toObj() == ack.toObj()
+
+
+@pytest.mark.parametrize('codec', Codec.supported)
+def test_delta_only_carries_changed_fields(codec):
+    sent = DeltaState(keyframeInterval=10)
+    makeIdleAck().encodeDelta(codec, sent)
+
+    delta = makeIdleAck(lat=35.78).encodeDelta(codec, sent)
+
+    assert len(delta) < len(makeIdleAck(lat=35.78).encode(codec))
+
+
+def test_delta_without_state_is_rejected():
+    sent = DeltaState(keyframeInterval=10)
+    makeIdleAck().encodeDelta(Codec.STRUCT, sent)
+    delta = makeIdleAck(lat=35.78).encodeDelta(Codec.STRUCT, sent)
+
+    with pytest.raises(Exception):
+        Command.decode(delta)
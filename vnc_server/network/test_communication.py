@@ -0,0 +1,114 @@
+#
+# Unit tests of FrameReader (see communication.py). No server needed.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_communication.py
+#
+import struct
+
+import pytest
+
+from communication import Communication, FrameReader
+
+
+class ScriptedSocket(object):
+    """
+    Hands out the given chunks of bytes, one per recv_into(), then reports the connection closed.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.reads = 0
+
+    def recv_into(self, view, nbytes=0, flags=0):
+        self.reads += 1
+        if (len(self.chunks) == 0):
+            return 0
+
+        chunk = self.chunks.pop(0)
+        n = min(len(chunk), len(view))
+        view[:n] = chunk[:n]
+        if (n < len(chunk)):
+            self.chunks.insert(0, chunk[n:])
+        return n
+
+
+def frame(payload):
+    return struct.pack(Communication.intByteRep, len(payload)) + payload
+
+
+def test_frames_merged_in_one_read():
+    sock = ScriptedSocket([frame(b'first') + frame(b'second') + frame(b'')])
+    reader = FrameReader(sock)
+
+    assert bytes(reader.recvFrame()) == b'first'
+    assert bytes(reader.recvFrame()) == b'second'
+    assert bytes(reader.recvFrame()) == b''
+    assert sock.reads == 1
+
+
+def test_frame_split_over_reads():
+    data = frame(b'split across reads') + frame(b'next')
+    sock = ScriptedSocket([data[0:2], data[2:9], data[9:]])
+    reader = FrameReader(sock)
+
+    assert bytes(reader.recvFrame()) == b'split across reads'
+    assert bytes(reader.recvFrame()) == b'next'
+
+
+def test_buffer_grows_for_a_large_frame():
+    large = bytes(range(256)) * 100
+    data = frame(b'small') + frame(large) + frame(b'after')
+    sock = ScriptedSocket([data[i:i + 1000] for i in range(0, len(data), 1000)])
+    reader = FrameReader(sock, size=64)
+
+    assert bytes(reader.recvFrame()) == b'small'
+    assert bytes(reader.recvFrame()) == large
+    assert bytes(reader.recvFrame()) == b'after'
+    assert len(reader.buf) >= len(large) + Communication.msgSizeLen
+
+
+def test_unread_bytes_move_to_the_front():
+    # The second frame starts near the end of the buffer, and doesn't fit after it
+    data = frame(b'x' * 20) + frame(b'y' * 20)
+    sock = ScriptedSocket([data[:30], data[30:]])
+    reader = FrameReader(sock, size=32)
+
+    assert bytes(reader.recvFrame()) == b'x' * 20
+    assert bytes(reader.recvFrame()) == b'y' * 20
+    assert len(reader.buf) == 32
+
+
+def test_handed_out_frame_is_released_by_the_next_call():
+    sock = ScriptedSocket([frame(b'one') + frame(b'two')])
+    reader = FrameReader(sock)
+
+    first = reader.recvFrame()
+    reader.recvFrame()
+
+    with pytest.raises(ValueError):
+        bytes(first)
+
+
+def test_closed_between_frames():
+    reader = FrameReader(ScriptedSocket([frame(b'only')]))
+    reader.recvFrame()
+
+    with pytest.raises(ConnectionError, match='Peer closed the connection$'):
+        reader.recvFrame()
+
+
+def test_closed_mid_frame():
+    reader = FrameReader(ScriptedSocket([frame(b'cut short')[:6]]))
+
+    with pytest.raises(ConnectionError, match='mid-frame'):
+        reader.recvFrame()
+
+
+def test_oversized_frame_is_rejected():
+    header = struct.pack(Communication.intByteRep, Communication.maxFrameSize + 1)
+    reader = FrameReader(ScriptedSocket([header]))
+
+    with pytest.raises(Exception, match='larger than the maximum'):
+        reader.recvFrame()
@@ -0,0 +1,168 @@
+#
+# Unit tests of CoordHistoryBuffer (see coord_history.py), flushed to a stand-in
+# database by hand. No MySQL needed.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_coord_history.py
+#
+import pytest
+
+from coord_history import CoordHistoryBuffer
+
+
+class FakeResponse(object):
+    def __init__(self, success, message=''):
+        self.success = success
+        self.message = message
+
+
+class FakeDB(object):
+    """
+    Records the rows of each upsertMany(). Fails the calls whose number (from 0) is in failures,
+    and calls duringCall (if set) before answering, as if rows were added meanwhile.
+    """
+
+    def __init__(self, failures=()):
+        self.failures = set(failures)
+        self.calls = 0
+        self.written = []
+        self.duringCall = None
+
+    def upsertMany(self, table, cols, rows, updateCols):
+        assert table == 'CoordHistory'
+        call = self.calls
+        self.calls += 1
+
+        if (self.duringCall is not None):
+            self.duringCall()
+
+        if (call in self.failures):
+            return FakeResponse(False, 'Lost connection to MySQL server')
+        self.written.extend(rows)
+        return FakeResponse(True)
+
+
+@pytest.fixture
+def buffer(monkeypatch):
+    monkeypatch.setattr(CoordHistoryBuffer, 'batchSize', 2)
+    monkeypatch.setattr(CoordHistoryBuffer, 'maxRows', 5)
+    return CoordHistoryBuffer()
+
+
+def add(buffer, *ts):
+    for t in ts:
+        buffer.add('Vehicle 1', 'WAITING', t, 35.5, -78.5)
+
+
+def times(rows):
+    return [row[1] for row in rows]
+
+
+def test_rows_are_written_in_batches(buffer):
+    buffer.db = FakeDB()
+    add(buffer, 1, 2, 3)
+
+    assert buffer.flush()
+
+    assert times(buffer.db.written) == [1, 2, 3]
+    assert buffer.db.calls == 2
+    stats = buffer.stats()
+    assert (stats['queued'], stats['added'], stats['written'], stats['dropped'], stats['flushes']) == (0, 3, 3, 0, 2)
+
+
+def test_full_buffer_drops_the_oldest_rows(buffer):
+    buffer.db = FakeDB()
+    add(buffer, 1, 2, 3, 4, 5, 6, 7)
+
+    assert buffer.flush()
+
+    assert times(buffer.db.written) == [3, 4, 5, 6, 7]
+    assert buffer.stats()['dropped'] == 2
+
+
+def test_failed_batch_goes_back_in_front_of_newer_rows(buffer):
+    buffer.db = FakeDB(failures=[0])
+    add(buffer, 1, 2)
+
+    assert not buffer.flush()
+    add(buffer, 3)
+    assert buffer.flush()
+
+    assert times(buffer.db.written) == [1, 2, 3]
+    stats = buffer.stats()
+    assert (stats['queued'], stats['written'], stats['dropped']) == (0, 3, 0)
+
+
+def test_rows_after_a_failed_batch_are_requeued_too(buffer):
+    buffer.db = FakeDB(failures=[1])
+    add(buffer, 1, 2, 3, 4, 5)
+
+    assert not buffer.flush()
+
+    assert times(buffer.db.written) == [1, 2]
+    assert times(row for row, added in buffer.rows) == [3, 4, 5]
+    stats = buffer.stats()
+    assert (stats['queued'], stats['written'], stats['dropped']) == (3, 2, 0)
+
+
+def test_requeue_keeps_only_what_fits(buffer):
+    buffer.db = FakeDB(failures=[0])
+    add(buffer, 1, 2)
+
+    # Four newer rows come in while the batch fails, so only one of it fits back
+    buffer.db.duringCall = lambda: add(buffer, 10, 11, 12, 13)
+    assert not buffer.flush()
+
+    assert times(row for row, added in buffer.rows) == [2, 10, 11, 12, 13]
+    stats = buffer.stats()
+    assert (stats['queued'], stats['added'], stats['written'], stats['dropped']) == (5, 6, 0, 1)
+
+
+def test_every_row_is_written_or_dropped(buffer):
+    buffer.db = FakeDB(failures=[0, 3])
+    for t in range(20):
+        add(buffer, t)
+        if (t % 3 == 0):
+            buffer.flush()
+    while (not buffer.flush()):
+        pass
+
+    stats = buffer.stats()
+    assert stats['queued'] == 0
+    assert stats['written'] == len(buffer.db.written)
+    assert stats['written'] + stats['dropped'] == stats['added'] == 20
+    assert times(buffer.db.written) == sorted(times(buffer.db.written))
+
+
+def test_rows_added_before_close_are_written(buffer, monkeypatch):
+    monkeypatch.setattr(CoordHistoryBuffer, 'flushInterval', 30.0)
+    buffer.db = FakeDB()
+    buffer.start()
+    add(buffer, 1)
+
+    # Not a batch yet, and the next flush is far off
+    assert buffer.close()
+
+    assert not buffer.thread.is_alive()
+    assert times(buffer.db.written) == [1]
+    assert buffer.stats()['queued'] == 0
+
+
+def test_close_retries_a_failed_batch(buffer):
+    buffer.db = FakeDB(failures=[0])
+    add(buffer, 1, 2, 3)
+
+    assert buffer.close()
+
+    assert times(buffer.db.written) == [1, 2, 3]
+
+
+def test_close_gives_up_on_a_failing_database(buffer):
+    buffer.db = FakeDB(failures=range(CoordHistoryBuffer.closeAttempts))
+    add(buffer, 1, 2, 3)
+
+    assert not buffer.close()
+
+    stats = buffer.stats()
+    assert (stats['queued'], stats['written'], stats['dropped']) == (0, 0, 3)
@@ -0,0 +1,204 @@
+#
+# Unit tests of RideDispatcher (see dispatcher.py), with stand-ins for the
+# rides, the sessions and the selector. No server or database needed.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_dispatcher.py
+#
+import threading
+
+from dispatcher import RideDispatcher
+
+
+class FakeRide(object):
+    def __init__(self, rideID):
+        self.rideID = rideID
+
+    def getRideID(self):
+        return self.rideID
+
+    def __str__(self):
+        return 'Ride %s' % self.rideID
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.assigned = []
+
+    def assign(self, ride):
+        self.assigned.append(ride.rideID)
+
+
+class FirstRide(object):
+    """
+    Picks the first ride of the queue, as FIFORide does, and records what it was asked
+    """
+
+    def __init__(self):
+        self.selections = []
+        self.forgotten = []
+
+    def selectRide(self, vName, queue, **kwargs):
+        self.selections.append(vName)
+        return queue.pop(0) if len(queue) > 0 else None
+
+    def forget(self, rideID):
+        self.forgotten.append(rideID)
+
+
+class BlockingSelector(FirstRide):
+    """
+    Like FirstRide, but each selection waits until the test lets it go on
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.selecting = threading.Event()
+        self.proceed = threading.Event()
+
+    def selectRide(self, vName, queue, **kwargs):
+        self.selecting.set()
+        assert self.proceed.wait(5)
+        return super().selectRide(vName, queue, **kwargs)
+
+
+def test_oldest_ride_goes_to_the_longest_idle_vehicle():
+    dispatcher = RideDispatcher(FirstRide())
+    first, second = FakeSession(), FakeSession()
+    dispatcher.vehicleIdle('Vehicle 1', first)
+    dispatcher.vehicleIdle('Vehicle 2', second)
+
+    dispatcher.addRides([FakeRide(1), FakeRide(2), FakeRide(3)])
+
+    assert (first.assigned, second.assigned) == ([1], [2])
+    assert dispatcher.stats()['queuedRides'] == 1
+    assert dispatcher.stats()['idleVehicles'] == 0
+
+
+def test_a_vehicle_waits_for_the_next_ride():
+    dispatcher = RideDispatcher(FirstRide())
+    session = FakeSession()
+
+    dispatcher.vehicleIdle('Vehicle 1', session)
+    assert session.assigned == []
+
+    dispatcher.addRide(FakeRide(1))
+    assert session.assigned == [1]
+
+
+def test_requeued_ride_goes_first():
+    dispatcher = RideDispatcher(FirstRide())
+    dispatcher.addRides([FakeRide(1), FakeRide(2)])
+
+    dispatcher.requeue(FakeRide(0))
+    session = FakeSession()
+    dispatcher.vehicleIdle('Vehicle 1', session)
+
+    assert session.assigned == [0]
+
+
+def test_removed_vehicle_gets_no_ride():
+    dispatcher = RideDispatcher(FirstRide())
+    old, new = FakeSession(), FakeSession()
+    dispatcher.vehicleIdle('Vehicle 1', old)
+
+    # Another session of the same vehicle doesn't remove the newer one
+    dispatcher.removeVehicle('Vehicle 1', new)
+    assert dispatcher.stats()['idleVehicles'] == 1
+
+    dispatcher.removeVehicle('Vehicle 1', old)
+    dispatcher.addRide(FakeRide(1))
+
+    assert old.assigned == []
+    assert dispatcher.stats()['queuedRides'] == 1
+
+
+def test_canceled_ride_leaves_the_queue_and_the_selector():
+    selector = FirstRide()
+    dispatcher = RideDispatcher(selector)
+    dispatcher.addRides([FakeRide(1), FakeRide(2)])
+
+    dispatcher.removeRide('1')
+    session = FakeSession()
+    dispatcher.vehicleIdle('Vehicle 1', session)
+
+    assert session.assigned == [2]
+    assert selector.forgotten == ['1']
+
+
+def test_selector_runs_without_the_lock():
+    selector = BlockingSelector()
+    dispatcher = RideDispatcher(selector)
+    session = FakeSession()
+    dispatcher.vehicleIdle('Vehicle 1', session)
+
+    matcher = threading.Thread(target=dispatcher.addRide, args=(FakeRide(1),))
+    matcher.start()
+    assert selector.selecting.wait(5)
+
+    # Neither waits on the selection in progress
+    dispatcher.addRide(FakeRide(2))
+    assert dispatcher.stats()['queuedRides'] == 2
+
+    selector.proceed.set()
+    matcher.join(5)
+
+    assert session.assigned == [1]
+    assert dispatcher.stats()['queuedRides'] == 1
+
+
+def test_changes_during_a_selection_are_matched_after_it():
+    selector = BlockingSelector()
+    dispatcher = RideDispatcher(selector)
+    first, second = FakeSession(), FakeSession()
+    dispatcher.vehicleIdle('Vehicle 1', first)
+
+    matcher = threading.Thread(target=dispatcher.addRide, args=(FakeRide(1),))
+    matcher.start()
+    assert selector.selecting.wait(5)
+
+    dispatcher.addRide(FakeRide(2))
+    dispatcher.vehicleIdle('Vehicle 2', second)
+
+    selector.proceed.set()
+    matcher.join(5)
+
+    assert (first.assigned, second.assigned) == ([1], [2])
+
+
+def test_match_for_a_vehicle_that_left_meanwhile_is_dropped():
+    selector = BlockingSelector()
+    dispatcher = RideDispatcher(selector)
+    session = FakeSession()
+    dispatcher.vehicleIdle('Vehicle 1', session)
+
+    matcher = threading.Thread(target=dispatcher.addRide, args=(FakeRide(1),))
+    matcher.start()
+    assert selector.selecting.wait(5)
+
+    dispatcher.removeVehicle('Vehicle 1', session)
+    selector.proceed.set()
+    matcher.join(5)
+
+    assert session.assigned == []
+    assert dispatcher.stats()['queuedRides'] == 1
+
+
+def test_ride_canceled_meanwhile_is_forgotten():
+    selector = BlockingSelector()
+    dispatcher = RideDispatcher(selector)
+    session = FakeSession()
+    dispatcher.vehicleIdle('Vehicle 1', session)
+
+    matcher = threading.Thread(target=dispatcher.addRide, args=(FakeRide(1),))
+    matcher.start()
+    assert selector.selecting.wait(5)
+
+    dispatcher.removeRide(1)
+    selector.proceed.set()
+    matcher.join(5)
+
+    assert session.assigned == []
+    assert selector.forgotten == [1, 1]
+    assert dispatcher.stats()['idleVehicles'] == 1
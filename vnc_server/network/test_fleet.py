@@ -0,0 +1,78 @@
+#
+# Unit tests of FleetRegistry (see fleet.py), flushed to a stand-in database.
+# No MySQL needed.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_fleet.py
+#
+import pytest
+
+from fleet import FleetRegistry
+
+
+class FakeResponse(object):
+    def __init__(self, success, message=''):
+        self.success = success
+        self.message = message
+
+
+class FakeDB(object):
+    """
+    Records each updateMany() as (setCols, rows), and fails them while failing is set
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.failing = False
+
+    def updateMany(self, table, setCols, whereCols, rows):
+        assert (table, whereCols) == ('Vehicles', ['name'])
+        if (self.failing):
+            return FakeResponse(False, 'Lost connection to MySQL server')
+        self.updates.append((setCols, rows))
+        return FakeResponse(True)
+
+
+def test_changed_columns_are_written_by_batch():
+    fleet = FleetRegistry()
+    fleet.db = FakeDB()
+    fleet.register('Vehicle 1', 35.5, -78.5, 90, 'WAITING')
+    fleet.update('Vehicle 2', {'status': 'IDLE'})
+    fleet.update('Vehicle 1', {'lat': 35.6, 'lon': -78.6})
+
+    fleet.flush()
+
+    assert sorted(fleet.db.updates) == [
+        (['lat', 'lon', 'status'], [(35.6, -78.6, 'WAITING', 'Vehicle 1')]),
+        (['status'], [('IDLE', 'Vehicle 2')])
+    ]
+    assert fleet.dirty == {}
+
+
+def test_failed_write_is_retried_under_newer_changes():
+    fleet = FleetRegistry()
+    fleet.db = FakeDB()
+    fleet.update('Vehicle 1', {'status': 'IDLE', 'batteryLife': 80})
+
+    fleet.db.failing = True
+    fleet.flush()
+    fleet.update('Vehicle 1', {'status': 'WAITING'})
+    fleet.db.failing = False
+    fleet.flush()
+
+    assert fleet.db.updates == [(['batteryLife', 'status'], [(80, 'WAITING', 'Vehicle 1')])]
+
+
+def test_changes_made_before_close_are_written(monkeypatch):
+    monkeypatch.setattr(FleetRegistry, 'flushInterval', 30.0)
+    fleet = FleetRegistry()
+    fleet.db = FakeDB()
+    fleet.start()
+    fleet.update('Vehicle 1', {'status': 'IDLE', 'curRideID': 7})
+
+    # The next flush is far off
+    fleet.close()
+
+    assert not fleet.thread.is_alive()
+    assert fleet.db.updates == [(['curRideID', 'status'], [(7, 'IDLE', 'Vehicle 1')])]
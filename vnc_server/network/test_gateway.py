@@ -0,0 +1,145 @@
+#
+# Unit tests of AsyncGatewayConnection (see gateway.py), over a stand-in stream.
+# No server or database needed.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_gateway.py
+#
+import asyncio
+import struct
+import threading
+
+from gateway import AsyncGatewayConnection
+from command import GatewayHello
+
+
+class FakeStream(object):
+    """
+    The server's end of a gateway connection. It reads the frames put in incoming
+    (None as the gateway going away), and records the frames sent as (channelID, payload).
+    """
+
+    def __init__(self):
+        self.incoming = asyncio.Queue()
+        self.sent = []
+        self.closed = False
+
+    async def recvFrame(self):
+        frame = await self.incoming.get()
+        if (frame is None):
+            raise ConnectionError('Gateway went away')
+        return frame
+
+    def sendFrame(self, payload):
+        # Only the GatewayAck goes out without a channel
+        self.sent.append((None, payload))
+
+    def sendFrameParts(self, parts):
+        channelID = struct.unpack('>H', parts[0])[0]
+        self.sent.append((channelID, b''.join(parts[1:])))
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def frame(channelID, payload=b''):
+    return struct.pack('>H', channelID) + payload
+
+
+async def until(condition):
+    for i in range(500):
+        if (condition()):
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('Timed out')
+
+
+class Sessions(object):
+    """
+    Sessions that answer each frame in upper case, until their channel closes,
+    or until they get b'bye' (then they close it themselves)
+    """
+
+    def __init__(self):
+        self.started = []
+        self.ended = []
+        self.threads = set()
+
+    async def __call__(self, channel):
+        self.started.append(channel.channelID)
+        self.threads.add(threading.current_thread())
+        try:
+            while True:
+                payload = await channel.recvFrame()
+                if (payload == b'bye'):
+                    channel.close()
+                    continue
+                channel.sendFrame(payload.upper())
+                await channel.drain()
+        except ConnectionError:
+            self.ended.append(channel.channelID)
+
+
+def serve(scenario):
+    async def run():
+        stream = FakeStream()
+        gateway = AsyncGatewayConnection(stream, GatewayHello({'name': 'Depot 1'}))
+        sessions = Sessions()
+
+        serving = asyncio.ensure_future(gateway.serve(sessions))
+        await scenario(stream, gateway, sessions)
+
+        stream.incoming.put_nowait(None)
+        await serving
+        await until(lambda: len(gateway.sessions) == 0)
+        return stream, gateway, sessions
+
+    return asyncio.run(run())
+
+
+def test_each_channel_is_a_session_on_the_loop():
+    async def scenario(stream, gateway, sessions):
+        for f in [frame(1, b'a'), frame(2, b'b'), frame(1, b'c')]:
+            stream.incoming.put_nowait(f)
+        await until(lambda: len(stream.sent) == 4)
+
+    stream, gateway, sessions = serve(scenario)
+
+    assert stream.sent[0][0] is None
+    assert sorted(stream.sent[1:]) == [(1, b'A'), (1, b'C'), (2, b'B')]
+    assert sessions.started == [1, 2]
+    assert sessions.threads == {threading.main_thread()}
+
+    # The gateway went away, and so did its channels
+    assert sorted(sessions.ended) == [1, 2]
+    assert stream.closed
+
+
+def test_gateway_closes_a_channel():
+    async def scenario(stream, gateway, sessions):
+        stream.incoming.put_nowait(frame(1, b'a'))
+        stream.incoming.put_nowait(frame(1))
+        await until(lambda: sessions.ended == [1])
+
+    stream, gateway, sessions = serve(scenario)
+
+    assert stream.sent[1:] == [(1, b'A')]
+
+
+def test_session_closes_its_channel():
+    async def scenario(stream, gateway, sessions):
+        stream.incoming.put_nowait(frame(1, b'bye'))
+        await until(lambda: sessions.ended == [1])
+
+        # The channel id is free again, for a new session
+        stream.incoming.put_nowait(frame(1, b'a'))
+        await until(lambda: len(stream.sent) == 3)
+
+    stream, gateway, sessions = serve(scenario)
+
+    assert stream.sent[1:] == [(1, b''), (1, b'A')]
+    assert sessions.started == [1, 1]
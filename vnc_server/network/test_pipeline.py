@@ -0,0 +1,109 @@
+#
+# Unit tests of Pipeline (see pipeline.py), over a local socket pair. No server needed.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_pipeline.py
+#
+import socket
+
+import pytest
+
+from command import Codec, Command, IdleAck, IdleRequest, EnrouteToRiderAck
+from communication import FrameReader
+from pipeline import Pipeline
+
+
+def makeAck(commandClass, seq=None):
+    ack = commandClass({
+        'name': 'Vehicle 1',
+        'lat': 35.5,
+        'lon': -78.5,
+        'heading': 0.0,
+        'steering': 0.0,
+        'speed': 0.0,
+        'batteryLife': 90,
+        'minBatteryLife': 20,
+        'mileage': 0.0
+    })
+    ack.seq = seq
+    return ack
+
+
+@pytest.fixture(params=Codec.supported)
+def connection(request):
+    """
+    A started Pipeline, and the vehicle's end of its connection (with a FrameReader)
+    """
+    serverSock, vehicleSock = socket.socketpair()
+    serverSock.settimeout(5)
+    vehicleSock.settimeout(5)
+
+    pipeline = Pipeline(serverSock, FrameReader(serverSock), request.param)
+    pipeline.start()
+
+    yield pipeline, vehicleSock, FrameReader(vehicleSock), request.param
+
+    pipeline.close()
+    serverSock.close()
+    vehicleSock.close()
+
+
+def test_acks_are_matched_to_their_requests_by_seq(connection):
+    pipeline, vehicleSock, vehicleReader, codec = connection
+
+    futures = [pipeline.request(IdleRequest({})) for i in range(3)]
+    requests = [Command.recv(vehicleReader) for i in range(3)]
+    assert len(set(r.seq for r in requests)) == 3
+
+    # Answered out of order
+    for request in reversed(requests):
+        makeAck(IdleAck, request.seq).send(vehicleSock, codec)
+
+    for future, request in zip(futures, requests):
+        assert future.result(5).seq == request.seq
+
+
+def test_acks_without_seq_go_to_the_inbox(connection):
+    pipeline, vehicleSock, vehicleReader, codec = connection
+
+    future = pipeline.request(IdleRequest({}))
+    request = Command.recv(vehicleReader)
+
+    makeAck(EnrouteToRiderAck).send(vehicleSock, codec)
+    makeAck(IdleAck, request.seq).send(vehicleSock, codec)
+
+    assert isinstance(pipeline.recv(5), EnrouteToRiderAck)
+    assert isinstance(future.result(5), IdleAck)
+
+
+def test_an_ack_with_an_unknown_seq_goes_to_the_inbox(connection):
+    pipeline, vehicleSock, vehicleReader, codec = connection
+
+    makeAck(IdleAck, 12345).send(vehicleSock, codec)
+
+    assert pipeline.recv(5).seq == 12345
+
+
+def test_seq_wraps_around(connection):
+    pipeline, vehicleSock, vehicleReader, codec = connection
+    pipeline.nextSeq = Pipeline.maxSeq
+
+    pipeline.request(IdleRequest({}))
+    pipeline.request(IdleRequest({}))
+
+    assert [Command.recv(vehicleReader).seq for i in range(2)] == [Pipeline.maxSeq, 1]
+
+
+def test_closing_fails_the_pending_requests(connection):
+    pipeline, vehicleSock, vehicleReader, codec = connection
+
+    future = pipeline.request(IdleRequest({}))
+    vehicleSock.close()
+
+    with pytest.raises(ConnectionError):
+        future.result(5)
+    with pytest.raises(ConnectionError):
+        pipeline.recv(5)
+    with pytest.raises(ConnectionError):
+        pipeline.request(IdleRequest({}))
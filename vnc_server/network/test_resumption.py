@@ -0,0 +1,145 @@
+#
+# Unit tests of SessionResumption (see resumption.py), with stand-in sessions.
+# No server or database needed.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_resumption.py
+#
+import threading
+
+import pytest
+
+from resumption import SessionResumption
+
+
+class FakeSession(object):
+    def __init__(self, vName='Vehicle 1'):
+        self.vName = vName
+        self.vState = 'IDLE'
+        self.superseded = False
+        self.supersedes = 0
+        self.closed = threading.Event()
+
+    def supersede(self):
+        self.supersedes += 1
+
+    def closeSession(self):
+        self.closed.set()
+
+
+@pytest.fixture
+def resumption(monkeypatch):
+    monkeypatch.setattr(SessionResumption, 'resumeWindow', 0.1)
+    return SessionResumption()
+
+
+def issue(resumption, session):
+    session.resumeToken = resumption.issue(session)
+    return session.resumeToken
+
+
+def test_parked_session_is_resumed(resumption):
+    session = FakeSession()
+    token = issue(resumption, session)
+
+    resumption.park(session)
+    assert resumption.stats()['parked'] == 1
+
+    assert resumption.resume(token, 'Vehicle 1') is session
+    assert not session.closed.wait(0.3)
+    assert session.supersedes == 0
+    assert resumption.stats() == {'parked': 0, 'resumed': 1, 'expired': 0}
+
+
+def test_parked_session_expires(resumption):
+    session = FakeSession()
+    token = issue(resumption, session)
+
+    resumption.park(session)
+
+    assert session.closed.wait(5)
+    assert resumption.resume(token, 'Vehicle 1') is None
+    assert resumption.stats() == {'parked': 0, 'resumed': 0, 'expired': 1}
+
+
+def test_expiry_that_lost_the_race_to_resume_does_nothing(resumption):
+    session = FakeSession()
+    token = issue(resumption, session)
+    resumption.park(session)
+
+    resumption.resume(token, 'Vehicle 1')
+    resumption.expire(token)
+
+    assert not session.closed.is_set()
+    assert resumption.stats()['expired'] == 0
+
+
+def test_live_session_is_superseded(resumption):
+    session = FakeSession()
+    token = issue(resumption, session)
+
+    assert resumption.resume(token, 'Vehicle 1') is session
+    assert session.superseded
+    assert session.supersedes == 1
+
+    # Its connection is shut, so it ends, but must not park or let go of the vehicle
+    resumption.park(session)
+    assert resumption.stats()['parked'] == 0
+    assert not session.closed.wait(0.3)
+
+
+def test_token_is_only_good_once(resumption):
+    session = FakeSession()
+    token = issue(resumption, session)
+    resumption.park(session)
+
+    assert resumption.resume(token, 'Vehicle 1') is session
+    assert resumption.resume(token, 'Vehicle 1') is None
+
+
+def test_token_of_another_vehicle_is_refused(resumption):
+    session = FakeSession()
+    token = issue(resumption, session)
+    resumption.park(session)
+
+    assert resumption.resume(token, 'Vehicle 2') is None
+    assert resumption.resume('', 'Vehicle 1') is None
+    assert resumption.resume(token, 'Vehicle 1') is session
+
+
+def test_session_still_in_its_handshake_is_refused(resumption):
+    session = FakeSession()
+    del session.vState
+    token = issue(resumption, session)
+
+    assert resumption.resume(token, 'Vehicle 1') is None
+    assert not session.superseded
+
+
+def test_forgotten_session_cant_be_resumed(resumption):
+    session = FakeSession()
+    token = issue(resumption, session)
+
+    resumption.forget(session)
+    resumption.park(session)
+
+    assert resumption.resume(token, 'Vehicle 1') is None
+    assert resumption.stats()['parked'] == 0
+
+
+def test_concurrent_resumes_get_the_session_once(resumption):
+    session = FakeSession()
+    token = issue(resumption, session)
+    resumption.park(session)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(resumption.resume(token, 'Vehicle 1')))
+               for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+
+    assert results.count(session) == 1
+    assert results.count(None) == 7
@@ -0,0 +1,96 @@
+#
+# Unit tests of the UDP position reports (see telemetry.py). The datagrams are
+# handed to TelemetryServer.handle() directly, so no vehicle or server is needed.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_telemetry.py
+#
+import pytest
+
+from telemetry import TelemetryServer, TelemetryStream
+
+
+@pytest.fixture
+def server():
+    server = TelemetryServer('127.0.0.1', 0)
+    yield server
+    server.sock.close()
+
+
+def report(token, seq, lat=35.5, lon=-78.5):
+    return TelemetryServer.datagram.pack(token, seq, lat, lon, 90.0, 4.0, 80)
+
+
+def test_newest_report_is_kept(server):
+    token = server.register('Vehicle 1')
+
+    server.handle(report(token, 1, lat=1.0))
+    server.handle(report(token, 2, lat=2.0))
+
+    assert server.latest('Vehicle 1')['lat'] == 2.0
+    assert server.withLatestPosition({'name': 'Vehicle 1', 'lat': 0.0, 'lon': 0.0})['lat'] == 2.0
+
+
+def test_stale_and_repeated_reports_are_dropped(server):
+    token = server.register('Vehicle 1')
+    stream = server.streams[token]
+
+    server.handle(report(token, 5, lat=5.0))
+    server.handle(report(token, 4, lat=4.0))
+    server.handle(report(token, 5, lat=5.5))
+
+    assert server.latest('Vehicle 1')['lat'] == 5.0
+    assert (stream.received, stream.dropped) == (1, 2)
+
+
+def test_seq_wraps_around(server):
+    token = server.register('Vehicle 1')
+
+    server.handle(report(token, TelemetryServer.maxSeq, lat=1.0))
+    server.handle(report(token, 0, lat=2.0))
+    server.handle(report(token, 1, lat=3.0))
+    server.handle(report(token, TelemetryServer.maxSeq - 1, lat=4.0))
+
+    assert server.latest('Vehicle 1')['lat'] == 3.0
+    assert server.streams[token].dropped == 1
+
+
+def test_newer_means_less_than_half_the_range_ahead():
+    stream = TelemetryStream('Vehicle 1')
+    assert stream.isNewer(1000)
+
+    stream.lastSeq = 1000
+    assert stream.isNewer(1001)
+    assert stream.isNewer(1000 + TelemetryServer.maxSeq // 2 - 1)
+    assert not stream.isNewer(1000 + TelemetryServer.maxSeq // 2 + 1)
+    assert not stream.isNewer(1000)
+
+
+def test_unknown_tokens_and_bad_sizes_are_ignored(server):
+    token = server.register('Vehicle 1')
+
+    server.handle(report(b'\0' * TelemetryServer.tokenLen, 1))
+    server.handle(report(token, 1)[:-1])
+
+    assert server.latest('Vehicle 1') is None
+
+
+def test_unregistered_sessions_stop_reporting(server):
+    token = server.register('Vehicle 1')
+    server.handle(report(token, 1))
+
+    server.unregister(token)
+    server.handle(report(token, 2))
+
+    assert server.latest('Vehicle 1') is None
+
+
+def test_a_new_session_of_the_vehicle_takes_over(server):
+    oldToken = server.register('Vehicle 1')
+    newToken = server.register('Vehicle 1')
+
+    server.handle(report(newToken, 1, lat=1.0))
+    server.unregister(oldToken)
+
+    assert server.latest('Vehicle 1')['lat'] == 1.0
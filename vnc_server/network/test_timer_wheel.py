@@ -0,0 +1,99 @@
+#
+# Unit tests of TimerWheel (see timer_wheel.py), on a fast wheel.
+# No server needed.
+#
+# Run them from this folder:
+#
+#     python3 -m pytest test_timer_wheel.py
+#
+import threading
+import time
+
+import pytest
+
+from timer_wheel import TimerWheel
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.woken = threading.Event()
+        self.wakeups = 0
+        self.wokenAt = None
+
+    def wake(self):
+        self.wakeups += 1
+        self.wokenAt = time.time()
+        self.woken.set()
+
+
+@pytest.fixture
+def wheel(monkeypatch):
+    # One turn is 512 slots of 2ms. The wheel's thread keeps ticking (at the usual
+    # rate) after the test, so nSlots must stay as it is.
+    monkeypatch.setattr(TimerWheel, 'slotDuration', 0.002)
+
+    wheel = TimerWheel()
+    wheel.start()
+    return wheel
+
+
+def test_wakes_at_the_deadline(wheel):
+    session = FakeSession()
+    start = time.time()
+
+    wheel.schedule(session, 0.05)
+
+    assert session.woken.wait(5)
+    assert session.wokenAt - start >= 0.05 - TimerWheel.slotDuration
+    assert session.wakeups == 1
+
+
+def test_deadline_more_than_one_turn_away(wheel):
+    session = FakeSession()
+    start = time.time()
+
+    # Over one turn: the slot comes around once before it is due
+    delay = 1.25 * TimerWheel.nSlots * TimerWheel.slotDuration
+    wheel.schedule(session, delay)
+
+    assert not session.woken.wait(delay - 0.15)
+    assert session.woken.wait(5)
+    assert session.wokenAt - start >= delay - TimerWheel.slotDuration
+    assert session.wakeups == 1
+
+
+def test_rescheduling_replaces_the_deadline(wheel):
+    session = FakeSession()
+
+    wheel.schedule(session, 0.5)
+    wheel.schedule(session, 0.02)
+
+    assert session.woken.wait(5)
+    time.sleep(0.6)
+    assert session.wakeups == 1
+    assert wheel.stats()['scheduled'] == 0
+
+
+def test_canceled_session_is_not_woken(wheel):
+    session = FakeSession()
+
+    wheel.schedule(session, 0.03)
+    wheel.cancel(session)
+
+    assert not session.woken.wait(0.15)
+    assert wheel.stats()['scheduled'] == 0
+
+
+def test_sessions_due_together_are_woken_together(wheel):
+    sessions = [FakeSession() for i in range(5)]
+
+    # Start right after a tick, so all of them fall in the same slot
+    time.sleep(TimerWheel.slotDuration - (time.time() - wheel.startTime) % TimerWheel.slotDuration)
+    for session in sessions:
+        wheel.schedule(session, 0.05)
+
+    for session in sessions:
+        assert session.woken.wait(5)
+    stats = wheel.stats()
+    assert stats['woken'] == 5
+    assert stats['wakeupsPerSlot'] > 1
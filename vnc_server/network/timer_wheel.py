@@ -0,0 +1,135 @@
+#
+# One scheduler for the ticks of every vehicle session.
+#
+# A session that has nothing to do until its next tick (see waitTick()) doesn't
+# sleep on a timer of its own: it schedules its next tick on the server's
+# TimerWheel, and waits for wake(). Time is cut into slots of slotDuration
+# seconds; the wheel's thread wakes up once per slot, and wakes every session
+# due in it at once. Sessions can still be woken before their deadline
+# (e.g. by the dispatcher, or a ride event), which cancels it.
+#
+# The wheel has nSlots slots. A deadline further away than one turn of the wheel
+# sits in its slot until the turn it is due in.
+#
+
+import math
+import threading
+import time
+
+import logging
+import os
+logger = logging.getLogger(__name__)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(module)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(formatter)
+logging_path = os.path.dirname(os.path.realpath(__file__)).split("src/")[0] + "src/server_log"
+fh = logging.FileHandler(logging_path)
+fh.setLevel(logging.DEBUG)
+fh.setFormatter(formatter)
+logger.addHandler(ch)
+logger.addHandler(fh)
+logger.setLevel(logging.DEBUG)
+
+
+class TimerWheel(object):
+    """
+    A hashed timer wheel of session ticks. Each session has at most one deadline,
+    and is woken (with its wake()) in the first slot at or after it.
+    """
+
+    # Seconds per slot: ticks due within the same slot are woken together
+    slotDuration = 0.05
+
+    # One turn of the wheel is nSlots * slotDuration seconds
+    nSlots = 512
+
+    def __init__(self):
+        # Map from session to the number of the tick (see run()) it is due at, one per slot
+        self.slots = [{} for i in range(TimerWheel.nSlots)]
+
+        # Map from session to its slot
+        self.deadlines = {}
+
+        # Ticks of the wheel so far, and when the first one was
+        self.ticks = 0
+        self.startTime = time.time()
+
+        self.lock = threading.Lock()
+
+        # Sessions woken, and slots that had any, so far
+        self.woken = 0
+        self.busySlots = 0
+
+    def start(self):
+        self.startTime = time.time()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    #
+    # Wake session in delay seconds, instead of at the deadline it had (if any)
+    #
+
+    def schedule(self, session, delay):
+        with self.lock:
+            self.cancelLocked(session)
+
+            # At least the next tick; the current one may have gone by already
+            dueTick = math.ceil((time.time() + delay - self.startTime) / TimerWheel.slotDuration)
+            dueTick = max(dueTick, self.ticks + 1)
+
+            slot = dueTick % TimerWheel.nSlots
+            self.slots[slot][session] = dueTick
+            self.deadlines[session] = slot
+
+    def cancel(self, session):
+        with self.lock:
+            self.cancelLocked(session)
+
+    def cancelLocked(self, session):
+        slot = self.deadlines.pop(session, None)
+        if (slot is not None):
+            del self.slots[slot][session]
+
+    #
+    # Tick once per slotDuration. A tick that comes late (e.g. the process was busy)
+    # is caught up right away, so no slot is skipped.
+    #
+
+    def run(self):
+        while True:
+            delay = self.startTime + (self.ticks + 1) * TimerWheel.slotDuration - time.time()
+            if (delay > 0):
+                time.sleep(delay)
+
+            with self.lock:
+                self.ticks += 1
+                slot = self.slots[self.ticks % TimerWheel.nSlots]
+
+                due = [session for session, dueTick in slot.items() if dueTick <= self.ticks]
+                for session in due:
+                    del slot[session]
+                    del self.deadlines[session]
+
+                if (len(due) > 0):
+                    self.woken += len(due)
+                    self.busySlots += 1
+
+            for session in due:
+                try:
+                    session.wake()
+                except Exception as e:
+                    logger.exception(f"EXCEPTION while waking a session: {e}")
+
+    def stats(self):
+        """Returns the metrics of the wheel
+
+        :return: 'scheduled' (sessions with a deadline now), and 'woken' (sessions) and
+            'wakeupsPerSlot' (on average, over the slots that woke any) so far
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                'scheduled': len(self.deadlines),
+                'woken': self.woken,
+                'wakeupsPerSlot': self.woken / self.busySlots if self.busySlots else 0.0
+            }
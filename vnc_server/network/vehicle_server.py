@@ -4,6 +4,8 @@ import time
 import random
 import math
 import signal
+import asyncio
+import json
 
 from typing import Optional, List
 from pdb import set_trace
@@ -16,13 +18,23 @@ import os
 
 sys.path.insert(1, os.path.abspath("../../vnc_server/"))
 from network.comm_strategy import GoodStrategy
-from vehicle_util import *
+from network import async_strategy
+from network.telemetry import TelemetryServer
+from network.dispatcher import RideDispatcher
+from network.broker import Broker, RemoteDispatcher
+from network.session_pool import SessionPool
+from network.fleet import FleetRegistry
+from network.coord_history import CoordHistoryBuffer
+from network.timer_wheel import TimerWheel
+from network.resumption import SessionResumption
+from command import StopAll, ServerBusy
 
 sys.path.insert(1, os.path.join(sys.path[0], '../databases'))
 from sqldb import SQLDB
 from user_util import UserUtil
 
-from network.vehicle_util import VehicleRideSelector, Ride, RideDBUtil
+# The sessions key by network.vehicle_util's State, so these must come from there too
+from network.vehicle_util import VehicleRideSelector, Ride, RideDBUtil, VehicleDBUtil, ReportCadence, RideEvents
 
 import logging
 import os
@@ -40,37 +52,32 @@ logger.addHandler(fh)
 logger.setLevel(logging.DEBUG)
 
 #
-# When the user presses CTRL+C, disable all vehicles.
+# When the user presses CTRL+C, stop and disable all vehicles.
+#
+# A running server does that on its own thread (see stopOnInterrupt()), since the
+# broadcast may take a while, and the handler holds up the main thread. Once done,
+# it interrupts the main thread again to exit. A second CTRL+C exits right away.
 #
 def intHandler(sig, frame):
+    server = VehicleServer.instance
+    if (server is not None):
+        if (not server.interrupted.is_set()):
+            server.interrupted.set()
+            return
+        sys.exit(0)
+
+    disableAllVehicles()
+    sys.exit(0)
+
+def disableAllVehicles():
     response = SQLDB().update('Vehicles', {'enabled': 0}, None)
     if (response.success == True):
         print('Successfully disabled all vehicles')
     else:
         print('FAILED TO DISABLE ALL VEHICLES: %s' % response.message)
 
-    sys.exit(0)
-
 signal.signal(signal.SIGINT, intHandler)
 
-#
-# Be able to access rides in a thread-safe way.
-#
-ridesLock = threading.Lock()
-
-
-def withRidesLock(func):
-    def wrapper(*args, **kwargs):
-        ridesLock.acquire()
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            print('Exception: %s' % e)
-        finally:
-            ridesLock.release()
-
-    return wrapper
-
 randNum = random.randint(12001, 12999)
 class VehicleServer():
     """The class handling the vehicle and ride interactions with VNC
@@ -104,12 +111,49 @@ class VehicleServer():
     # So we may as well keep it large
     queueSize = 100
 
-    def __init__(self, strategy: Optional[str] = None):
+    # How vehicle connections are served: a thread each (THREADED),
+    # or coroutines on one event loop (ASYNCIO, see async_strategy.py)
+    THREADED = 'threaded'
+    ASYNCIO = 'asyncio'
+    mode = THREADED
+
+    # How many DB calls the asyncio mode runs at once
+    dbWorkers = 32
+
+    # How many vehicle sessions a process holds at once,
+    # and how many more connections may wait for one to end (see session_pool.py)
+    maxSessions = 1000
+    maxQueuedSessions = 100
+
+    # How many processes hold vehicle connections (see broker.py).
+    # With 1, this process does.
+    workers = 1
+
+    # How long broadcast() waits for a frame to reach every vehicle
+    broadcastTimeout = 5.0
+
+    # The running server, if any (for intHandler())
+    instance = None
+
+    def __init__(self, strategy: Optional[str] = None, mode: Optional[str] = None, workers: Optional[int] = None):
         """Init method for server
 
         :param strategy: the strategy to match rides with, defaults to None
         :type strategy: Optional[str], optional
+        :param mode: how to serve vehicle connections, VehicleServer.THREADED or VehicleServer.ASYNCIO,
+            defaults to VehicleServer.mode
+        :type mode: Optional[str], optional
+        :param workers: how many worker processes hold vehicle connections, defaults to VehicleServer.workers.
+            With more than 1, this process only runs the ride queue and matching, as their broker (see broker.py).
+        :type workers: Optional[int], optional
         """
+        startTime = time.time()
+
+        self.mode = mode or VehicleServer.mode
+        if (self.mode not in (VehicleServer.THREADED, VehicleServer.ASYNCIO)):
+            print('Unknown server mode: %s' % self.mode)
+            exit()
+
         # VehicleServer.port = port = random.randint(12001, 12999) # 12345
         # Set all vehicles to inactive (they'll become active once they connect)
         try:
@@ -121,16 +165,109 @@ class VehicleServer():
             print('FAILED TO DISABLE ALL VEHICLES: %s' % e)
             exit()
 
-        self.rides = []
-
         self._rideSelector = VehicleRideSelector()
         self._vehicleSelectorStrat = strategy
 
+        nWorkers = workers or VehicleServer.workers
+
+        # The current state of the vehicles connected to this process (see fleet.py).
+        # A broker has no vehicles, and reads the Vehicles table instead.
+        self.fleet = FleetRegistry() if nWorkers == 1 else None
+
+        # Their position reports, on their way to the CoordHistory table (see coord_history.py)
+        self.coordHistory = CoordHistoryBuffer() if nWorkers == 1 else None
+
+        # Matches waiting rides with idle vehicles, as either comes in
+        self.dispatcher = RideDispatcher(self._rideSelector.getVehicleSelector(strategy), self.fleet)
+
         # dictionaries to keep track of when ride requests start and pick-up
         # inorder to calculate wait times
         self.ride_start_dict = {}  # key: rideID value: start time
         self.ride_pickup_dict = {} # key: rideID value: pickup time
 
+        # Pick up where the last run left off
+        nReloaded = self.reloadRides()
+
+        # How often vehicles should report, shared by every session
+        self.cadence = ReportCadence()
+
+        # Pickups, arrivals and cancellations, as the API hears of them
+        self.rideEvents = RideEvents()
+
+        # Map from vehicle name to the session (CommStrategy) serving it
+        self.sessions = {}
+        self.sessionsLock = threading.Lock()
+
+        # Runs the sessions, and turns connections away once full
+        self.sessionPool = SessionPool(VehicleServer.maxSessions, VehicleServer.maxQueuedSessions)
+
+        # Wakes the sessions at their next tick
+        self.timers = TimerWheel()
+
+        # Sessions whose connection dropped, until their vehicle reconnects.
+        # The vehicles of a sharded server may reconnect to another worker, so it has none.
+        self.resumption = SessionResumption() if nWorkers == 1 else None
+
+        # Set by intHandler() on CTRL+C
+        self.interrupted = threading.Event()
+        threading.Thread(target=self.stopOnInterrupt, daemon=True).start()
+
+        VehicleServer.instance = self
+
+        # Vehicle connections go to worker processes instead (see runWorker()).
+        # UDP datagrams would be spread over them with no regard for which one
+        # holds the session, so vehicles only report over TCP.
+        if (nWorkers > 1):
+            if (not hasattr(socket, 'SO_REUSEPORT')):
+                print('Cannot run %d workers: SO_REUSEPORT is not supported here' % nWorkers)
+                exit()
+
+            self.broker = Broker(self, nWorkers)
+            self.telemetry = None
+            self.sock = None
+            self.reportReady(startTime, nReloaded)
+            return
+
+        self.broker = None
+
+        # Position reports over UDP, on the same port number as the vehicle connections
+        try:
+            self.telemetry = TelemetryServer(VehicleServer.host, VehicleServer.port)
+        except Exception as e:
+            print('Failed to open the telemetry socket, vehicles will only report over TCP: %s' % e)
+            self.telemetry = None
+
+        self.openSocket(reusePort=False)
+        self.reportReady(startTime, nReloaded)
+
+    #
+    # Queue the rides that were still waiting for a vehicle when the server last stopped,
+    # oldest first, and return how many.
+    # Rides a vehicle was already serving are left as they are, and aren't dispatched again.
+    #
+
+    def reloadRides(self):
+        try:
+            rides = RideDBUtil.getWaitingRides(SQLDB())
+        except Exception as e:
+            print('Failed to reload the waiting rides: %s' % e)
+            return 0
+
+        for ride in rides:
+            self.ride_start_dict[str(ride.getRideID())] = ride.getTime()
+        self.dispatcher.addRides(rides)
+        return len(rides)
+
+    def reportReady(self, startTime, nReloaded):
+        self.readyTime = time.time() - startTime
+        logger.info(f"Ready in {self.readyTime:.3f}s, with {nReloaded} waiting ride(s) reloaded")
+
+    #
+    # Create the vehicle socket, and listen on it.
+    # With reusePort, every worker process listens on the same port.
+    #
+
+    def openSocket(self, reusePort):
         # Create the socket
         try:
             # AF_INET means IPv4,
@@ -146,6 +283,13 @@ class VehicleServer():
         except Exception as e:
             print('Failed to make address reusable: %s' % e)
 
+        if (reusePort):
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            except Exception as e:
+                print('Failed to make port reusable: %s' % e)
+                exit()
+
         # Listen on the socket
         try:
             self.sock.bind((VehicleServer.host, VehicleServer.port))
@@ -167,6 +311,91 @@ class VehicleServer():
     def run(self):
         print('VehicleServer.run()')
 
+        if (self.broker is not None):
+            self.broker.start()
+            self.broker.join()
+            return
+
+        if (self.telemetry is not None):
+            self.telemetry.start()
+        self.fleet.start()
+        self.coordHistory.start()
+        self.timers.start()
+
+        self.serve()
+
+    #
+    # The 'main()' of a worker process (see broker.py), forked from the broker's server.
+    # conn is its end of the pipe to the broker.
+    #
+
+    def runWorker(self, conn):
+        # Start from fresh state; another thread may have held a lock when forking
+        self.cadence = ReportCadence()
+        self.rideEvents = RideEvents()
+        self.sessionsLock = threading.Lock()
+        self.sessionPool = SessionPool(VehicleServer.maxSessions, VehicleServer.maxQueuedSessions)
+
+        self.fleet = FleetRegistry()
+        self.fleet.start()
+        self.coordHistory = CoordHistoryBuffer()
+        self.coordHistory.start()
+        self.timers = TimerWheel()
+        self.timers.start()
+
+        self.interrupted = threading.Event()
+        threading.Thread(target=self.stopOnInterrupt, daemon=True).start()
+
+        self.broker = None
+        self.dispatcher = RemoteDispatcher(self, conn)
+        self.dispatcher.start()
+
+        self.openSocket(reusePort=True)
+        self.serve()
+
+    #
+    # Once CTRL+C was pressed (see intHandler()), stop all vehicles, write the fleet's
+    # last changes, disable them all, write the coordinate history still buffered,
+    # then have the main thread exit
+    #
+
+    def stopOnInterrupt(self):
+        self.interrupted.wait()
+
+        try:
+            self.broadcast(StopAll({}))
+        except Exception as e:
+            logger.exception(f"EXCEPTION while stopping the vehicles: {e}")
+
+        # Before disabling them, so that is the last write to the Vehicles table
+        try:
+            if (self.fleet is not None):
+                self.fleet.close()
+        except Exception as e:
+            logger.exception(f"EXCEPTION while writing the fleet: {e}")
+
+        try:
+            disableAllVehicles()
+        except Exception as e:
+            logger.exception(f"EXCEPTION while disabling the vehicles: {e}")
+
+        try:
+            if (self.coordHistory is not None):
+                self.coordHistory.close()
+        except Exception as e:
+            logger.exception(f"EXCEPTION while writing the coordinate history: {e}")
+
+        os.kill(os.getpid(), signal.SIGINT)
+
+    #
+    # Accept and serve vehicle connections, forever
+    #
+
+    def serve(self):
+        if (self.mode == VehicleServer.ASYNCIO):
+            asyncio.run(async_strategy.serve(self, VehicleServer.dbWorkers))
+            return
+
         while True:
             try:
                 (clientSock, clientAddr) = self.sock.accept()
@@ -174,37 +403,180 @@ class VehicleServer():
                 print('Failed to accept client connection: %s' % e)
                 continue
 
-            # myHandler = RandomStrategy(clientSock)
-            myHandler = GoodStrategy(clientSock)
+            self.startSession(clientSock)
+
+    #
+    # Handle one vehicle (or gateway, see gateway.py) on a thread of the session pool,
+    # or turn it away if the pool is full.
+    # sock is a client socket or a GatewayChannel.
+    #
+
+    def startSession(self, sock):
+        # myHandler = RandomStrategy(sock)
+        myHandler = GoodStrategy(sock)
+
+        try:
+            if (not self.sessionPool.submit(myHandler.startServer, self)):
+                self.refuseSession(sock)
+        except Exception as e:
+            print('Failed to start client thread: %s' % e)
+            sock.close()
+
+    #
+    # Tell a connection the server is full, and close it
+    #
+
+    def refuseSession(self, sock):
+        busy = ServerBusy({'retryAfter': self.sessionPool.retryAfter()})
+        try:
+            busy.send(sock)
+        except Exception as e:
+            logger.debug(f"Failed to send ServerBusy: {e}")
+        sock.close()
+
+        logger.warning(f"Turned a vehicle connection away: {self.sessionPool.stats()}")
 
-            target = myHandler.__class__.startServer
-            args = (myHandler, self)
+    def getRideQueueStats(self) -> dict:
+        """Returns the metrics of the ride queue, and of the lock guarding it
+
+        :return: see :func:`dispatcher.RideDispatcher.stats`
+        :rtype: dict
+        """
+        return self.dispatcher.stats()
+
+    def getSessionStats(self) -> dict:
+        """Returns the metrics of this process's vehicle sessions, and of their ticks
+
+        :return: see :func:`session_pool.SessionPool.stats` and :func:`timer_wheel.TimerWheel.stats`
+        :rtype: dict
+        """
+        stats = self.sessionPool.stats()
+        stats.update(self.timers.stats())
+        if (self.resumption is not None):
+            stats.update(self.resumption.stats())
+        return stats
+
+    def getCoordHistoryStats(self) -> dict:
+        """Returns the metrics of the CoordHistory rows waiting to be inserted
+
+        :return: see :func:`coord_history.CoordHistoryBuffer.stats`
+        :rtype: dict
+        """
+        return self.coordHistory.stats() if self.coordHistory is not None else {}
+
+    def getDBStats(self) -> dict:
+        """Returns the metrics of this process's pool of MySQL connections, and of its schema cache
+
+        :return: see :func:`connection_pool.ConnectionPool.stats` and :func:`schema_cache.SchemaCache.stats`
+        :rtype: dict
+        """
+        stats = SQLDB.getPool().stats()
+        stats.update(SQLDB.schema.stats())
+        return stats
+
+    def addSession(self, vName, session):
+        with self.sessionsLock:
+            self.sessions[vName] = session
+
+    def removeSession(self, vName, session):
+        with self.sessionsLock:
+            # A reconnected vehicle may already have a newer session
+            if (self.sessions.get(vName) is session):
+                del self.sessions[vName]
+
+    def getSession(self, vName):
+        with self.sessionsLock:
+            return self.sessions.get(vName)
+
+    def pushCommand(self, vName, command):
+        """Sends a command to a vehicle right away, ahead of anything queued for it
+
+        Only vehicles on a pipelined connection (see pipeline.py) can be pushed to.
+
+        :param vName: the name of the target vehicle
+        :type vName: str
+        :param command: the request to send
+        :type command: :class:`command.Command`
+        :return: the Future of the vehicle's ack, or None if the vehicle isn't connected
+        :rtype: :class:`concurrent.futures.Future` or None
+        """
+        session = self.getSession(vName)
+        if (session is None):
+            return None
+        return session.push(command)
+
+    def broadcast(self, command, timeout: float = broadcastTimeout) -> dict:
+        """Sends the same command to every connected vehicle
+
+        The command is encoded once per codec in use (so once, for a fleet on one codec),
+        and that one buffer is sent to every vehicle with that codec.
+        On pipelined connections it goes ahead of anything else queued.
+        Vehicles don't answer broadcasts.
+
+        :param command: the command to send. Its seq is ignored.
+        :type command: :class:`command.Command`
+        :param timeout: how many seconds to wait for the frame to be sent to every vehicle
+        :type timeout: float
+        :return: map from vehicle name to the seconds it took to send it the frame,
+                 or None if that didn't happen within the timeout.
+                 Empty on a broker, which hands the command to its workers without waiting.
+        :rtype: dict
+        """
+        if (self.broker is not None):
+            self.broker.broadcast(command)
+            return {}
+
+        with self.sessionsLock:
+            sessions = dict(self.sessions)
+
+        command.seq = None
+        payloads = {}
+        latencies = {vName: None for vName in sessions}
+        remaining = [len(sessions)]
+        lock = threading.Lock()
+        allSent = threading.Event()
+
+        def onSent(vName, delivered=True):
+            with lock:
+                if (delivered):
+                    latencies[vName] = time.time() - start
+                remaining[0] -= 1
+                if (remaining[0] == 0):
+                    allSent.set()
+
+        start = time.time()
+        for vName, session in sessions.items():
+            payload = payloads.get(session.codec)
+            if (payload is None):
+                payload = payloads[session.codec] = command.encode(session.codec)
 
             try:
-                threading.Thread(target=target, args=args).start()
+                session.sendPayload(payload, urgent=True, onSent=lambda vName=vName: onSent(vName))
             except Exception as e:
-                print('Failed to start client thread: %s' % e)
-                continue
+                logger.error(f"Failed to broadcast {command.__class__.__name__} to vehicle {vName}: {e}")
+                onSent(vName, delivered=False)
 
-    @withRidesLock
-    def getRide(self, vName) -> Optional[Ride]:
-        """Selects and returns a ride request utilizing the best strategy
+        if (len(sessions) > 0):
+            allSent.wait(timeout)
 
-        Uses :class:`vehicle_util.VehicleRideSelector` to obtain the optimal ride
-        selection strategy, and uses that strategy to choose the ride for the vehicle.
-        :return: Ride instance from the queue or None
-        :rtype: :class:`Ride` or None
-        """
-        ride = self._rideSelector.getVehicleSelector(self._vehicleSelectorStrat).selectRide(vName, queue=self.rides)
-        return ride
+        with lock:
+            latencies = dict(latencies)
+        delivered = [l for l in latencies.values() if l is not None]
+        logger.info(f"Broadcast {command.__class__.__name__} to {len(delivered)}/{len(latencies)} vehicles "
+                    f"with {len(payloads)} encode(s)"
+                    + (f", max latency {max(delivered) * 1000:.1f}ms" if delivered else ""))
+        return latencies
+
+    #
+    # The ride is written to the DB first, and only then queued (see dispatcher.py),
+    # so no lock is held across the DB round trips
+    #
 
-    @withRidesLock
     def addRide(self, riderEmail, riderLat, riderLon, destLat, destLon, rtime):
         newRide = Ride(riderEmail, riderLat, riderLon, destLat, destLon, rtime)
         response = RideDBUtil.addRide(SQLDB(), newRide)
         if response:
             newRide.setRideID(SQLDB())
-            self.rides.append(newRide)
 
             # Assign the ride id to user
             db = SQLDB()
@@ -214,11 +586,12 @@ class VehicleServer():
             r = db.update('Users', obj, {"email": riderEmail})
             if not r.success:
                 logger.error(f"Failed to assign ride id {newRide.getRideID()} to user {riderEmail}: {r.message}")
-        # add ride id with start time to dictionary
-        self.ride_start_dict[str(newRide.getRideID())] = time.time()
+
+            # add ride id with start time to dictionary
+            self.ride_start_dict[str(newRide.getRideID())] = time.time()
+            self.dispatcher.addRide(newRide)
         return newRide.getRideID()
 
-    @withRidesLock
     def findRide(self, id: str) -> dict:
         """Returns a dict representing a pending :class:`vehicle_util.Ride` with the target id
 
@@ -240,7 +613,6 @@ class VehicleServer():
             logger.debug(f"Did not find ride with id {id}")
             return None
 
-    @withRidesLock
     def getRides(self) -> List[dict]:
         """Returns a list of pending rides registered with the server
 
@@ -266,8 +638,16 @@ class VehicleServer():
         :return: the list of the vehicles
         :rtype: List[dict]
         """
-        #Might have to remove that False, this currently gets all vehicles including disabled ones.
-        return VehicleDBUtil.getVehiclesLite(SQLDB())
+        if (self.fleet is not None):
+            vehicles = self.fleet.getVehicles()
+        else:
+            #Might have to remove that False, this currently gets all vehicles including disabled ones.
+            vehicles = VehicleDBUtil.getVehiclesLite(SQLDB())
+
+        # Vehicles reporting over UDP are further along than the DB says
+        if (self.telemetry is not None):
+            vehicles = tuple(self.telemetry.withLatestPosition(v) for v in vehicles)
+        return vehicles
 
     def findVehicle(self, id: str) -> dict:
         """Returns a dict representing a pending :class:`vehicle_util.Vehicle` with the target ride id
@@ -283,7 +663,9 @@ class VehicleServer():
         :rtype: dict
         """
         import json
-        r = RideDBUtil.getVehicle(SQLDB(), id)
+        r = self.fleet.getVehicleForRide(id) if self.fleet is not None else None
+        if not r:
+            r = RideDBUtil.getVehicle(SQLDB(), id)
         if r:
             logger.debug(f"Found ride with id {id}: {json.dumps(r)}")
             return r
@@ -307,21 +689,40 @@ class VehicleServer():
         if response:
             # add ride id with pickup time to dictionary
             self.ride_pickup_dict[str(rideID)] = time.time()
+            self.publishRideEvent(rideID, RideEvents.PICKUP)
             return "Confirmed Pickup"
         return "Pickup confirmation failed."
 
     def confirmArrival(self, rideID):
         response = RideDBUtil.confirmArrival(SQLDB(), rideID)
 
-        if response: return "Confirmed Arrival"
+        if response:
+            self.publishRideEvent(rideID, RideEvents.ARRIVAL)
+            return "Confirmed Arrival"
         return "Arrival confirmation failed."
 
     def cancelRide(self, rideID):
         response = RideDBUtil.cancelRide(SQLDB(), rideID)
 
-        if response: return "Canceled Ride"
+        if response:
+            # A ride still waiting for a vehicle won't get one
+            self.dispatcher.removeRide(rideID)
+
+            # The vehicle's session acts on it now rather than at its next DB check
+            self.publishRideEvent(rideID, RideEvents.CANCEL)
+            return "Canceled Ride"
         return "Ride cancellation failed."
 
+    #
+    # Tell the session serving the ride, wherever it is
+    #
+
+    def publishRideEvent(self, rideID, event):
+        if (self.broker is not None):
+            self.broker.publish(rideID, event)
+        else:
+            self.rideEvents.publish(rideID, event)
+
     def clearStartAndPickupDicts(self):
         """
         Clears the ride start and pickup dictionaries that are used to
@@ -4,6 +4,8 @@
 
 import math
 import json
+import threading
+import time
 from enum import Enum
 from abc import ABC, abstractmethod
 from typing import List, Optional, Tuple
@@ -45,6 +47,136 @@ class FSMUtil(object):
             raise Exception(errStr)
 
 
+class ReportCadence(object):
+    """
+    How often a vehicle in each state should report its state to the server.
+
+    Vehicles heading somewhere report often, so the map and pickup times stay fresh.
+    Idle and charging vehicles barely move, so they report much less often.
+
+    Every interval is stretched by a back-off factor while the server is overloaded,
+    i.e. while sessions spend too long on the work of one tick (DB writes, mostly).
+    One ReportCadence is shared by every session of a VehicleServer.
+    """
+
+    # Seconds between two reports, by state
+    intervals = {
+        State.IDLE:               2.0,
+        State.ENROUTE_TO_RIDER:   0.25,
+        State.TO_RIDER:           1.0,
+        State.ENROUTE_TO_DEST:    0.25,
+        State.TO_DEST:            1.0,
+        State.ENROUTE_TO_CHARGER: 0.5,
+        State.CHARGING:           5.0
+    }
+
+    # Average seconds of work per tick above which the server counts as overloaded,
+    # and below which it counts as recovered
+    overloadedWork = 0.10
+    recoveredWork = 0.02
+
+    # How much a new tick counts in the average
+    smoothing = 0.05
+
+    # The back-off factor doubles (or halves) at most once per adjustPeriod seconds
+    maxBackoff = 8.0
+    adjustPeriod = 5.0
+
+    def __init__(self):
+        self.backoff = 1.0
+        self.avgWork = 0.0
+        self.lastAdjust = 0.0
+        self.lock = threading.Lock()
+
+    def interval(self, state):
+        return ReportCadence.intervals[state] * self.backoff
+
+    #
+    # A session spent work seconds on one tick (not counting waiting on its vehicle)
+    #
+
+    def observe(self, work):
+        with self.lock:
+            self.avgWork += ReportCadence.smoothing * (work - self.avgWork)
+
+            now = time.time()
+            if (now - self.lastAdjust < ReportCadence.adjustPeriod):
+                return
+
+            if (self.avgWork > ReportCadence.overloadedWork and self.backoff < ReportCadence.maxBackoff):
+                self.backoff *= 2
+            elif (self.avgWork < ReportCadence.recoveredWork and self.backoff > 1.0):
+                self.backoff /= 2
+            else:
+                return
+
+            self.lastAdjust = now
+            print('Report cadence back-off is now x%g (%.3fs of work per tick)' % (self.backoff, self.avgWork))
+
+
+class RideEvents(object):
+    """
+    What happened to each ride (pickup or arrival confirmed, canceled), by ride id,
+    as heard by this process.
+
+    The VehicleServer publishes an event when the API confirms or cancels a ride,
+    and wakes the session serving that ride (its listener) right away.
+    The session checks happened() instead of the DB on each tick,
+    and only reads the DB every fallbackInterval seconds,
+    for changes made outside this process.
+    One RideEvents is shared by every session of a VehicleServer.
+    """
+
+    PICKUP = 'pickup'
+    ARRIVAL = 'arrival'
+    CANCEL = 'cancel'
+
+    # Seconds between two DB checks of a ride, for events this process didn't see
+    fallbackInterval = 5.0
+
+    def __init__(self):
+        # Map from ride id to the set of its events so far
+        self.events = {}
+
+        # Map from ride id to the session serving it (anything with wake())
+        self.listeners = {}
+
+        self.lock = threading.Lock()
+
+    def publish(self, rideID, event):
+        rideID = str(rideID)
+        with self.lock:
+            self.events.setdefault(rideID, set()).add(event)
+            listener = self.listeners.get(rideID)
+
+        if (listener is not None):
+            listener.wake()
+
+    def happened(self, rideID, event):
+        with self.lock:
+            return event in self.events.get(str(rideID), ())
+
+    def subscribe(self, rideID, listener):
+        with self.lock:
+            self.listeners[str(rideID)] = listener
+
+    def unsubscribe(self, rideID, listener):
+        rideID = str(rideID)
+        with self.lock:
+            if (self.listeners.get(rideID) is listener):
+                del self.listeners[rideID]
+
+    #
+    # The ride is over; drop everything about it
+    #
+
+    def forget(self, rideID):
+        rideID = str(rideID)
+        with self.lock:
+            self.events.pop(rideID, None)
+            self.listeners.pop(rideID, None)
+
+
 class SpatialUtil(object):
     @staticmethod
     def getDist(lat1, lon1, lat2, lon2):
@@ -140,16 +272,19 @@ class VehicleDBUtil(object):
         return True
 
     @staticmethod
-    def updateStatus(db, vName: str, status: str, t: int, lat: float, lon: float, batLife: int = -1,
-                       curRideId: Optional[int] = -1) -> bool:
+    def updateStatus(db, vName: str, status: str, t: float, lat: float, lon: float, batLife: int = -1,
+                       curRideId: Optional[int] = -1, mileage: float = -1, fleet=None, history=None) -> bool:
         """Insterts the vehicle's location and status into CoordHistory table
 
         The status should be one of the given list:
         ('WAITING', 'ENROUTE_TO_RIDER', 'TO_RIDER', 'ENROUTE_TO_DEST', 'TO_DEST').
 
-        Beware that the time 't' is used as primary key. So, if you try to report
-        the location more than once per second, the insertion will fail. So, instead,
-        the already existing entry will be updated with new information.
+        Beware that the time 't' (to the millisecond) is part of the primary key. So, if you report
+        the location again at the same time, the already existing entry is updated with the new
+        information instead. See "CoordHistory timestamps" in databases/README.md for a table
+        whose 't' holds whole seconds.
+
+        Both tables are written in one transaction: one statement each, and one commit.
 
         :param db: the reference to the db interface instance. Normally :class:`vnc_server.databases.sqldb.SQLDB`
         :type db: :class:`vnc_server.databases.sqldb.SQLDB`
@@ -158,7 +293,7 @@ class VehicleDBUtil(object):
         :param status: the status of the vehicle
         :type status: str
         :param t: the time associated with the given information
-        :type t: int
+        :type t: float
         :param lat: the latitude of the vehicle
         :type lat: float
         :param lon: the longitude of the vehicle
@@ -169,43 +304,29 @@ class VehicleDBUtil(object):
                           For the cases when the ride id should be set to NULL (when ride is finished or canceled)
                           provide None.
         :type: None or int
+        :param mileage: the mileage of the vehicle. Defaults to -1 if this should not be reported
+        :type: float
+        :param fleet: the registry of the connected vehicles. If given, the Vehicles table is updated from it later,
+                      instead of now. Defaults to None
+        :type fleet: :class:`fleet.FleetRegistry`
+        :param history: the buffer of CoordHistory rows. If given, the row is inserted from it later, instead of now.
+                        Defaults to None
+        :type history: :class:`coord_history.CoordHistoryBuffer`
         :return: True if the info was successfuly added to the table or False otherwise
         :rtype: bool
         """
-        wasSuccessful = True
+        statements = []
 
         #
         # Update the coordinate history
         #
-        obj = {
-            'vehicleName': vName,
-            'status':      status,
-            't':           t,
-            'lat':         lat,
-            'lon':         lon
-        }
-        cols = list(obj.keys())
-        response = db.create('CoordHistory', cols, obj)
-        if not response.success:
-            if "Duplicate entry" not in response.message:
-                print('Failed to insert into CoordinateHistory: %s' %
-                    response.message)
-                wasSuccessful = False
-            else:
-                setAttrs = {
-                    'lat': lat,
-                    'lon': lon,
-                    'status': status
-                }
-                whereAttrs = {
-                    'vehicleName': vName,
-                    't': t
-                }
-                response = db.update('CoordHistory', setAttrs, whereAttrs)
-                if (response.success != True):
-                    print('Failed to update Vehicle coordinates in CoordHistory: %s' %
-                        response.message)
-                    wasSuccessful = False
+        t = round(t, 3)
+        if history is not None:
+            history.add(vName, status, t, lat, lon)
+        else:
+            cols = ['vehicleName', 'status', 't', 'lat', 'lon']
+            row = (vName, status, t, lat, lon)
+            statements.append(db.upsertSQL('CoordHistory', cols, [row], ['lat', 'lon', 'status']))
 
         #
         # Update vehicle's status
@@ -220,17 +341,57 @@ class VehicleDBUtil(object):
             setAttrs["batteryLife"] = batLife
         if curRideId is None or curRideId != -1:
             setAttrs["curRideID"] = curRideId
+        if mileage != -1:
+            setAttrs["mileage"] = mileage
 
-        whereAttrs = {
-            'name': vName,
-        }
-        response = db.update('Vehicles', setAttrs, whereAttrs)
-        if (response.success != True):
-            print('Failed to update Vehicle coordinates: %s' %
-                response.message)
-            wasSuccessful = False
+        if fleet is not None:
+            fleet.update(vName, setAttrs)
+        else:
+            whereAttrs = {
+                'name': vName,
+            }
+            statements.append(db.updateSQL('Vehicles', setAttrs, whereAttrs))
+
+        if len(statements) == 0:
+            return True
+
+        try:
+            db.executeAll(statements)
+        except Exception as e:
+            print('Failed to update Vehicle coordinates and status: %s' % e)
+            return False
+
+        return True
+
+    @staticmethod
+    def insertCoordHistory(db, vName: str, samples: List[list]) -> bool:
+        """Inserts many of the vehicle's past locations and statuses into CoordHistory table at once
+
+        Used for the states a vehicle recorded while it was offline (see :class:`command.TelemetryBatch`).
+        All of the samples go in one multi-row insert, rather than one insert each.
+        Samples whose time is already in the table are skipped.
+
+        :param db: the reference to the db interface instance. Normally :class:`vnc_server.databases.sqldb.SQLDB`
+        :type db: :class:`vnc_server.databases.sqldb.SQLDB`
+        :param vName: the name of the vehicle
+        :type vName: str
+        :param samples: the samples, each one [t, lat, lon, status]
+        :type samples: List[list]
+        :return: True if the samples were successfuly added to the table or False otherwise
+        :rtype: bool
+        """
+        if (len(samples) == 0):
+            return True
 
-        return wasSuccessful
+        cols = ['vehicleName', 't', 'lat', 'lon', 'status']
+        rows = [(vName, t, lat, lon, status) for t, lat, lon, status in samples]
+
+        response = db.createMany('CoordHistory', cols, rows, ignoreDuplicates=True)
+        if not response.success:
+            print('Failed to insert into CoordinateHistory: %s' % response.message)
+            return False
+
+        return True
 
     @staticmethod
     def disableVehicle(db, name):
@@ -442,6 +603,42 @@ class RideDBUtil(object):
             return ()
         return tuple(response.results)
 
+    @staticmethod
+    def getWaitingRides(db) -> List['Ride']:
+        """Returns the rides in the Rides table still waiting for a vehicle, oldest first
+
+        The whole table is read at once. Rides that were canceled, or already assigned
+        to a vehicle, are left out. In case of error returns an empty list.
+
+        :param db: the instance of the database interface to use. Typically :class:`vnc_server.databases.sqldb.SQLDB`
+        :type db: `vnc_server.databases.sqldb.SQLDB`
+        :return: the waiting rides, with their ride ids set
+        :rtype: List[Ride]
+        """
+        response = db.read('Rides', ['id', 'tStart', 'startNode', 'endNode', 'canceled', 'userEmail', 'vehicleName'], [], {})
+        if not response.success:
+            print('Failed to retrieve Rides: %s' % response.message)
+            return []
+
+        rides = []
+        for r in sorted(response.results, key=lambda r: r['tStart']):
+            if r['vehicleName'] or r['canceled'] == '\x01':
+                continue
+
+            # The nodes are stored as '(lat, lon)' (see addRide())
+            try:
+                riderLat, riderLon = [float(v) for v in r['startNode'].strip('()').split(',')]
+                destLat, destLon = [float(v) for v in r['endNode'].strip('()').split(',')]
+            except ValueError:
+                print('Skipping ride %s with malformed nodes: %s, %s' % (r['id'], r['startNode'], r['endNode']))
+                continue
+
+            ride = Ride(r['userEmail'], riderLat, riderLon, destLat, destLon, r['tStart'])
+            ride.rideID = r['id']
+            rides.append(ride)
+
+        return rides
+
     @staticmethod
     def getRide(db, rideID):
         # Get the ride (if it exists)
@@ -800,6 +997,18 @@ class VehicleSelectorStrategy(ABC):
         """
         pass
 
+    def forget(self, rideID):
+        """Drops whatever the strategy keeps about a ride that left the queue
+
+        Called when the ride is canceled, or handed out other than by this strategy's match.
+        Strategies that keep nothing about rides don't need to override it.
+
+        Arguments:
+            :param rideID: the ID of the ride that left the queue
+            :type rideID: int
+        """
+        pass
+
 
 class FIFORide(VehicleSelectorStrategy):
     """The basic FIFO selection strategy
@@ -845,8 +1054,8 @@ class ProximityRide(VehicleSelectorStrategy):
     def selectRide(self, vName: str, queue: List[Ride], **kwargs) -> Optional[Ride]:
         """Selects and returns the first ride request waiting in the queue
 
-        The method does not expect any keyword arguments, so any arguments besides a list of Rides
-        will be ignored.
+        The only keyword argument used is fleet, the registry of the connected vehicles,
+        to get the vehicle's location from. Without it, the location is read from the Vehicles table.
 
         Arguments:
             :param vName: the vehichle name that is being ride-matched
@@ -860,7 +1069,11 @@ class ProximityRide(VehicleSelectorStrategy):
         match = None
         minDist = -1
         try:
-            vlat,vlong = VehicleDBUtil.getVehicleLocation(SQLDB(), vName)
+            fleet = kwargs.get('fleet')
+            location = fleet.getLocation(vName) if fleet is not None else None
+            if location is None:
+                location = VehicleDBUtil.getVehicleLocation(SQLDB(), vName)
+            vlat,vlong = location
             origin = {'latitude': float(vlat), 'longitude': float(vlong)}
             checkLen = self.NUM_CHECK
             if len(queue) < self.NUM_CHECK:
@@ -872,7 +1085,7 @@ class ProximityRide(VehicleSelectorStrategy):
                     self.rideSkip[ride.rideID] = 1
                 elif skips >= self.SKIP_MAX:
                     queue.remove(ride)
-                    self.rideSkip.pop(ride.rideID)
+                    self.rideSkip.pop(ride.rideID, None)
                     return ride
                 elif skips < self.SKIP_MAX:
                     skips += 1
@@ -891,13 +1104,22 @@ class ProximityRide(VehicleSelectorStrategy):
                     minDist = dist
                     match = ride
             queue.remove(match)
-            self.rideSkip.pop(match.rideID)
+            self.rideSkip.pop(match.rideID, None)
             return match
         except IndexError:
             return None
         except ValueError:
             return None
 
+    def forget(self, rideID):
+        """Stops counting the skips of a ride that left the queue
+
+        Arguments:
+            :param rideID: the ID of the ride that left the queue
+            :type rideID: int
+        """
+        self.rideSkip.pop(rideID, None)
+
 
 class VehicleRideSelector():
     """The Factory class providing an instance of :class:`vehicle_util.VehicleSelectorStrategy` based on fleet condition